@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import cubo
+import datos
+import estaciones
+import estadisticas
+import filtros
+import interpolacion
+import muestreo
+import normativa
+import resoluciones
+
+# Escalas por defecto (estaciones, días); los datos son horarios, así que filas = estaciones × días × 24
+ESCALAS = [(6, 365), (60, 365), (60, 365 * 3), (600, 365)]
+DENSIDAD_FALTANTES = 0.02
+
+# Rango típico de cada columna del CSV original, para que los datos sintéticos se parezcan a los reales
+RANGOS = {
+    'CO (ug/m3)': (0, 2000), 'H2S (ug/m3)': (0, 40), 'NO2 (ug/m3)': (0, 200), 'O3 (ug/m3)': (0, 120),
+    'PM10 (ug/m3)': (0, 150), 'PM2.5 (ug/m3)': (0, 80), 'SO2 (ug/m3)': (0, 60), 'Ruido (dB)': (40, 90),
+    'UV': (0, 12), 'Humedad (%)': (40, 100), 'Presion (Pa)': (99500, 101500), 'Temperatura (C)': (12, 30),
+}
+COLUMNAS_CSV = ['Fecha', 'CO (ug/m3)', 'H2S (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'PM10 (ug/m3)', 'PM2.5 (ug/m3)',
+                'SO2 (ug/m3)', 'Ruido (dB)', 'UV', 'Humedad (%)', 'Latitud', 'Longitud', 'Presion (Pa)', 'Temperatura (C)']
+
+# Registro sintético: estaciones en una grilla alrededor de Lima, separadas unos 500 m
+def generar_estaciones(cantidad):
+    lado = int(np.ceil(np.sqrt(cantidad)))
+    fila, columna = np.divmod(np.arange(cantidad), lado)
+    return pd.DataFrame({
+        'Ubicación': [f"Estación {i + 1:04d}" for i in range(cantidad)],
+        'Latitud': np.round(-12.20 + fila * 0.0045, 5),
+        'Longitud': np.round(-77.15 + columna * 0.0045, 5),
+    })
+
+# CSV horario con el esquema de data/aire.csv. H2S y SO2 traen '-' como en la exportación real;
+# el resto de columnas de medición trae celdas vacías con la misma densidad.
+def generar_csv(ruta, registro, dias, densidad_faltantes=DENSIDAD_FALTANTES, semilla=0):
+    generador = np.random.default_rng(semilla)
+    horas = pd.date_range("2020-07-01", periods=dias * 24, freq="h")
+    filas = len(registro) * len(horas)
+    estacion = np.repeat(np.arange(len(registro)), len(horas))
+    data = {'Fecha': np.tile(horas.strftime("%d/%m/%Y %H:%M").to_numpy(), len(registro))}
+    for columna, (minimo, maximo) in RANGOS.items():
+        valores = np.round(generador.uniform(minimo, maximo, filas), 2)
+        faltantes = generador.random(filas) < densidad_faltantes
+        if columna in ['H2S (ug/m3)', 'SO2 (ug/m3)']:
+            valores = np.where(faltantes, '-', valores.astype(str))
+        else:
+            valores[faltantes] = np.nan
+        data[columna] = valores
+    data['Latitud'] = registro['Latitud'].to_numpy()[estacion]
+    data['Longitud'] = registro['Longitud'].to_numpy()[estacion]
+    pd.DataFrame(data)[COLUMNAS_CSV].to_csv(ruta, sep=";", index=False)
+    return filas
+
+class Medicion:
+    def __init__(self, resultados, escala, filas):
+        self.resultados = resultados
+        self.escala = escala
+        self.filas = filas
+
+    # tracemalloc hace varias veces más lentas las etapas que reservan mucha memoria: el tiempo se mide en
+    # una corrida sin trazar y el pico de memoria en otra aparte. `antes` deja el estado como estaba
+    # antes de la primera corrida (por ejemplo, borra el cache que esa corrida escribió).
+    def __call__(self, etapa, funcion, *argumentos, antes=None, **opciones):
+        if antes:
+            antes()
+        inicio = time.perf_counter()
+        resultado = funcion(*argumentos, **opciones)
+        segundos = time.perf_counter() - inicio
+        if antes:
+            antes()
+        tracemalloc.start()
+        funcion(*argumentos, **opciones)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.resultados.append({
+            'estaciones': self.escala[0], 'dias': self.escala[1], 'filas': self.filas, 'etapa': etapa,
+            'segundos': segundos, 'filas_por_segundo': self.filas / segundos if segundos > 0 else None, 'pico_bytes': pico,
+        })
+        print(f"{self.escala[0]:>5} est. {self.escala[1]:>5} días  {etapa:34s} {segundos:9.4f} s  {pico / 2**20:9.1f} MiB")
+        return resultado
+
+def borrar_cache(ruta_csv):
+    for ruta in (datos.ruta_cache(ruta_csv), datos.ruta_niveles(ruta_csv)):
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+def medir_escala(cantidad_estaciones, dias, densidad_faltantes, resultados, directorio):
+    # Un directorio por escala para que el cache en disco de una no se reutilice en la siguiente
+    directorio = os.path.join(directorio, f"{cantidad_estaciones}x{dias}")
+    os.makedirs(directorio, exist_ok=True)
+    registro = generar_estaciones(cantidad_estaciones)
+    ruta_estaciones = os.path.join(directorio, "estaciones.csv")
+    ruta_csv = os.path.join(directorio, "aire.csv")
+    registro.to_csv(ruta_estaciones, sep=";", index=False)
+    filas = generar_csv(ruta_csv, registro, dias, densidad_faltantes)
+    medir = Medicion(resultados, (cantidad_estaciones, dias), filas)
+
+    # Etapas de datos.limpiar por separado
+    aire = medir('lectura_csv', pd.read_csv, ruta_csv, sep=";")
+    aire['Fecha'] = medir('conversion_fechas', pd.to_datetime, aire['Fecha'], format=datos.FORMATO_FECHA)
+    for columna in datos.COLUMNAS_TEXTO:
+        aire[columna] = medir(f'conversion_numerica {columna}', pd.to_numeric, aire[columna], errors='coerce')
+    aire['Fecha'] = aire['Fecha'].dt.floor('h')
+    aire = medir('localizar', estaciones.localizar, aire, registro)
+    aire = aire.rename(columns={'PM2.5 (ug/m3)': 'PM2,5 (ug/m3)'}).drop(columns=['Latitud', 'Longitud'])
+    variables = datos.variables_de(aire)
+    acumulados = medir('agrupacion_diaria', datos.acumular, aire)
+    niveles = medir('niveles_hora_dia_semana_mes', resoluciones.acumular, aire, variables)
+    medir('control_calidad', resoluciones.calificar, niveles['hora'], variables)
+    diario = datos.promediar(acumulados, variables)
+    medir('excluir_marcadas', datos.excluir_marcadas, niveles, variables, diario)
+
+    # Carga completa con y sin cache en disco
+    medir('cargar_aire_sin_cache', datos.cargar_aire, ruta_csv, True, ruta_estaciones, antes=lambda: borrar_cache(ruta_csv))
+    medir('cargar_aire_con_cache', datos.cargar_aire, ruta_csv, True, ruta_estaciones)
+    medir('abrir_compartido_memory_map', datos.abrir_compartido, ruta_csv, True, ruta_estaciones)
+
+    # Estructuras compartidas y operaciones de cada página
+    datos_cubo = medir('cubo', cubo.Cubo.desde_aire, diario, registro)
+    indice = medir('indice_ubicacion_fecha', filtros.AireIndexado, diario)
+    ubicaciones = datos_cubo.ubicaciones[::2]
+    inicio = datos_cubo.fechas[0]
+    fin = datos_cubo.fechas[min(89, len(datos_cubo.fechas) - 1)]
+    medir('filtro_mascaras_original', lambda: diario.loc[diario['Ubicación'].isin(ubicaciones) & diario['Fecha'].between(inicio, fin)])
+    medir('filtro_indice', indice.filtrar, ubicaciones, inicio, fin)
+    serie = medir('pagina_series_cubo', datos_cubo.seleccionar, ubicaciones, inicio, datos_cubo.fechas[-1], ['NO2 (ug/m3)'])
+    medir('pagina_series_lttb', muestreo.reducir, serie, 'Fecha', 'NO2 (ug/m3)', 'Ubicación')
+    medir('pagina_resumen', datos_cubo.promedio_estaciones, inicio, datos_cubo.fechas[-1], variables)
+    medir('pagina_heatmap_estadisticas', datos_cubo.estadisticas_diarias, ubicaciones, inicio, datos_cubo.fechas[-1])
+    medir('pagina_dispersion_correlaciones', estadisticas.correlaciones, diario, variables)
+    medir('pagina_comparativa_cajas', estadisticas.resumenes_caja, datos_cubo.valores, datos_cubo.ubicaciones, datos_cubo.variables)
+    cumplimiento = medir('normativa_completa', normativa.MotorNormativa().actualizar, niveles['hora'])
+    medir('pagina_normativa_excedencias', cumplimiento.excedencias, int(cumplimiento.anios()[-1]))
+    malla = medir('mapa_malla_idw', interpolacion.MallaIDW, datos_cubo.latitudes, datos_cubo.longitudes)
+    pm25 = datos_cubo.valores[:, :, datos_cubo.posicion_variable['PM2,5 (ug/m3)']]
+    medir('mapa_superficie_dia', malla.superficie, pm25[:, -1])
+    medir('mapa_superficie_anio', malla.superficie, pm25)
+
+# Compara dos ejecuciones por (estaciones, días, etapa): >1 significa que la actual es más lenta
+def comparar(actual, anterior):
+    clave = lambda r: (r['estaciones'], r['dias'], r['etapa'])
+    previos = {clave(r): r for r in anterior['resultados']}
+    for resultado in actual['resultados']:
+        previo = previos.get(clave(resultado))
+        if previo and previo['segundos'] > 0:
+            print(f"{resultado['estaciones']:>5} est. {resultado['dias']:>5} días  {resultado['etapa']:34s} "
+                  f"{resultado['segundos'] / previo['segundos']:6.2f}x tiempo  {resultado['pico_bytes'] / max(previo['pico_bytes'], 1):6.2f}x memoria")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline del tablero con datos qHAWAX sintéticos")
+    parser.add_argument("--escala", nargs=2, type=int, action="append", metavar=("ESTACIONES", "DIAS"),
+                        help="Escala a medir; se puede repetir (por defecto: %s)" % ESCALAS)
+    parser.add_argument("--faltantes", type=float, default=DENSIDAD_FALTANTES, help="Fracción de celdas vacías o '-'")
+    parser.add_argument("--salida", default="benchmark.json", help="Archivo JSON con los resultados")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior contra el cual comparar")
+    argumentos = parser.parse_args()
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        for cantidad_estaciones, dias in argumentos.escala or ESCALAS:
+            medir_escala(cantidad_estaciones, dias, argumentos.faltantes, resultados, directorio)
+
+    informe = {
+        'fecha': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'faltantes': argumentos.faltantes,
+        'resultados': resultados,
+    }
+    with open(argumentos.salida, "w", encoding="utf-8") as archivo:
+        json.dump(informe, archivo, indent=2, ensure_ascii=False)
+    if argumentos.comparar:
+        with open(argumentos.comparar, encoding="utf-8") as archivo:
+            comparar(informe, json.load(archivo))
+
+if __name__ == "__main__":
+    main()
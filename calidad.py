@@ -0,0 +1,131 @@
+import numpy as np
+
+# Bits de la máscara de control de calidad de cada (Ubicación, hora, variable)
+FUERA_DE_RANGO = 1
+PLANO = 2
+ATASCADO = 4
+PICO = 8
+NOMBRES = {FUERA_DE_RANGO: 'Fuera de rango', PLANO: 'Racha de ceros', ATASCADO: 'Valor atascado', PICO: 'Pico'}
+TIPO_MASCARA = 'uint8'
+
+# Rango físicamente posible de cada variable; una hora con alguna lectura fuera de él se marca
+RANGOS = {
+    'CO (ug/m3)': (0, 50000), 'H2S (ug/m3)': (0, 1000), 'NO2 (ug/m3)': (0, 2000), 'O3 (ug/m3)': (0, 1000),
+    'PM10 (ug/m3)': (0, 2000), 'PM2,5 (ug/m3)': (0, 1000), 'SO2 (ug/m3)': (0, 2000), 'Ruido (dB)': (30, 140),
+    'UV': (0, 20), 'Humedad (%)': (0, 100), 'Presion (Pa)': (80000, 110000), 'Temperatura (C)': (-10, 50),
+}
+# Horas seguidas con exactamente el mismo valor a partir de las cuales la racha completa se marca.
+# El UV vale 0 toda la noche, así que para él una racha de ceros tiene que ser más larga.
+HORAS_PLANO = 6
+HORAS_PLANO_VARIABLE = {'UV': 18}
+HORAS_ATASCADO = 12
+# Una lectura es un pico si se aleja de sus dos vecinas en el mismo sentido más de DESVIACIONES_PICO
+# desviaciones estándar de las VENTANA_PICO lecturas anteriores de la misma estación
+VENTANA_PICO = 24
+DESVIACIONES_PICO = 5.0
+
+# Máscara de una variable sobre la serie horaria de todas las estaciones. `estacion` (códigos enteros) y
+# las filas deben venir ordenadas por estación y hora; `minimo` y `maximo` son los extremos de las
+# lecturas de cada hora y `valor` su promedio. Todo se calcula con operaciones sobre arreglos, sin
+# recorrer estaciones: las rachas con sumas acumuladas de cambios y la desviación móvil con sumas
+# acumuladas de x y x².
+def marcar(estacion, valor, minimo, maximo, variable):
+    mascara = np.zeros(len(valor), dtype=TIPO_MASCARA)
+    inferior, superior = RANGOS.get(variable, (-np.inf, np.inf))
+    with np.errstate(invalid='ignore'):
+        mascara[(minimo < inferior) | (maximo > superior)] |= FUERA_DE_RANGO
+
+    # Las horas sin dato no cortan una racha ni cuentan como vecinas
+    validas = np.flatnonzero(~np.isnan(valor))
+    if len(validas) == 0:
+        return mascara
+    x = valor[validas].astype('float64')
+    e = estacion[validas]
+    otra_estacion = np.r_[True, e[1:] != e[:-1]]
+
+    nueva_racha = otra_estacion | np.r_[True, x[1:] != x[:-1]]
+    racha = np.cumsum(nueva_racha) - 1
+    largo = np.bincount(racha)[racha]
+    mascara[validas[(x == 0) & (largo >= HORAS_PLANO_VARIABLE.get(variable, HORAS_PLANO))]] |= PLANO
+    mascara[validas[(x != 0) & (largo >= HORAS_ATASCADO)]] |= ATASCADO
+
+    # Desviación de las lecturas anteriores de la misma estación (centradas para no perder precisión)
+    posicion = np.arange(len(x))
+    inicio_estacion = np.maximum.accumulate(np.where(otra_estacion, posicion, 0))
+    desde = np.maximum(posicion - VENTANA_PICO, inicio_estacion)
+    n = posicion - desde
+    centrado = x - x.mean()
+    suma = np.r_[0.0, np.cumsum(centrado)]
+    cuadrados = np.r_[0.0, np.cumsum(centrado ** 2)]
+    # Si las lecturas anteriores son todas iguales (una sola racha) la desviación es exactamente 0: las
+    # sumas acumuladas dejarían un residuo que depende del resto de la serie
+    inicio_racha = np.maximum.accumulate(np.where(nueva_racha, posicion, 0))
+    constante = inicio_racha[np.maximum(posicion - 1, 0)] <= desde
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media = (suma[posicion] - suma[desde]) / n
+        desviacion = np.where(constante, 0.0, np.sqrt(np.maximum((cuadrados[posicion] - cuadrados[desde]) / n - media ** 2, 0)))
+        previa = np.where(otra_estacion, np.nan, np.r_[np.nan, x[:-1]])
+        siguiente = np.where(np.r_[otra_estacion[1:], True], np.nan, np.r_[x[1:], np.nan])
+        # Prueba de picos de QARTOD: cuánto sobresale la lectura del promedio de sus vecinas, descontando su pendiente
+        altura = np.abs(x - (previa + siguiente) / 2) - np.abs(siguiente - previa) / 2
+        pico = (n >= VENTANA_PICO // 2) & (desviacion > 0) & (altura > DESVIACIONES_PICO * desviacion)
+    mascara[validas[pico]] |= PICO
+    return mascara
+
+# Máscara de ventanas en las que solo cambiaron las filas desde un corte (las que tienen `previa` en
+# False). Las filas previas conservan su máscara guardada (`anterior`), salvo la racha que cruza el
+# corte, que puede crecer, y la última lectura previa, cuya vecina siguiente cambió. Si la ventana no
+# llega al final de lo que cambió (`al_final` en False), desde el comienzo de su última racha también se
+# conserva lo guardado. También devuelve, por ventana, si le faltan filas para calcularla: antes del
+# corte, las VENTANA_PICO lecturas previas a esa última lectura y el comienzo de su racha; después, las
+# VENTANA_PICO primeras lecturas (las que dependen de las previas) antes de esa última racha.
+# `al_inicio` marca las ventanas que empiezan en la primera fila de su estación.
+def remarcar(ventana, valor, minimo, maximo, variable, anterior, previa, al_inicio, al_final):
+    nueva = marcar(ventana, valor, minimo, maximo, variable)
+    cantidad = len(al_inicio)
+    validas = np.flatnonzero(~np.isnan(valor))
+    if len(validas) == 0:
+        return nueva, ~al_final
+    v = ventana[validas]
+    x = valor[validas]
+    nueva_racha = np.r_[True, (v[1:] != v[:-1]) | (x[1:] != x[:-1])]
+    racha = np.cumsum(nueva_racha) - 1
+    posicion = np.arange(len(validas))
+    inicio_racha = np.maximum.accumulate(np.where(nueva_racha, posicion, 0))
+
+    # Por ventana, como posiciones en `validas`: su primera y su última lectura, la última previa al
+    # corte (-1 si no hay) y la primera desde el corte
+    despues = ~previa[validas]
+    primera = np.full(cantidad, len(validas) - 1)
+    np.minimum.at(primera, v, posicion)
+    ultima_ventana = np.zeros(cantidad, dtype='int64')
+    np.maximum.at(ultima_ventana, v, posicion)
+    ultima = np.full(cantidad, -1)
+    np.maximum.at(ultima, v, np.where(despues, -1, posicion))
+    primera_nueva = np.full(cantidad, len(validas) - 1)
+    np.minimum.at(primera_nueva, v[despues], posicion[despues])
+    # Sin lecturas nuevas hasta el final no cambia nada de lo anterior; si la ventana no llega al final
+    # todavía puede haberlas más adelante
+    con_nuevas = np.bincount(v[despues], minlength=cantidad) > 0
+    con_ultima = con_nuevas & (ultima >= 0)
+    racha_ultima = np.where(con_ultima, racha[ultima], -1)
+    faltan = ~al_inicio & con_nuevas & (~con_ultima | (ultima - primera < VENTANA_PICO) | (racha_ultima == racha[primera]))
+    faltan |= ~al_final & (~con_nuevas | (inicio_racha[ultima_ventana] < primera_nueva + VENTANA_PICO))
+
+    # Desde la última lectura previa (o el comienzo de la ventana) vale la máscara nueva; antes, solo las
+    # marcas de la racha que cruza el corte
+    filas = np.arange(len(valor))
+    desde = np.where(con_ultima, validas[ultima], np.where(con_nuevas, np.searchsorted(ventana, np.arange(cantidad)), len(valor)))
+    hasta = np.where(al_final, len(valor), validas[inicio_racha[ultima_ventana]])
+    mascara = np.where(((filas >= desde[ventana]) | ~previa) & (filas < hasta[ventana]), nueva, anterior).astype(TIPO_MASCARA)
+    en_racha = validas[racha == racha_ultima[v]]
+    rachas = np.uint8(PLANO | ATASCADO)
+    mascara[en_racha] = (mascara[en_racha] & ~rachas) | (nueva[en_racha] & rachas)
+    return mascara, faltan
+
+# Cantidad de horas con cada marca, por variable
+def resumen(mascaras):
+    return {
+        variable: {nombre: int(((mascara & bit) > 0).sum()) for bit, nombre in NOMBRES.items()} | {'Horas': len(mascara)}
+        for variable, mascara in mascaras.items()
+    }
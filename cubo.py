@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+UN_DIA = np.timedelta64(1, 'D')
+
+# Cubo denso estación × día × variable con los promedios diarios ya calculados por datos.cargar_aire.
+# Las páginas lo recortan con índices en lugar de volver a agrupar el DataFrame en cada interacción.
+class Cubo:
+    def __init__(self, ubicaciones, fechas, variables, valores, latitudes, longitudes):
+        self.ubicaciones = list(ubicaciones)
+        self.fechas = fechas
+        self.variables = list(variables)
+        self.valores = valores
+        self.validos = ~np.isnan(valores)
+        # Un (estación, día) está presente si tuvo al menos una variable medida ese día
+        self.presentes = self.validos.any(axis=2)
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        # Orden de las estaciones por valor en cada (día, variable), con los faltantes al final:
+        # permite calcular la mediana de cualquier subconjunto de estaciones sin volver a ordenar.
+        # Se guarda con el entero más chico que alcanza para las estaciones (no int64, que duplicaría
+        # la memoria del cubo) y se ordena variable por variable para no armar la copia de 64 bits completa.
+        self.orden = np.empty(valores.shape, dtype='int16' if len(self.ubicaciones) < 2**15 else 'int32')
+        for j in range(valores.shape[2]):
+            self.orden[:, :, j] = np.argsort(np.where(self.validos[:, :, j], valores[:, :, j], np.inf), axis=0, kind='stable')
+        self.posicion_ubicacion = {ubicacion: i for i, ubicacion in enumerate(self.ubicaciones)}
+        self.posicion_variable = {variable: i for i, variable in enumerate(self.variables)}
+        for arreglo in (self.fechas, self.valores, self.validos, self.presentes, self.latitudes, self.longitudes, self.orden):
+            arreglo.flags.writeable = False
+
+    # `posiciones` es la tabla lateral (Ubicación, Latitud, Longitud) de datos.cargar_posiciones
+    @classmethod
+    def desde_aire(cls, aire, posiciones, variables=None):
+        if variables is None:
+            variables = [col for col in aire.columns if col not in ['Fecha', 'Latitud', 'Longitud', 'Ubicación']]
+        aire = aire.dropna(subset=['Ubicación'])
+        ubicaciones = sorted(aire['Ubicación'].unique())
+        estacion = pd.Categorical(aire['Ubicación'], categories=ubicaciones).codes
+
+        fechas_filas = aire['Fecha'].to_numpy().astype('datetime64[D]')
+        if len(fechas_filas):
+            fechas = np.arange(fechas_filas.min(), fechas_filas.max() + UN_DIA, UN_DIA)
+        else:
+            fechas = np.array([], dtype='datetime64[D]')
+        dia = (fechas_filas - fechas[:1]).astype('int64') if len(fechas) else np.array([], dtype='int64')
+
+        valores = np.full((len(ubicaciones), len(fechas), len(variables)), np.nan)
+        valores[estacion, dia, :] = aire[variables].to_numpy(dtype='float64', na_value=np.nan)
+
+        posiciones = posiciones.drop_duplicates('Ubicación').set_index('Ubicación').reindex(ubicaciones)
+        return cls(ubicaciones, fechas, variables, valores,
+                   posiciones['Latitud'].to_numpy(), posiciones['Longitud'].to_numpy())
+
+    def rango_dias(self, inicio, fin):
+        inicio = np.datetime64(inicio, 'D')
+        fin = np.datetime64(fin, 'D')
+        return slice(np.searchsorted(self.fechas, inicio, side='left'), np.searchsorted(self.fechas, fin, side='right'))
+
+    def indices_ubicaciones(self, ubicaciones):
+        return np.array([self.posicion_ubicacion[u] for u in ubicaciones if u in self.posicion_ubicacion], dtype='int64')
+
+    def indices_variables(self, variables):
+        return np.array([self.posicion_variable[v] for v in variables], dtype='int64')
+
+    # Filas (Fecha, Ubicación, variables...) en el mismo formato largo que usan los gráficos
+    def seleccionar(self, ubicaciones, inicio, fin, variables):
+        estaciones = self.indices_ubicaciones(ubicaciones)
+        dias = self.rango_dias(inicio, fin)
+        columnas = self.indices_variables(variables)
+
+        fila, dia = np.nonzero(self.presentes[estaciones, dias])
+        bloque = self.valores[estaciones, dias][:, :, columnas][fila, dia]
+        data = pd.DataFrame({
+            'Fecha': self.fechas[dias][dia].astype('datetime64[ns]'),
+            'Ubicación': pd.Categorical.from_codes(estaciones[fila], categories=self.ubicaciones),
+        })
+        for i, variable in enumerate(variables):
+            data[variable] = bloque[:, i]
+        return data
+
+    # Promedio diario entre estaciones, ignorando valores faltantes
+    def promedio_estaciones(self, inicio, fin, variables, ubicaciones=None):
+        estaciones = self.indices_ubicaciones(self.ubicaciones if ubicaciones is None else ubicaciones)
+        dias = self.rango_dias(inicio, fin)
+        columnas = self.indices_variables(variables)
+
+        valores = self.valores[estaciones, dias][:, :, columnas]
+        validos = self.validos[estaciones, dias][:, :, columnas]
+        conteo = validos.sum(axis=0)
+        suma = np.where(validos, valores, 0.0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            promedio = np.where(conteo > 0, suma / conteo, np.nan)
+
+        con_datos = self.presentes[estaciones, dias].any(axis=0)
+        data = pd.DataFrame(promedio[con_datos], columns=variables)
+        data.insert(0, 'Fecha', self.fechas[dias][con_datos].astype('datetime64[ns]'))
+        return data
+
+    # Media, mediana, máximo, mínimo, suma y conteo diarios entre las estaciones seleccionadas, para
+    # todas las variables en una sola pasada. Columnas (variable, estadístico); solo días con datos.
+    def estadisticas_diarias(self, ubicaciones, inicio, fin):
+        seleccionadas = np.zeros(len(self.ubicaciones), dtype=bool)
+        seleccionadas[self.indices_ubicaciones(ubicaciones)] = True
+        dias = self.rango_dias(inicio, fin)
+
+        valores = self.valores[:, dias]
+        validos = self.validos[:, dias] & seleccionadas[:, None, None]
+        conteo = validos.sum(axis=0)
+        hay_datos = conteo > 0
+        suma = np.where(validos, valores, 0.0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media = np.where(hay_datos, suma / conteo, np.nan)
+        maximo = np.where(hay_datos, np.where(validos, valores, -np.inf).max(axis=0), np.nan)
+        minimo = np.where(hay_datos, np.where(validos, valores, np.inf).min(axis=0), np.nan)
+
+        orden = self.orden[:, dias]
+        ordenados = np.take_along_axis(valores, orden, axis=0)
+        acumulado = np.take_along_axis(validos, orden, axis=0).cumsum(axis=0)
+        # Posición del valor válido número k (desde 0) en el orden precalculado
+        bajo = np.argmax(acumulado > ((conteo - 1) // 2)[None], axis=0)
+        alto = np.argmax(acumulado > (conteo // 2)[None], axis=0)
+        mediana = (np.take_along_axis(ordenados, bajo[None], axis=0)[0] + np.take_along_axis(ordenados, alto[None], axis=0)[0]) / 2
+        mediana = np.where(hay_datos, mediana, np.nan)
+
+        estadisticos = {'mean': media, 'median': mediana, 'max': maximo, 'min': minimo, 'sum': np.where(hay_datos, suma, np.nan), 'count': conteo}
+        columnas = pd.MultiIndex.from_tuples([(variable, nombre) for variable in self.variables for nombre in estadisticos])
+        tabla = np.stack([estadisticos[nombre] for nombre in estadisticos], axis=2).reshape(len(self.fechas[dias]), -1)
+        con_datos = hay_datos.any(axis=1)
+        return pd.DataFrame(tabla[con_datos], columns=columnas, index=pd.DatetimeIndex(self.fechas[dias][con_datos].astype('datetime64[ns]'), name='Fecha'))
+
+    # Una fila por estación: posición, último día con datos y, para cada variable, su promedio en todo
+    # el periodo (o entre `inicio` y `fin`) y su último valor medido. Es lo que necesita el mapa; no depende de la cantidad de días.
+    def resumen_estaciones(self, variables, inicio=None, fin=None):
+        dias = self.rango_dias(inicio, fin) if inicio is not None else slice(None)
+        fechas = self.fechas[dias]
+        columnas = self.indices_variables(variables)
+        valores = self.valores[:, dias][:, :, columnas]
+        validos = self.validos[:, dias][:, :, columnas]
+        presentes = self.presentes[:, dias]
+        conteo = validos.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media = np.where(conteo > 0, np.where(validos, valores, 0.0).sum(axis=1) / conteo, np.nan)
+        ultimo = media
+        ultima_fecha = None
+        if len(fechas):
+            # Último día válido de cada (estación, variable): el primero al recorrer los días al revés
+            ultimo_dia = len(fechas) - 1 - np.argmax(validos[:, ::-1], axis=1)
+            ultimo = np.where(conteo > 0, np.take_along_axis(valores, ultimo_dia[:, None, :], axis=1)[:, 0], np.nan)
+            dia = len(fechas) - 1 - np.argmax(presentes[:, ::-1], axis=1)
+            ultima_fecha = np.where(presentes.any(axis=1), fechas[dia].astype(str), None)
+
+        data = pd.DataFrame({
+            'Ubicación': self.ubicaciones,
+            'Latitud': self.latitudes,
+            'Longitud': self.longitudes,
+            'Última fecha': ultima_fecha,
+        })
+        for i, variable in enumerate(variables):
+            data['Media ' + variable] = media[:, i]
+            data['Último ' + variable] = ultimo[:, i]
+        return data
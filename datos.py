@@ -0,0 +1,366 @@
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import resoluciones
+from estaciones import RUTA_ESTACIONES, cargar_estaciones, localizar
+from resoluciones import PREFIJO_CONTEO, PREFIJO_SUMA
+
+RUTA_AIRE = "data/aire.csv"
+FORMATO_FECHA = "%d/%m/%Y %H:%M"
+FIJOS = ['Fecha', 'Latitud', 'Longitud', 'Ubicación']
+# Columnas clave del DataFrame que ven las páginas; las coordenadas de cada estación están en el registro
+# (cargar_posiciones) y no se repiten en cada fila
+CLAVES = ['Fecha', 'Ubicación']
+# Los promedios se entregan en float32; las sumas y conteos del cache siguen en 64 bits para no perder
+# precisión al combinarlos en cada carga incremental
+TIPO_MEDICION = 'float32'
+COLUMNAS_TEXTO = ['H2S (ug/m3)', 'SO2 (ug/m3)']
+# Desde fines de 2020 los sensores reportan la presión en hPa aunque la columna diga Pa. Ninguna presión
+# real en Pa está por debajo de este valor, así que esas lecturas se pasan a Pa.
+COLUMNA_PRESION = 'Presion (Pa)'
+LIMITE_HPA = 2000
+
+# Permisos con los que el proceso crea archivos. Se lee una sola vez al importar: os.umask lo cambia para
+# todo el proceso y los hilos que ya corren podrían crear archivos mientras tanto.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Se incrementa cuando cambia la forma en que se procesa el CSV, para invalidar caches antiguos
+VERSION_CACHE = 10
+CLAVE_METADATOS = b"qaira"
+TAMANO_COLA = 1 << 16
+
+def limpiar(aire, estaciones=None):
+    aire['Fecha'] = pd.to_datetime(aire['Fecha'], format=FORMATO_FECHA)
+    for columna in COLUMNAS_TEXTO:
+        aire[columna] = pd.to_numeric(aire[columna], errors='coerce')
+    if COLUMNA_PRESION in aire:
+        presion = aire[COLUMNA_PRESION]
+        aire[COLUMNA_PRESION] = presion.where(~(presion < LIMITE_HPA), presion * 100)
+    aire['Fecha'] = aire['Fecha'].dt.floor('h')
+    aire = localizar(aire, estaciones)
+    aire.rename(columns={'PM2.5 (ug/m3)': 'PM2,5 (ug/m3)'}, inplace=True)
+    # Después de localizar las coordenadas son las del registro, así que no aportan nada por fila
+    return aire.drop(columns=['Latitud', 'Longitud'])
+
+def variables_de(aire):
+    return [col for col in aire.columns if col not in FIJOS]
+
+# Registro único de las columnas de medición numéricas, sin importar su ancho (float32, float64, enteros)
+def columnas_numericas(aire):
+    return sorted(col for col in variables_de(aire) if pd.api.types.is_numeric_dtype(aire[col]))
+
+# Tabla lateral con la posición de cada estación (Ubicación, Latitud, Longitud)
+def cargar_posiciones(ruta_estaciones=RUTA_ESTACIONES):
+    return cargar_estaciones(ruta_estaciones)[['Ubicación', 'Latitud', 'Longitud']]
+
+# Sumas y conteos por (Fecha, Ubicación): a diferencia del promedio,
+# se pueden combinar con los de filas nuevas sin volver a leer el historial
+def acumular(aire):
+    variables = variables_de(aire)
+    aire = aire.assign(Fecha=aire['Fecha'].dt.floor('D'))
+    grupos = aire.groupby(CLAVES, observed=True)[variables]
+    sumas = grupos.sum().add_prefix(PREFIJO_SUMA)
+    conteos = grupos.count().add_prefix(PREFIJO_CONTEO)
+    return pd.concat([sumas, conteos], axis=1)
+
+def combinar(acumulados, nuevos):
+    return pd.concat([acumulados, nuevos]).groupby(level=CLAVES, observed=True).sum()
+
+def promediar(acumulados, variables):
+    aire = pd.DataFrame(index=acumulados.index)
+    for variable in variables:
+        conteo = acumulados[PREFIJO_CONTEO + variable]
+        aire[variable] = (acumulados[PREFIJO_SUMA + variable] / conteo.where(conteo > 0)).astype(TIPO_MEDICION)
+    return aire.reset_index()
+
+# Promedios diarios con el mismo formato que los de cargar_aire, pero sin las horas que el control de
+# calidad marcó. Se arman desde los niveles (que guardan la máscara horaria), sin volver al CSV.
+def excluir_marcadas(niveles, variables, aire):
+    niveles = resoluciones.excluir_marcadas(niveles, variables)
+    limpio = promediar(niveles['dia'].set_index(CLAVES)[[PREFIJO_SUMA + v for v in variables] + [PREFIJO_CONTEO + v for v in variables]], variables)
+    limpio['Ubicación'] = limpio['Ubicación'].astype(aire['Ubicación'].dtype)
+    limpio = limpio.sort_values(['Ubicación', 'Fecha'], ignore_index=True)
+    return limpio, niveles
+
+def procesar_csv(ruta, estaciones=None):
+    aire = limpiar(pd.read_csv(ruta, delimiter=";", decimal="."), estaciones)
+    return promediar(acumular(aire), variables_de(aire))
+
+def ruta_cache(ruta):
+    return os.path.splitext(ruta)[0] + ".feather"
+
+def ruta_niveles(ruta):
+    return os.path.splitext(ruta)[0] + ".niveles.feather"
+
+def calcular_hash(ruta):
+    sha = hashlib.sha256()
+    with open(ruta, "rb") as archivo:
+        for bloque in iter(lambda: archivo.read(1 << 20), b""):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+# Hash de los últimos bytes ya procesados: si no cambió, el archivo solo creció por el final
+def hash_cola(ruta, desplazamiento):
+    with open(ruta, "rb") as archivo:
+        archivo.seek(max(0, desplazamiento - TAMANO_COLA))
+        return hashlib.sha256(archivo.read(min(desplazamiento, TAMANO_COLA))).hexdigest()
+
+def leer_metadatos_cache(ruta_feather):
+    try:
+        with pa.memory_map(ruta_feather) as fuente:
+            metadatos = pa.ipc.open_file(fuente).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    if CLAVE_METADATOS not in metadatos:
+        return None
+    return json.loads(metadatos[CLAVE_METADATOS])
+
+def escribir_cache(tabla, ruta_feather, huella):
+    metadatos = dict(tabla.schema.metadata or {})
+    metadatos[CLAVE_METADATOS] = json.dumps(huella).encode()
+    tabla = tabla.replace_schema_metadata(metadatos)
+    # Se escribe en un archivo temporal y luego se reemplaza, para no dejar un cache a medias. El nombre
+    # del temporal es único: el tablero, el servicio y los procesos de exportación pueden ingerir a la vez.
+    temporal = None
+    try:
+        descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta_feather) or ".", prefix=os.path.basename(ruta_feather) + ".", suffix=".tmp")
+        os.close(descriptor)
+        # En un solo lote: con varios, to_pandas tiene que concatenarlos y copia la columna completa
+        feather.write_feather(tabla.combine_chunks(), temporal, compression="uncompressed", chunksize=max(len(tabla), 1))
+        # mkstemp lo crea solo legible por este usuario; el cache lo leen procesos de otros usuarios
+        os.chmod(temporal, 0o666 & ~UMASK)
+        os.replace(temporal, ruta_feather)
+    except OSError:
+        # Sin permisos de escritura el tablero sigue funcionando, solo sin cache
+        if temporal is not None and os.path.exists(temporal):
+            os.remove(temporal)
+
+# Los niveles hora/día/semana/mes van en un archivo aparte con el mismo desplazamiento que el
+# cache principal; si no coinciden (p. ej. una escritura interrumpida) se reconstruyen ambos
+def niveles_al_dia(ruta, guardada):
+    niveles = leer_metadatos_cache(ruta_niveles(ruta))
+    return niveles is not None and all(niveles.get(clave) == guardada.get(clave) for clave in ('version', 'desplazamiento', 'sha_cola'))
+
+# Los faltantes de las columnas float se guardan como NaN y no como nulos de Arrow: sin máscara de
+# validez, abrir_compartido puede usar los buffers del archivo directamente como arreglos de numpy
+def a_tabla(df):
+    return pa.table({
+        columna: pa.array(df[columna].to_numpy()) if df[columna].dtype.kind == 'f' else pa.array(df[columna], from_pandas=True)
+        for columna in df.columns
+    })
+
+# El cache guarda los promedios (lo que usan las páginas) junto a las sumas y conteos
+def guardar(acumulados, variables, ruta_feather, huella, niveles=None, ruta=None):
+    if niveles is not None:
+        huella_niveles = {clave: huella[clave] for clave in ('version', 'variables', 'desplazamiento', 'sha_cola')}
+        escribir_cache(a_tabla(resoluciones.apilar(niveles)), ruta_niveles(ruta), huella_niveles)
+    # Ordenado por (Ubicación, Fecha), como lo usa filtros.AireIndexado: así no tiene que reordenar (copiar)
+    # la vista compartida del cache
+    acumulados = acumulados.sort_index(level=['Ubicación', 'Fecha'])
+    aire = promediar(acumulados, variables)
+    escribir_cache(a_tabla(pd.concat([aire, acumulados.reset_index(drop=True)], axis=1)), ruta_feather, huella)
+    return aire
+
+def leer_acumulados(ruta_feather, variables):
+    columnas = [prefijo + variable for prefijo in (PREFIJO_SUMA, PREFIJO_CONTEO) for variable in variables]
+    return feather.read_feather(ruta_feather, columns=CLAVES + columnas).set_index(CLAVES)
+
+def leer_incremento(ruta, desde, hasta, columnas, estaciones):
+    with open(ruta, "rb") as archivo:
+        archivo.seek(desde)
+        bloque = archivo.read(hasta - desde)
+    # Solo se procesan líneas completas; una línea a medio escribir queda para la próxima carga
+    fin_linea = bloque.rfind(b"\n")
+    if fin_linea < 0:
+        return None, desde
+    bloque = bloque[:fin_linea + 1]
+    if not bloque.strip():
+        return None, desde + len(bloque)
+    nuevas = pd.read_csv(io.BytesIO(bloque), delimiter=";", decimal=".", header=None, names=columnas)
+    return limpiar(nuevas, estaciones), desde + len(bloque)
+
+# Lectura completa de los primeros `hasta` bytes del CSV (el tamaño con el que se armó la huella), hasta
+# la última línea completa como en leer_incremento. Devuelve las filas y los bytes procesados, que son
+# el desplazamiento desde el que sigue la próxima carga incremental.
+def leer_completo(ruta, hasta):
+    with open(ruta, "rb") as archivo:
+        bloque = archivo.read(hasta)
+    fin_linea = bloque.rfind(b"\n")
+    if fin_linea >= 0:
+        bloque = bloque[:fin_linea + 1]
+    return pd.read_csv(io.BytesIO(bloque), delimiter=";", decimal="."), bloque
+
+# Huella actual del CSV y metadatos del cache, o None si el cache no sirve ni como punto de partida
+def revisar_cache(ruta, ruta_estaciones):
+    estado = os.stat(ruta)
+    # Un cambio en el registro de estaciones también invalida el cache, porque cambia la asignación de ubicaciones
+    huella = {'version': VERSION_CACHE, 'tamano': estado.st_size, 'mtime': estado.st_mtime_ns,
+              'estaciones': calcular_hash(ruta_estaciones)}
+    guardada = leer_metadatos_cache(ruta_cache(ruta))
+    if (guardada is not None and guardada.get('version') == VERSION_CACHE and guardada.get('estaciones') == huella['estaciones']
+            and niveles_al_dia(ruta, guardada)):
+        return estado, huella, guardada
+    return estado, huella, None
+
+def cache_al_dia(huella, guardada):
+    return guardada is not None and guardada['tamano'] == huella['tamano'] and guardada['mtime'] == huella['mtime']
+
+def cargar_aire(ruta=RUTA_AIRE, incremental=True, ruta_estaciones=RUTA_ESTACIONES):
+    ruta_feather = ruta_cache(ruta)
+    estado, huella, guardada = revisar_cache(ruta, ruta_estaciones)
+    estaciones = cargar_estaciones(ruta_estaciones)
+
+    if guardada is not None:
+        variables = guardada['variables']
+        if cache_al_dia(huella, guardada):
+            return feather.read_feather(ruta_feather, columns=CLAVES + variables)
+
+        desplazamiento = guardada['desplazamiento']
+        if incremental and estado.st_size >= desplazamiento and hash_cola(ruta, desplazamiento) == guardada['sha_cola']:
+            # Modo incremental: se asume que el CSV solo crece y se procesan solo las filas agregadas al final
+            nuevas, desplazamiento = leer_incremento(ruta, desplazamiento, estado.st_size, guardada['columnas'], estaciones)
+            acumulados = leer_acumulados(ruta_feather, variables)
+            niveles = leer_niveles(ruta)
+            if nuevas is not None:
+                acumulados = combinar(acumulados, acumular(nuevas))
+                niveles = resoluciones.combinar(niveles, resoluciones.acumular(nuevas, variables), variables)
+            huella.update(variables=variables, columnas=guardada['columnas'], desplazamiento=desplazamiento,
+                          sha_cola=hash_cola(ruta, desplazamiento), sha256=None)
+            return guardar(acumulados, variables, ruta_feather, huella, niveles, ruta)
+
+        # El tamaño o la fecha cambiaron: solo se reconstruye si el contenido también cambió
+        huella['sha256'] = calcular_hash(ruta)
+        if guardada.get('sha256') == huella['sha256']:
+            huella.update({clave: guardada[clave] for clave in ('variables', 'columnas', 'desplazamiento', 'sha_cola')})
+            escribir_cache(feather.read_table(ruta_feather), ruta_feather, huella)
+            return feather.read_feather(ruta_feather, columns=CLAVES + variables)
+
+    crudo, bloque = leer_completo(ruta, estado.st_size)
+    columnas = list(crudo.columns)
+    aire = limpiar(crudo, estaciones)
+    variables = variables_de(aire)
+    # El hash es el de lo procesado: si quedó una línea a medio escribir no coincide con el del archivo y
+    # un cambio solo de fecha no reutiliza este cache
+    huella.update(variables=variables, columnas=columnas, desplazamiento=len(bloque),
+                  sha256=hashlib.sha256(bloque).hexdigest(), sha_cola=hashlib.sha256(bloque[-TAMANO_COLA:]).hexdigest())
+    return guardar(acumular(aire), variables, ruta_feather, huella, resoluciones.acumular(aire, variables), ruta)
+
+# Mismo contenido que cargar_aire, pero como vista de solo lectura sobre un memory map del cache: las
+# columnas numéricas apuntan a las páginas del archivo, que el sistema operativo comparte entre todas
+# las sesiones y procesos que lo abren, en lugar de una copia por cada uno. No se debe modificar.
+def abrir_compartido(ruta=RUTA_AIRE, incremental=True, ruta_estaciones=RUTA_ESTACIONES):
+    if es_multiple(ruta):
+        return cargar_varios(ruta, ruta_estaciones)[0]
+    _, huella, guardada = revisar_cache(ruta, ruta_estaciones)
+    if not cache_al_dia(huella, guardada):
+        aire = cargar_aire(ruta, incremental, ruta_estaciones)
+        _, huella, guardada = revisar_cache(ruta, ruta_estaciones)
+        if not cache_al_dia(huella, guardada):
+            # No se pudo escribir el cache (o el CSV cambió mientras tanto): se usa la copia en memoria
+            return aire
+    return leer_compartido(ruta_cache(ruta), guardada['variables'])
+
+def mapear(ruta_feather):
+    return pa.ipc.open_file(pa.memory_map(ruta_feather)).read_all()
+
+def leer_compartido(ruta_feather, variables):
+    return mapear(ruta_feather).select(CLAVES + variables).to_pandas(split_blocks=True)
+
+# Los niveles (el nivel horario es el archivo más grande) también se leen sobre un memory map
+def leer_niveles(ruta):
+    return resoluciones.desapilar(mapear(ruta_niveles(ruta)).to_pandas(split_blocks=True))
+
+def cargar_niveles(ruta=RUTA_AIRE, incremental=True, ruta_estaciones=RUTA_ESTACIONES):
+    if es_multiple(ruta):
+        return cargar_varios(ruta, ruta_estaciones)[1:]
+    variables = variables_de(abrir_compartido(ruta, incremental, ruta_estaciones))
+    guardada = leer_metadatos_cache(ruta_cache(ruta))
+    if guardada is not None and niveles_al_dia(ruta, guardada):
+        return leer_niveles(ruta), variables
+    # Sin cache en disco (p. ej. sin permisos de escritura) los niveles se calculan en memoria
+    aire = limpiar(leer_completo(ruta, os.path.getsize(ruta))[0], cargar_estaciones(ruta_estaciones))
+    return resoluciones.acumular(aire, variables), variables
+
+# Varios CSV (p. ej. uno por sensor y por mes): `ruta` puede ser un directorio o un patrón glob
+def es_multiple(ruta):
+    return os.path.isdir(ruta) or any(caracter in ruta for caracter in "*?[")
+
+def expandir(patron, ruta_estaciones=RUTA_ESTACIONES):
+    archivos = glob.glob(os.path.join(patron, "*.csv")) if os.path.isdir(patron) else glob.glob(patron)
+    registro = os.path.abspath(ruta_estaciones)
+    return sorted(archivo for archivo in archivos if os.path.abspath(archivo) != registro)
+
+# Ruta ficticia del CSV combinado: su cache y sus niveles quedan junto a los archivos, con un nombre
+# que depende del patrón
+def ruta_combinada(patron):
+    directorio = patron if os.path.isdir(patron) else os.path.dirname(patron)
+    return os.path.join(directorio, "combinado-" + hashlib.sha256(patron.encode()).hexdigest()[:12] + ".csv")
+
+def huella_combinada(archivos, ruta_estaciones):
+    estados = {archivo: [os.stat(archivo).st_size, os.stat(archivo).st_mtime_ns] for archivo in archivos}
+    # Con los mismos nombres de claves que la huella de un solo archivo, para reutilizar niveles_al_dia
+    return {'version': VERSION_CACHE, 'estaciones': calcular_hash(ruta_estaciones), 'archivos': len(archivos),
+            'desplazamiento': sum(tamano for tamano, _ in estados.values()),
+            'sha_cola': hashlib.sha256(json.dumps(estados, sort_keys=True).encode()).hexdigest()}
+
+# Sumas, conteos y niveles de un archivo. Cada archivo tiene su propio cache incremental, así que solo
+# se vuelven a parsear los archivos nuevos o modificados. Se ejecuta en los procesos del pool.
+def ingerir_archivo(ruta, ruta_estaciones=RUTA_ESTACIONES):
+    cargar_aire(ruta, True, ruta_estaciones)
+    _, huella, guardada = revisar_cache(ruta, ruta_estaciones)
+    if cache_al_dia(huella, guardada):
+        variables = guardada['variables']
+        return leer_acumulados(ruta_cache(ruta), variables), leer_niveles(ruta), variables
+    # Sin cache escribible se calcula en memoria
+    aire = limpiar(leer_completo(ruta, os.path.getsize(ruta))[0], cargar_estaciones(ruta_estaciones))
+    variables = variables_de(aire)
+    return acumular(aire), resoluciones.acumular(aire, variables), variables
+
+# Los archivos pendientes se parsean en paralelo; los que ya tienen cache se leen directamente
+def ingerir_archivos(archivos, ruta_estaciones=RUTA_ESTACIONES, procesos=None):
+    pendientes = [archivo for archivo in archivos if not cache_al_dia(*revisar_cache(archivo, ruta_estaciones)[1:])]
+    procesos = min(procesos or os.cpu_count() or 1, len(pendientes))
+    resultados = {}
+    if procesos > 1:
+        # "spawn" porque el tablero tiene otros hilos corriendo y hacer fork con hilos no es seguro
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context("spawn")) as pool:
+            resultados = dict(zip(pendientes, pool.map(ingerir_archivo, pendientes, [ruta_estaciones] * len(pendientes))))
+    return [resultados[archivo] if archivo in resultados else ingerir_archivo(archivo, ruta_estaciones) for archivo in archivos]
+
+# Combina los archivos de `patron` sumando sus acumulados diarios y sus niveles, sin armar nunca un
+# DataFrame con todas las filas horarias. Devuelve (aire, niveles, variables) como abrir_compartido y
+# cargar_niveles; el resultado combinado también se guarda en cache.
+def cargar_varios(patron, ruta_estaciones=RUTA_ESTACIONES, procesos=None):
+    archivos = expandir(patron, ruta_estaciones)
+    if not archivos:
+        raise FileNotFoundError(f"No hay archivos CSV en {patron}")
+    combinada = ruta_combinada(patron)
+    huella = huella_combinada(archivos, ruta_estaciones)
+    guardada = leer_metadatos_cache(ruta_cache(combinada))
+    if (guardada is not None and all(guardada.get(clave) == huella[clave] for clave in ('version', 'estaciones', 'sha_cola'))
+            and niveles_al_dia(combinada, guardada)):
+        variables = guardada['variables']
+        return leer_compartido(ruta_cache(combinada), variables), leer_niveles(combinada), variables
+
+    resultados = ingerir_archivos(archivos, ruta_estaciones, procesos)
+    variables = list(dict.fromkeys(variable for _, _, variables_archivo in resultados for variable in variables_archivo))
+    columnas = [prefijo + variable for prefijo in (PREFIJO_SUMA, PREFIJO_CONTEO) for variable in variables]
+    acumulados = pd.concat([acumulados for acumulados, _, _ in resultados]).groupby(level=CLAVES, observed=True).sum()
+    acumulados = acumulados.reindex(columns=columnas, fill_value=0)
+    niveles = resoluciones.unir([niveles_archivo for _, niveles_archivo, _ in resultados], variables)
+    huella['variables'] = variables
+    aire = guardar(acumulados, variables, ruta_cache(combinada), huella, niveles, combinada)
+    if leer_metadatos_cache(ruta_cache(combinada)) == huella:
+        aire = leer_compartido(ruta_cache(combinada), variables)
+    return aire, niveles, variables
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+RUTA_ESTACIONES = "data/estaciones.csv"
+DECIMALES_CLAVE = 5
+# Distancia máxima para asignar una lectura a la estación más cercana cuando sus coordenadas no coinciden exactamente
+TOLERANCIA_METROS = 50.0
+METROS_POR_GRADO = 111_320.0
+
+def cargar_estaciones(ruta=RUTA_ESTACIONES):
+    estaciones = pd.read_csv(ruta, delimiter=";", decimal=".")
+    return estaciones.drop_duplicates('Ubicación').reset_index(drop=True)
+
+# Clave entera única por par de coordenadas redondeadas, para unir con hash en lugar de comparar floats
+def clave_coordenadas(latitud, longitud):
+    escala = 10 ** DECIMALES_CLAVE
+    latitud = np.round(np.asarray(latitud, dtype="float64") * escala)
+    longitud = np.round(np.asarray(longitud, dtype="float64") * escala)
+    validas = ~(np.isnan(latitud) | np.isnan(longitud))
+    clave = np.full(len(latitud), -1, dtype="int64")
+    clave[validas] = latitud[validas].astype("int64") * 10**9 + longitud[validas].astype("int64")
+    return clave, validas
+
+# Proyección equirectangular local: suficiente para distancias de pocos cientos de metros
+def proyectar(latitud, longitud, latitud_referencia):
+    x = np.asarray(longitud) * np.cos(np.radians(latitud_referencia)) * METROS_POR_GRADO
+    y = np.asarray(latitud) * METROS_POR_GRADO
+    return np.column_stack([x, y])
+
+def localizar(df, estaciones=None, tolerancia=TOLERANCIA_METROS):
+    if estaciones is None:
+        estaciones = cargar_estaciones()
+
+    # Se resuelve cada par de coordenadas distinto una sola vez y luego se expande a todas las filas
+    clave, validas = clave_coordenadas(df['Latitud'], df['Longitud'])
+    codigos, unicas = pd.factorize(clave)
+    primera = np.empty(len(unicas), dtype="int64")
+    primera[codigos[::-1]] = np.arange(len(codigos) - 1, -1, -1)
+
+    clave_estaciones, _ = clave_coordenadas(estaciones['Latitud'], estaciones['Longitud'])
+    estacion = pd.Index(clave_estaciones).get_indexer(unicas)
+
+    sin_estacion = (estacion < 0) & validas[primera]
+    if sin_estacion.any() and len(estaciones):
+        # scipy solo se necesita cuando hay coordenadas que no coinciden con el registro
+        from scipy.spatial import cKDTree
+
+        referencia = estaciones['Latitud'].mean()
+        arbol = cKDTree(proyectar(estaciones['Latitud'], estaciones['Longitud'], referencia))
+        filas = primera[sin_estacion]
+        distancia, cercana = arbol.query(
+            proyectar(df['Latitud'].to_numpy()[filas], df['Longitud'].to_numpy()[filas], referencia),
+            distance_upper_bound=tolerancia,
+        )
+        estacion[sin_estacion] = np.where(np.isfinite(distancia), cercana, -1)
+    estacion[~validas[primera]] = -1
+
+    estacion_fila = estacion[codigos]
+    asignada = estacion_fila >= 0
+    df['Ubicación'] = pd.Categorical.from_codes(estacion_fila, categories=estaciones['Ubicación'].tolist())
+    # Las coordenadas se reemplazan por las registradas para que el ruido del GPS no separe los grupos
+    df['Latitud'] = np.where(asignada, estaciones['Latitud'].to_numpy()[estacion_fila], df['Latitud'])
+    df['Longitud'] = np.where(asignada, estaciones['Longitud'].to_numpy()[estacion_fila], df['Longitud'])
+    return df
+
+# Agrupa filas con posición en celdas cuadradas de `metros` de lado (en la proyección local). Devuelve la
+# esquina suroeste de cada celda ocupada, cuántas filas cayeron en ella y el promedio de `columnas`.
+def agrupar_en_grilla(tabla, columnas, metros):
+    tabla = tabla.dropna(subset=['Latitud', 'Longitud'])
+    referencia = tabla['Latitud'].mean()
+    celda = np.floor(proyectar(tabla['Latitud'], tabla['Longitud'], referencia) / metros).astype("int64")
+    grupos = tabla[columnas].groupby([celda[:, 0], celda[:, 1]])
+    grilla = grupos.mean()
+    grilla['Cantidad'] = grupos.size()
+    x = grilla.index.get_level_values(0).to_numpy()
+    y = grilla.index.get_level_values(1).to_numpy()
+    grilla['Longitud'] = x * metros / (np.cos(np.radians(referencia)) * METROS_POR_GRADO)
+    grilla['Latitud'] = y * metros / METROS_POR_GRADO
+    return grilla.reset_index(drop=True)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Correlación de Pearson por pares con observaciones completas (como DataFrame.corr), para todas
+# las columnas a la vez: las sumas de cada par salen de productos matriciales sobre la máscara de
+# valores válidos, en lugar de recorrer los pares uno por uno.
+def pearson(valores):
+    validos = ~np.isnan(valores)
+    x = np.where(validos, valores, 0.0)
+    m = validos.astype('float64')
+    n = m.T @ m
+    suma = x.T @ m
+    suma_cuadrados = (x * x).T @ m
+    suma_productos = x.T @ x
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covarianza = suma_productos - suma * suma.T / n
+        varianza = suma_cuadrados - suma * suma / n
+        r = covarianza / np.sqrt(varianza * varianza.T)
+    r[n < 2] = np.nan
+    return np.clip(r, -1.0, 1.0)
+
+# Spearman como Pearson sobre rangos, con los rangos de cada par calculados solo sobre las filas que
+# ambas columnas tienen (como DataFrame.corr). Los rangos por columna sirven para todos los pares con
+# los mismos faltantes; solo los pares con faltantes distintos se vuelven a rangar.
+def spearman(valores):
+    validos = ~np.isnan(valores)
+    r = pearson(pd.DataFrame(valores).rank(method='average').to_numpy())
+    for i in range(valores.shape[1]):
+        for j in range(i + 1, valores.shape[1]):
+            if np.array_equal(validos[:, i], validos[:, j]):
+                continue
+            comunes = validos[:, i] & validos[:, j]
+            rangos = pd.DataFrame(valores[comunes][:, [i, j]]).rank(method='average').to_numpy()
+            r[i, j] = r[j, i] = pearson(rangos)[0, 1]
+    return r
+
+def correlaciones(data, columnas):
+    valores = data[columnas].to_numpy(dtype='float64', na_value=np.nan)
+    return (
+        pd.DataFrame(pearson(valores), index=columnas, columns=columnas),
+        pd.DataFrame(spearman(valores), index=columnas, columns=columnas),
+    )
+
+MAX_ATIPICOS = 200
+
+# Estadísticos de un diagrama de caja (cuartiles, bigotes de Tukey y una muestra de atípicos)
+def resumen_caja(valores, max_atipicos=MAX_ATIPICOS):
+    valores = np.asarray(valores, dtype='float64')
+    valores = valores[~np.isnan(valores)]
+    if not len(valores):
+        return None
+    q1, mediana, q3 = np.quantile(valores, [0.25, 0.5, 0.75])
+    rango = q3 - q1
+    limite_inferior, limite_superior = q1 - 1.5 * rango, q3 + 1.5 * rango
+    dentro = valores[(valores >= limite_inferior) & (valores <= limite_superior)]
+    atipicos = np.unique(valores[(valores < limite_inferior) | (valores > limite_superior)])
+    if len(atipicos) > max_atipicos:
+        # Se conservan los más alejados de la mediana
+        atipicos = atipicos[np.argsort(np.abs(atipicos - mediana))[-max_atipicos:]]
+    return {
+        'n': len(valores),
+        'q1': q1,
+        'mediana': mediana,
+        'q3': q3,
+        'bigote_inferior': dentro.min() if len(dentro) else q1,
+        'bigote_superior': dentro.max() if len(dentro) else q3,
+        'atipicos': atipicos,
+    }
+
+# Resúmenes de caja de cada (ubicación, variable) a partir de un arreglo ubicación × día × variable. Con
+# promedios diarios cada caja tiene a lo sumo unos miles de valores: los cuartiles exactos bastan.
+def resumenes_caja(valores, ubicaciones, variables):
+    return {
+        (ubicacion, variable): resumen_caja(valores[i, :, j])
+        for i, ubicacion in enumerate(ubicaciones)
+        for j, variable in enumerate(variables)
+    }
@@ -0,0 +1,226 @@
+import argparse
+import html
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import cubo
+import datos
+import estadisticas
+import figuras
+import muestreo
+import normativa
+import resoluciones
+
+# Variables de cada página del tablero, en el mismo orden en que las muestra main.py
+GRUPOS = {
+    'gases': ['CO (ug/m3)', 'H2S (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'SO2 (ug/m3)'],
+    'material_particulado': ['PM10 (ug/m3)', 'PM2,5 (ug/m3)'],
+    'variables_meteorologicas': ['Humedad (%)', 'UV', 'Presion (Pa)', 'Temperatura (C)'],
+    'niveles_presion_sonora': ['Ruido (dB)'],
+}
+PAGINAS = ['inicio', 'resumen'] + list(GRUPOS) + ['comparativa', 'dispersion', 'heatmap', 'normativa']
+COLORMAP = 'viridis'
+TODAS = 'todas'
+# Contaminantes del tooltip del mapa de Inicio y límite de sensores antes de agruparlos en grilla, como en main.py
+CONTAMINANTES_MAPA = ['PM10 (ug/m3)', 'PM2,5 (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'CO (ug/m3)']
+LIMITE_ESTACIONES_MAPA = 500
+METROS_CELDA_MAPA = 1000
+
+# Datos compartidos por los procesos. Con "fork" los hijos heredan lo que cargó el proceso principal
+# sin copiarlo; con "spawn" cada hijo abre el mismo cache feather como memory map, sin volver a parsear el CSV.
+_estado = {}
+
+def cargar_estado(ruta=datos.RUTA_AIRE, excluir_marcadas=False):
+    if not _estado:
+        aire = datos.abrir_compartido(ruta)
+        niveles, variables = datos.cargar_niveles(ruta)
+        if excluir_marcadas:
+            aire, niveles = datos.excluir_marcadas(niveles, variables, aire)
+        _estado['cubo'] = cubo.Cubo.desde_aire(aire, datos.cargar_posiciones())
+        _estado['resoluciones'] = resoluciones.Resoluciones(niveles, variables)
+        _estado['cumplimiento'] = normativa.MotorNormativa().actualizar(niveles['hora'])
+    return _estado
+
+def meses_de(datos_cubo):
+    return pd.period_range(pd.Timestamp(datos_cubo.fechas[0]), pd.Timestamp(datos_cubo.fechas[-1]), freq='M')
+
+# Cada sección es una figura de plotly o una tabla
+def escribir_html(ruta, titulo, secciones):
+    partes = [f"<h1>{html.escape(titulo)}</h1>"]
+    plotly_incluido = False
+    for subtitulo, contenido in secciones:
+        partes.append(f"<h2>{html.escape(subtitulo)}</h2>")
+        if isinstance(contenido, pd.DataFrame):
+            partes.append(contenido.to_html(index=False))
+            continue
+        partes.append(contenido.to_html(full_html=False, include_plotlyjs='cdn' if not plotly_incluido else False))
+        plotly_incluido = True
+    with open(ruta, "w", encoding="utf-8") as archivo:
+        archivo.write(f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(titulo)}</title></head><body>{''.join(partes)}</body></html>")
+    return [ruta]
+
+# Cada página se exporta con los mismos datos que usa en el tablero (cubo, niveles, resúmenes de caja)
+# El mapa es un HTML de deck.gl con las mismas capas que Inicio; el tooltip resume solo el mes
+def exportar_inicio(estado, ubicaciones, inicio, fin, ruta, titulo):
+    import pydeck as pdk
+    resumen = estado['cubo'].resumen_estaciones(CONTAMINANTES_MAPA, inicio, fin)
+    resumen = resumen.loc[resumen['Ubicación'].isin(ubicaciones)]
+    layers, tooltip = figuras.capas_mapa(resumen, CONTAMINANTES_MAPA, LIMITE_ESTACIONES_MAPA, METROS_CELDA_MAPA)
+    vista = pdk.ViewState(latitude=float(resumen['Latitud'].mean()), longitude=float(resumen['Longitud'].mean()), zoom=12, pitch=30)
+    deck = pdk.Deck(layers=layers, initial_view_state=vista, tooltip={"html": tooltip}, map_style="light", description=html.escape(titulo))
+    deck.to_html(ruta + ".html", open_browser=False, notebook_display=False)
+    return [ruta + ".html"]
+
+def exportar_resumen(estado, ubicaciones, inicio, fin, ruta, titulo):
+    import plotly.express as px
+    variables = [variable for grupo in GRUPOS.values() for variable in grupo]
+    data = estado['cubo'].promedio_estaciones(inicio, fin, variables, ubicaciones)
+    secciones = [(variable, px.bar(muestreo.reducir(data, 'Fecha', variable), x='Fecha', y=variable)) for variable in variables]
+    return escribir_html(ruta + ".html", titulo, secciones)
+
+def exportar_series(estado, variables, ubicaciones, inicio, fin, ruta, titulo):
+    import plotly.express as px
+    nivel = resoluciones.elegir_nivel(inicio, fin)
+    if nivel == 'dia':
+        data = estado['cubo'].seleccionar(ubicaciones, inicio, fin, variables)
+    else:
+        data = estado['resoluciones'].seleccionar(nivel, ubicaciones, inicio, fin, variables)
+    secciones = [
+        (variable, px.line(muestreo.reducir(data, 'Fecha', variable, "Ubicación"), x='Fecha', y=variable, color="Ubicación"))
+        for variable in variables
+    ]
+    return escribir_html(ruta + ".html", f"{titulo} (resolución: {nivel})", secciones)
+
+def exportar_comparativa(estado, ubicaciones, inicio, fin, ruta, titulo):
+    datos_cubo = estado['cubo']
+    estaciones = datos_cubo.indices_ubicaciones(ubicaciones)
+    dias = datos_cubo.rango_dias(inicio, fin)
+    nombres = [datos_cubo.ubicaciones[i] for i in estaciones]
+    cajas = estadisticas.resumenes_caja(datos_cubo.valores[estaciones, dias], nombres, datos_cubo.variables)
+    secciones = []
+    for variable in sorted(datos_cubo.variables):
+        resumenes = [(ubicacion, cajas[(ubicacion, variable)]) for ubicacion in nombres if cajas[(ubicacion, variable)] is not None]
+        if resumenes:
+            secciones.append((variable, figuras.figura_cajas(resumenes, variable)))
+    return escribir_html(ruta + ".html", titulo, secciones)
+
+def exportar_dispersion(estado, ubicaciones, inicio, fin, ruta, titulo):
+    import plotly.express as px
+    datos_cubo = estado['cubo']
+    data = datos_cubo.seleccionar(ubicaciones, inicio, fin, datos_cubo.variables)
+    columnas = sorted(datos_cubo.variables)
+    pearson, spearman = estadisticas.correlaciones(data, columnas)
+    secciones = [
+        ("Correlación de Pearson", px.imshow(pearson, zmin=-1, zmax=1, color_continuous_scale='RdBu_r')),
+        ("Correlación de Spearman", px.imshow(spearman, zmin=-1, zmax=1, color_continuous_scale='RdBu_r')),
+    ]
+    return escribir_html(ruta + ".html", titulo, secciones)
+
+def exportar_heatmap(estado, ubicaciones, inicio, fin, ruta, titulo):
+    estadisticas_diarias = estado['cubo'].estadisticas_diarias(ubicaciones, inicio, fin)
+    escritos = []
+    for variable in estado['cubo'].variables:
+        datos_calor = estadisticas_diarias[(variable, 'mean')].dropna() if len(estadisticas_diarias) else []
+        if len(datos_calor) == 0:
+            continue
+        nombre = f"{ruta}_{variable.split(' ')[0].replace(',', '.')}.png"
+        with open(nombre, "wb") as archivo:
+            archivo.write(figuras.heatmap_calendario(datos_calor, COLORMAP))
+        escritos.append(nombre)
+    return escritos
+
+# Cumplimiento del año calendario del mes, contado hasta el fin del mes, y la serie diaria del mes frente al límite
+def exportar_normativa(estado, ubicaciones, inicio, fin, ruta, titulo):
+    import plotly.express as px
+    cumplimiento = estado['cumplimiento']
+    ubicaciones = [ubicacion for ubicacion in cumplimiento.ubicaciones if ubicacion in ubicaciones]
+    if not cumplimiento.variables or not ubicaciones:
+        return []
+    anio = pd.Timestamp(inicio).year
+    secciones = [
+        (f"Días con excedencia en {anio} hasta el {pd.Timestamp(fin).date()}", cumplimiento.excedencias(anio, ubicaciones, fin)),
+        (f"Categoría diaria del índice de calidad del aire en {anio}", px.bar(cumplimiento.resumen_aqi(anio, ubicaciones, fin))),
+    ]
+    dias = (cumplimiento.dias >= np.datetime64(inicio, 'D')) & (cumplimiento.dias <= np.datetime64(fin, 'D'))
+    estaciones = [cumplimiento.ubicaciones.index(ubicacion) for ubicacion in ubicaciones]
+    metrica = cumplimiento.metrica()[estaciones][:, dias]
+    for j, variable in enumerate(cumplimiento.variables):
+        serie = pd.DataFrame({
+            'Fecha': np.tile(cumplimiento.dias[dias].astype('datetime64[ns]'), len(estaciones)),
+            'Ubicación': np.repeat(ubicaciones, dias.sum()),
+            variable: metrica[:, :, j].ravel(),
+        }).dropna()
+        if len(serie):
+            fig = px.line(serie, x='Fecha', y=variable, color='Ubicación')
+            fig.add_hline(y=normativa.LIMITES[variable]['limite'], line_dash='dash')
+            secciones.append((f"{variable} frente al límite ({normativa.LIMITES[variable]['norma']})", fig))
+    return escribir_html(ruta + ".html", titulo, secciones)
+
+# Una tarea es una (página, conjunto de estaciones, mes); devuelve los archivos escritos
+def exportar(tarea):
+    pagina, conjunto, ubicaciones, mes, salida = tarea
+    estado = cargar_estado()
+    inicio = np.datetime64(mes.start_time, 'ns')
+    fin = np.datetime64(mes.end_time.floor('D'), 'ns')
+    directorio = os.path.join(salida, str(mes), conjunto)
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, pagina)
+    titulo = f"{pagina.replace('_', ' ').capitalize()} — {conjunto} — {mes}"
+    if pagina in GRUPOS:
+        return exportar_series(estado, GRUPOS[pagina], list(ubicaciones), inicio, fin, ruta, titulo)
+    funcion = {
+        'inicio': exportar_inicio, 'resumen': exportar_resumen, 'comparativa': exportar_comparativa,
+        'dispersion': exportar_dispersion, 'heatmap': exportar_heatmap, 'normativa': exportar_normativa,
+    }[pagina]
+    return funcion(estado, list(ubicaciones), inicio, fin, ruta, titulo)
+
+def escribir_indice(salida, archivos):
+    enlaces = "".join(
+        f"<li><a href='{html.escape(os.path.relpath(archivo, salida))}'>{html.escape(os.path.relpath(archivo, salida))}</a></li>"
+        for archivo in sorted(archivos)
+    )
+    with open(os.path.join(salida, "index.html"), "w", encoding="utf-8") as archivo:
+        archivo.write(f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>QAIRA</title></head><body><ul>{enlaces}</ul></body></html>")
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta las páginas del tablero a HTML/PNG estáticos, por mes y conjunto de estaciones")
+    parser.add_argument("--ruta", default=datos.RUTA_AIRE, help="CSV de mediciones, directorio o patrón glob")
+    parser.add_argument("--salida", default="exportes", help="Directorio de salida")
+    parser.add_argument("--paginas", nargs="+", choices=PAGINAS, default=PAGINAS)
+    parser.add_argument("--meses", nargs="+", help="Meses a exportar (AAAA-MM); por defecto todos los que tienen datos")
+    parser.add_argument("--por-estacion", action="store_true", help="Además de todas las estaciones juntas, exportar cada una por separado")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count(), help="Procesos en paralelo")
+    parser.add_argument("--excluir-marcadas", action="store_true", help="Excluir las horas marcadas por el control de calidad")
+    argumentos = parser.parse_args()
+
+    # Se carga una sola vez antes de crear el pool (y se construye el cache feather si hacía falta)
+    estado = cargar_estado(argumentos.ruta, argumentos.excluir_marcadas)
+    datos_cubo = estado['cubo']
+    meses = [pd.Period(mes, freq='M') for mes in argumentos.meses] if argumentos.meses else list(meses_de(datos_cubo))
+    conjuntos = [(TODAS, tuple(datos_cubo.ubicaciones))]
+    if argumentos.por_estacion:
+        conjuntos += [(ubicacion.replace(os.sep, '_'), (ubicacion,)) for ubicacion in datos_cubo.ubicaciones]
+    tareas = [(pagina, nombre, ubicaciones, mes, argumentos.salida) for mes in meses for nombre, ubicaciones in conjuntos for pagina in argumentos.paginas]
+
+    inicio = time.perf_counter()
+    archivos = []
+    metodos = multiprocessing.get_all_start_methods()
+    contexto = multiprocessing.get_context('fork' if 'fork' in metodos else None)
+    with ProcessPoolExecutor(max_workers=argumentos.procesos, mp_context=contexto, initializer=cargar_estado, initargs=(argumentos.ruta, argumentos.excluir_marcadas)) as pool:
+        futuros = {pool.submit(exportar, tarea): tarea for tarea in tareas}
+        for futuro in as_completed(futuros):
+            pagina, conjunto, _, mes, _ = futuros[futuro]
+            try:
+                archivos += futuro.result()
+            except Exception as error:
+                print(f"Error exportando {pagina} / {conjunto} / {mes}: {error}")
+    escribir_indice(argumentos.salida, archivos)
+    print(f"{len(archivos)} archivos de {len(tareas)} tareas en {time.perf_counter() - inicio:.1f} s con {argumentos.procesos} procesos")
+
+if __name__ == "__main__":
+    main()
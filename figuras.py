@@ -0,0 +1,146 @@
+import io
+import threading
+from collections import OrderedDict
+
+import estaciones
+
+# Tamaño máximo (en bytes de imagen) del cache de figuras renderizadas
+LIMITE_BYTES = 64 * 1024 * 1024
+
+# Cache LRU de figuras ya renderizadas (PNG) limitado por tamaño total. Es compartido por todas
+# las sesiones, así que el acceso va protegido por un candado.
+class CacheFiguras:
+    def __init__(self, limite_bytes=LIMITE_BYTES):
+        self.limite_bytes = limite_bytes
+        self.entradas = OrderedDict()
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.candado = threading.Lock()
+
+    def obtener(self, clave):
+        with self.candado:
+            entrada = self.entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada
+
+    def guardar(self, clave, imagen, **datos):
+        entrada = dict(datos, imagen=imagen)
+        with self.candado:
+            if clave in self.entradas:
+                self.bytes -= len(self.entradas.pop(clave)['imagen'])
+            self.entradas[clave] = entrada
+            self.bytes += len(imagen)
+            # Se descartan las menos usadas recientemente hasta volver a estar bajo el límite
+            while self.bytes > self.limite_bytes and len(self.entradas) > 1:
+                _, descartada = self.entradas.popitem(last=False)
+                self.bytes -= len(descartada['imagen'])
+        return entrada
+
+    def estadisticas(self):
+        with self.candado:
+            return {'entradas': len(self.entradas), 'bytes': self.bytes, 'aciertos': self.aciertos, 'fallos': self.fallos}
+
+# Convierte una figura de matplotlib a bytes y la cierra, para no acumular figuras en un servidor de larga duración
+def rasterizar(fig, formato="png", dpi=100):
+    import matplotlib.pyplot as plt
+    try:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=formato, dpi=dpi, bbox_inches="tight")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+# Boxplot de plotly armado con los estadísticos de estadisticas.resumen_caja, sin enviar todas las observaciones.
+# `resumenes` es una lista de (ubicación, resumen); la usan la página Comparativa y la exportación.
+def figura_cajas(resumenes, variable):
+    import plotly.express as px
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    colores = px.colors.qualitative.Plotly
+    for i, (ubicacion, resumen) in enumerate(resumenes):
+        color = colores[i % len(colores)]
+        fig.add_trace(go.Box(
+            name=ubicacion, x=[ubicacion], legendgroup=ubicacion, marker_color=color,
+            q1=[resumen['q1']], median=[resumen['mediana']], q3=[resumen['q3']],
+            lowerfence=[resumen['bigote_inferior']], upperfence=[resumen['bigote_superior']],
+        ))
+        if len(resumen['atipicos']):
+            fig.add_trace(go.Scatter(
+                x=[ubicacion] * len(resumen['atipicos']), y=resumen['atipicos'], mode='markers',
+                legendgroup=ubicacion, showlegend=False, marker_color=color, name=ubicacion,
+            ))
+    fig.update_layout(xaxis_title='Ubicación', yaxis_title=variable)
+    return fig
+
+# Capas de deck.gl y plantilla del tooltip del mapa de sensores, a partir de Cubo.resumen_estaciones: un
+# punto por sensor o, con más de `limite` sensores, una grilla agregada en el servidor que envía una celda
+# por zona. La usan la página Inicio y la exportación.
+def capas_mapa(resumen, contaminantes, limite, metros_celda):
+    import pydeck as pdk
+
+    # Nombres simples para las plantillas del tooltip de deck.gl
+    capa = resumen[['Ubicación', 'Latitud', 'Longitud', 'Última fecha']].rename(columns={'Ubicación': 'ubicacion', 'Última fecha': 'fecha'})
+    tooltip = "<b>{ubicacion}</b><br/>Último día con datos: {fecha}"
+    for i, variable in enumerate(contaminantes):
+        capa[f'media{i}'] = resumen['Media ' + variable].round(1)
+        capa[f'ultimo{i}'] = resumen['Último ' + variable].round(1)
+        tooltip += f"<br/>{variable}: media {{media{i}}}, último {{ultimo{i}}}"
+
+    if len(capa) <= limite:
+        layers = [
+            pdk.Layer(
+                "ScatterplotLayer",
+                data=capa,
+                get_position=["Longitud", "Latitud"],
+                auto_highlight=True,
+                get_radius=50,
+                get_fill_color=[0, 128, 0, 140],
+                pickable=True,
+            ),
+            pdk.Layer(
+                "TextLayer",
+                data=capa,
+                get_position=["Longitud", "Latitud"],
+                get_text="ubicacion",
+                get_color=[0, 0, 0, 10],
+                get_size=15,
+                get_alignment_baseline="'bottom'",
+            ),
+        ]
+        return layers, tooltip
+
+    capa = estaciones.agrupar_en_grilla(capa, [f'media{i}' for i in range(len(contaminantes))], metros_celda)
+    tooltip = "<b>{Cantidad} sensores</b>" + "".join(f"<br/>{variable}: media {{media{i}}}" for i, variable in enumerate(contaminantes))
+    capa = capa.round({f'media{i}': 1 for i in range(len(contaminantes))})
+    layers = [
+        pdk.Layer(
+            "GridCellLayer",
+            data=capa,
+            get_position=["Longitud", "Latitud"],
+            cell_size=metros_celda,
+            extruded=True,
+            get_elevation="Cantidad",
+            elevation_scale=20,
+            get_fill_color=[0, 128, 0, 140],
+            pickable=True,
+        ),
+    ]
+    return layers, tooltip
+
+# Mapa de calor de calendario (calplot) de una serie diaria ya agregada, como PNG
+def heatmap_calendario(datos_calor, colormap):
+    import calplot
+    fig, ax = calplot.calplot(data=datos_calor, how=None, cmap=colormap, figsize=(15, 4), suptitle=None)
+    return rasterizar(fig)
+
+# Superficie interpolada (fila 0 al sur) como PNG, transparente donde no tiene valor, para un BitmapLayer
+def imagen_superficie(superficie, minimo, maximo, colormap):
+    import matplotlib.image
+    buffer = io.BytesIO()
+    matplotlib.image.imsave(buffer, superficie, vmin=minimo, vmax=maximo, cmap=colormap, origin='lower', format='png')
+    return buffer.getvalue()
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Datos ordenados por (Ubicación, Fecha) con una tabla de desplazamientos por estación:
+# cada estación ocupa un bloque contiguo y el rango de fechas dentro del bloque se resuelve
+# con búsqueda binaria, sin recorrer la tabla completa con máscaras booleanas.
+class AireIndexado:
+    def __init__(self, aire):
+        if aire['Ubicación'].isna().any():
+            aire = aire.dropna(subset=['Ubicación'])
+        ubicacion = aire['Ubicación'].astype('category').cat.remove_unused_categories()
+        codigos = ubicacion.cat.codes.to_numpy()
+        fechas = aire['Fecha'].to_numpy()
+        orden = np.lexsort((fechas, codigos))
+
+        # El cache ya se guarda en este orden: entonces se usa tal cual, sin copiar la vista compartida
+        ordenado = (orden == np.arange(len(orden))).all()
+        self.aire = (aire if ordenado else aire.iloc[orden]).reset_index(drop=True)
+        self.fechas = self.aire['Fecha'].to_numpy()
+        self.fechas.flags.writeable = False
+        codigos = codigos[orden]
+        posiciones = np.arange(len(ubicacion.cat.categories))
+        inicios = np.searchsorted(codigos, posiciones, side='left')
+        finales = np.searchsorted(codigos, posiciones, side='right')
+        self.bloques = {ubicacion: (int(a), int(b)) for ubicacion, a, b in zip(ubicacion.cat.categories, inicios, finales)}
+        self.ubicaciones = sorted(self.bloques)
+
+    def rango(self, ubicacion, inicio=None, fin=None):
+        a, b = self.bloques.get(ubicacion, (0, 0))
+        fechas = self.fechas[a:b]
+        if inicio is not None:
+            a += int(np.searchsorted(fechas, np.datetime64(inicio).astype(fechas.dtype), side='left'))
+        if fin is not None:
+            b = a + int(np.searchsorted(self.fechas[a:b], np.datetime64(fin).astype(fechas.dtype), side='right'))
+        return a, b
+
+    # Filas de los bloques de estas ubicaciones, las que recorre un filtro sobre ellas
+    def filas_de(self, ubicaciones):
+        return sum(b - a for a, b in (self.bloques.get(ubicacion, (0, 0)) for ubicacion in ubicaciones))
+
+    # Filas de las ubicaciones y fechas (inclusive) seleccionadas. Con una sola estación el
+    # resultado es una vista del bloque; con varias se copian solo las filas seleccionadas.
+    def filtrar(self, ubicaciones, inicio=None, fin=None):
+        rangos = [self.rango(ubicacion, inicio, fin) for ubicacion in ubicaciones]
+        rangos = [(a, b) for a, b in rangos if b > a]
+        if not rangos:
+            return self.aire.iloc[0:0]
+        if len(rangos) == 1:
+            return self.aire.iloc[rangos[0][0]:rangos[0][1]]
+        filas = np.concatenate([np.arange(a, b) for a, b in rangos])
+        return self.aire.take(filas)
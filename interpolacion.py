@@ -0,0 +1,69 @@
+import numpy as np
+
+import estaciones
+
+# Lado de cada celda de la malla y margen alrededor de las estaciones, en metros
+METROS_CELDA = 100
+MARGEN_METROS = 1500
+# Celdas por lado como máximo: con una flota muy extendida las celdas se agrandan
+CELDAS_MAXIMAS = 200
+# Exponente de la distancia en los pesos IDW. Cada celda usa solo sus VECINAS estaciones más cercanas a
+# menos de RADIO_METROS: una celda sin ninguna queda sin valor en lugar de extrapolarse.
+POTENCIA = 2
+VECINAS = 12
+RADIO_METROS = 3000
+
+# Malla regular sobre las estaciones con la matriz dispersa de pesos IDW celda × estación ya calculada. La
+# superficie de un día es un producto matriz-vector con los valores de las estaciones; las que no tienen
+# dato ese día (o no están seleccionadas) se descuentan dividiendo por la suma de los pesos de las demás.
+class MallaIDW:
+    def __init__(self, latitudes, longitudes, metros=METROS_CELDA, margen=MARGEN_METROS, radio=RADIO_METROS, vecinas=VECINAS, potencia=POTENCIA):
+        from scipy import sparse
+        from scipy.spatial import cKDTree
+
+        latitudes = np.asarray(latitudes, dtype='float64')
+        longitudes = np.asarray(longitudes, dtype='float64')
+        con_posicion = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+        self.referencia = latitudes[con_posicion].mean() if len(con_posicion) else 0.0
+        puntos = estaciones.proyectar(latitudes[con_posicion], longitudes[con_posicion], self.referencia)
+
+        centro = puntos.mean(axis=0) if len(puntos) else np.zeros(2)
+        minimo = (puntos.min(axis=0) if len(puntos) else centro) - margen
+        maximo = (puntos.max(axis=0) if len(puntos) else centro) + margen
+        metros = max(metros, (maximo - minimo).max() / CELDAS_MAXIMAS)
+        columnas, filas = np.ceil((maximo - minimo) / metros).astype('int64')
+        maximo = minimo + np.array([columnas, filas]) * metros
+        self.forma = (int(filas), int(columnas))
+
+        # Centros de las celdas, fila por fila desde el sur
+        x = minimo[0] + (np.arange(columnas) + 0.5) * metros
+        y = minimo[1] + (np.arange(filas) + 0.5) * metros
+        centros = np.column_stack([np.tile(x, filas), np.repeat(y, columnas)])
+        if len(puntos):
+            distancia, cercana = cKDTree(puntos).query(centros, k=max(vecinas, 2), distance_upper_bound=radio)
+        else:
+            distancia, cercana = np.full((len(centros), 2), np.inf), np.zeros((len(centros), 2), dtype='int64')
+        celda, orden = np.nonzero(np.isfinite(distancia))
+        # Una celda que contiene una estación no debe tener peso infinito
+        pesos = 1.0 / np.maximum(distancia[celda, orden], metros / 2) ** potencia
+        self.pesos = sparse.csr_matrix(
+            (pesos, (celda, con_posicion[cercana[celda, orden]])), shape=(len(centros), len(latitudes)),
+        )
+
+        # Esquinas [oeste, sur, este, norte] en grados, como las espera el BitmapLayer de deck.gl
+        metros_por_grado_x = np.cos(np.radians(self.referencia)) * estaciones.METROS_POR_GRADO
+        self.limites = [
+            float(minimo[0] / metros_por_grado_x), float(minimo[1] / estaciones.METROS_POR_GRADO),
+            float(maximo[0] / metros_por_grado_x), float(maximo[1] / estaciones.METROS_POR_GRADO),
+        ]
+
+    # `valores` tiene una fila por estación, en el orden de las posiciones de la malla, y opcionalmente una
+    # columna por día. Devuelve (filas, columnas[, días]) con NaN donde no hay estaciones con dato cerca.
+    def superficie(self, valores):
+        valores = np.asarray(valores, dtype='float64')
+        validos = ~np.isnan(valores)
+        numerador = self.pesos @ np.where(validos, valores, 0.0)
+        total = self.pesos @ validos.astype('float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            resultado = np.where(total > 0, numerador / total, np.nan)
+        return resultado.reshape(self.forma + valores.shape[1:])
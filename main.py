@@ -1,13 +1,29 @@
 import streamlit as st
 import pandas as pd
-import pydeck as pdk
 import numpy as np
+import base64
+import os
 import traceback
 
-import calplot # <-- Add this
-import matplotlib.pyplot as plt # <-- Add this
 import io # Already present in Colab code, good practice to ensure it's there
-import plotly.express as px # <-- Add this for the boxplot page
+# pydeck, calplot, matplotlib y plotly se importan dentro de la página (o de figuras) que los usa:
+# así la primera carga de "Inicio" no paga el costo de las librerías de las demás páginas
+
+import cubo
+import datos
+import estadisticas
+import figuras
+import filtros
+import interpolacion
+import muestreo
+import normativa
+import rendimiento
+import resoluciones
+import vigilancia
+
+# El panel de Rendimiento muestra las etapas de esta ejecución del script, incluidas la carga del vigilante
+# y de la instantánea sin marcadas, así que las mediciones se reinician antes de cualquier otra cosa
+rendimiento.reiniciar()
 
 descripciones = { 
     "Ruido (dB)": "El ruido 2 se mide en decibelios (dB), los niveles de ruido que no son perjudiciales para la audición son generalmente inferiores a los 85 dB, aunque esto depende del tiempo de exposición y si se utilizan o no protecciones auditivas.",
@@ -28,47 +44,220 @@ descripciones = {
     "Niveles de Presión Sonora": "Niveles de Presión Sonora medidos en decibelios (dB)",
 }
 
-def localizar(df):
-    ubicaciones = [
-        {'Latitud': -12.10972, 'Longitud': -77.05194, 'Ubicación': 'San Isidro 1'},
-        {'Latitud': -12.07274, 'Longitud': -77.08269, 'Ubicación': 'San Miguel 1'},
-        {'Latitud': -12.11000, 'Longitud': -77.05000, 'Ubicación': 'Miraflores 1'},
-        {'Latitud': -12.07000, 'Longitud': -77.08000, 'Ubicación': 'San Miguel 2'},
-        {'Latitud': -12.04028, 'Longitud': -77.04361, 'Ubicación': 'Cercado 1'},
-        {'Latitud': -12.11913, 'Longitud': -77.02885, 'Ubicación': 'Miraflores 2'},
-    ]
-
-    df['Ubicación'] = np.nan
-    df['Ubicación'] = df['Ubicación'].astype(str)
-    for ubicacion in ubicaciones:
-        df.loc[(df['Latitud'] == ubicacion['Latitud']) & (df['Longitud'] == ubicacion['Longitud']), 'Ubicación'] = ubicacion['Ubicación']
-    return df
+# Contaminantes que se resumen en el tooltip del mapa de Inicio
+CONTAMINANTES_MAPA = ['PM10 (ug/m3)', 'PM2,5 (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'CO (ug/m3)']
+# Con más sensores que esto el mapa muestra una grilla agregada en lugar de un punto por sensor
+LIMITE_ESTACIONES_MAPA = 500
+METROS_CELDA_MAPA = 1000
+# Contaminantes que se pueden ver como superficie interpolada sobre el distrito, y su escala de colores
+CONTAMINANTES_SUPERFICIE = ['PM2,5 (ug/m3)', 'NO2 (ug/m3)']
+COLORMAP_SUPERFICIE = 'viridis'
+
+# Un solo vigilante por proceso: ingiere en segundo plano lo que llega a data/aire.csv y publica
+# instantáneas de solo lectura (vía memory map, compartidas por todas las sesiones y procesos del servidor).
+# QAIRA_DATOS puede apuntar a otro CSV, a un directorio o a un patrón glob (p. ej. un CSV por sensor y mes);
+# con un directorio o un patrón también se ingieren los CSV nuevos que aparezcan.
+@st.cache_resource
+def cargar_vigilante():
+    # Los motores se resuelven aquí: las caches de Streamlit no se deben llamar desde el hilo del vigilante
+    motores = cargar_motores_normativa()
+    return vigilancia.Vigilante(
+        os.environ.get("QAIRA_DATOS", datos.RUTA_AIRE),
+        preparar=lambda instantanea, anterior: preparar_instantanea(instantanea, anterior, motores),
+    )
+
+# Las estructuras derivadas (cubo, índice, niveles, cajas, cumplimiento) se guardan en cada instantánea y
+# se liberan junto con ella cuando ya ninguna sesión la usa. En la primera versión se arman al pedirlas;
+# en las siguientes el vigilante arma en su hilo, antes de publicarla, las que ya estaban armadas en la
+# anterior (y la variante sin las lecturas marcadas solo si alguien la usó): una ingesta nueva no hace
+# esperar a la primera sesión que se vuelve a ejecutar.
+def preparar_instantanea(instantanea, anterior, motores):
+    cargadores = {
+        "indice": cargar_indice,
+        "resoluciones": cargar_resoluciones,
+        "cubo": cargar_cubo,
+        "resumen_estaciones": cargar_resumen_estaciones,
+        "cajas": cargar_cajas,
+        "cumplimiento": lambda cada: cargar_cumplimiento(cada, motores),
+    }
+    pares = [(instantanea, anterior)]
+    if "sin_marcadas" in anterior.armadas():
+        pares.append((cargar_sin_marcadas(instantanea), anterior.sin_marcadas()))
+    for cada, previa in pares:
+        armadas = previa.armadas()
+        for nombre, cargar in cargadores.items():
+            if nombre in armadas:
+                cargar(cada)
+
+# Filas de entrada de las etapas medidas, a partir de los mismos argumentos que la función
+def filas_diarias(instantanea, *argumentos, **opciones):
+    return len(instantanea.aire)
+
+def filas_horarias(instantanea, *argumentos, **opciones):
+    return len(instantanea.niveles['hora'])
+
+def filas_seleccionadas(instantanea, ubicaciones, *argumentos, **opciones):
+    return cargar_indice(instantanea).filas_de(ubicaciones)
+
+def filas_nivel(instantanea, nivel, *argumentos, **opciones):
+    return len(instantanea.aire) if nivel == 'dia' else len(instantanea.niveles[nivel])
+
+# Los datos se cachean por versión: se conservan las dos últimas versiones (cada una con y sin las
+# lecturas marcadas) para las sesiones que aún usan la anterior
+POR_VERSION = {vigilancia.Instantanea: lambda instantanea: (instantanea.version, instantanea.excluye_marcadas)}
+
+# Los promedios y niveles sin las horas marcadas se arman una vez por versión, no en cada ejecución
+@rendimiento.medido("cargar_sin_marcadas", entrada=filas_horarias)
+def cargar_sin_marcadas(instantanea):
+    return instantanea.sin_marcadas()
+
+@st.cache_data(hash_funcs=POR_VERSION, max_entries=2)
+def calcular_resumen_calidad(instantanea):
+    return pd.DataFrame(resoluciones.resumen_calidad(instantanea.niveles, instantanea.variables)).T
+
+@rendimiento.medido("cargar_cubo", entrada=filas_diarias)
+def cargar_cubo(instantanea):
+    return instantanea.derivada("cubo", lambda cada: cubo.Cubo.desde_aire(cada.aire, datos.cargar_posiciones()))
+
+@rendimiento.medido("cargar_indice", entrada=filas_diarias)
+def cargar_indice(instantanea):
+    return instantanea.derivada("indice", lambda cada: filtros.AireIndexado(cada.aire))
+
+# Una fila por sensor con su posición y los valores que muestra el tooltip del mapa
+@rendimiento.medido("cargar_resumen_estaciones", entrada=filas_diarias)
+def cargar_resumen_estaciones(instantanea):
+    return instantanea.derivada("resumen_estaciones", lambda cada: cargar_cubo(cada).resumen_estaciones(CONTAMINANTES_MAPA))
+
+@rendimiento.medido("cargar_resoluciones", entrada=filas_horarias)
+def cargar_resoluciones(instantanea):
+    return instantanea.derivada("resoluciones", lambda cada: resoluciones.Resoluciones(cada.niveles, cada.variables))
+
+# Series por ubicación en una resolución (hora/día/semana/mes), ya reducidas con LTTB para cada gráfico.
+# Se memorizan por filtro y resolución: volver a una combinación ya vista no recorta ni reduce de nuevo.
+@rendimiento.medido("calcular_series", entrada=filas_nivel)
+@st.cache_data(hash_funcs=POR_VERSION, max_entries=32)
+def calcular_series(instantanea, nivel, ubicaciones, inicio, fin, variables, puntos=muestreo.PUNTOS_POR_GRAFICO):
+    if nivel == 'dia':
+        data = cargar_cubo(instantanea).seleccionar(list(ubicaciones), inicio, fin, list(variables))
+    else:
+        data = cargar_resoluciones(instantanea).seleccionar(nivel, list(ubicaciones), inicio, fin, list(variables))
+    return {variable: muestreo.reducir(data, 'Fecha', variable, "Ubicación", puntos) for variable in variables}
+
+# Las páginas de series arman los filtros (barra lateral) y delegan en este fragmento el selector de
+# resolución y los gráficos: cambiar la resolución solo vuelve a ejecutar el fragmento, no la página
+@st.fragment
+def mostrar_series(instantanea, ubicaciones, inicio, fin, variables):
+    resolucion = st.selectbox("Resolución", ["automática"] + resoluciones.NIVELES, key="series_resolucion")
+    nivel = resoluciones.elegir_nivel(inicio, fin) if resolucion == "automática" else resolucion
+    st.caption(f"Resolución: {nivel}")
+    agregar_grafico(variables, calcular_series(instantanea, nivel, tuple(ubicaciones), inicio, fin, tuple(variables)))
+
+# Malla y pesos IDW del mapa de Inicio. Solo dependen de las posiciones de las estaciones, así que se
+# reutilizan entre versiones de los datos mientras el registro no cambie.
+@rendimiento.medido("cargar_malla", entrada=lambda latitudes, longitudes: len(latitudes))
+@st.cache_resource(max_entries=4)
+def cargar_malla(latitudes, longitudes):
+    return interpolacion.MallaIDW(latitudes, longitudes)
+
+# Escala fija por variable (percentiles de los promedios diarios de todas las estaciones) para que los días
+# se puedan comparar al recorrerlos
+@st.cache_data(hash_funcs=POR_VERSION, max_entries=16)
+def calcular_escala_superficie(instantanea, variable):
+    datos_cubo = cargar_cubo(instantanea)
+    valores = datos_cubo.valores[:, :, datos_cubo.posicion_variable[variable]]
+    if np.isnan(valores).all():
+        return 0.0, 1.0
+    minimo, maximo = np.nanpercentile(valores, [2, 98])
+    return float(minimo), float(max(maximo, minimo + 1e-9))
+
+# Superficie de un día como PNG embebido y sus esquinas, o None si ninguna estación seleccionada tiene dato.
+# Se memoriza por (variable, día): recorrer los días solo interpola y codifica los que aún no se vieron.
+@rendimiento.medido("calcular_superficie", entrada=lambda instantanea, variable, dia, ubicaciones: len(ubicaciones))
+@st.cache_data(hash_funcs=POR_VERSION, max_entries=2048)
+def calcular_superficie(instantanea, variable, dia, ubicaciones):
+    datos_cubo = cargar_cubo(instantanea)
+    malla = cargar_malla(tuple(datos_cubo.latitudes), tuple(datos_cubo.longitudes))
+    dias = datos_cubo.rango_dias(dia, dia)
+    valores = np.full(len(datos_cubo.ubicaciones), np.nan)
+    estaciones_elegidas = datos_cubo.indices_ubicaciones(ubicaciones)
+    if dias.stop > dias.start:
+        valores[estaciones_elegidas] = datos_cubo.valores[estaciones_elegidas, dias.start, datos_cubo.posicion_variable[variable]]
+    superficie = malla.superficie(valores)
+    if np.isnan(superficie).all():
+        return None
+    minimo, maximo = calcular_escala_superficie(instantanea, variable)
+    imagen = figuras.imagen_superficie(superficie, minimo, maximo, COLORMAP_SUPERFICIE)
+    return "data:image/png;base64," + base64.b64encode(imagen).decode(), malla.limites
+
+# Cuartiles, bigotes y atípicos de cada (ubicación, variable), calculados una vez al cargar los datos
+@rendimiento.medido("cargar_cajas", entrada=filas_diarias)
+def cargar_cajas(instantanea):
+    def armar(cada):
+        datos_cubo = cargar_cubo(cada)
+        return estadisticas.resumenes_caja(datos_cubo.valores, datos_cubo.ubicaciones, datos_cubo.variables)
+    return instantanea.derivada("cajas", armar)
+
+# Los cinco estadísticos diarios de todas las variables para un filtro; el método de agregación solo elige una columna
+@rendimiento.medido("calcular_estadisticas_diarias", entrada=filas_seleccionadas)
+@st.cache_data(hash_funcs=POR_VERSION)
+def calcular_estadisticas_diarias(instantanea, ubicaciones, inicio, fin):
+    return cargar_cubo(instantanea).estadisticas_diarias(list(ubicaciones), inicio, fin)
+
+# Un motor por proceso y por modo de control de calidad (con o sin las lecturas marcadas) que conserva
+# lo ya calculado: cada versión nueva de los datos solo recalcula los días con horas nuevas. El resultado
+# de cada versión no cambia aunque el motor siga avanzando.
+@st.cache_resource
+def cargar_motores_normativa():
+    return {excluye_marcadas: normativa.MotorNormativa() for excluye_marcadas in (False, True)}
+
+@rendimiento.medido("cargar_cumplimiento", entrada=filas_horarias)
+def cargar_cumplimiento(instantanea, motores=None):
+    def armar(cada):
+        return (motores or cargar_motores_normativa())[cada.excluye_marcadas].actualizar(cada.niveles['hora'])
+    return instantanea.derivada("cumplimiento", armar)
 
 @st.cache_data
-def cargar_datos():
-    aire = pd.read_csv("data/aire.csv", delimiter=";", decimal=".")
-    aire['Fecha'] = pd.to_datetime(aire['Fecha'], dayfirst=True)
-    aire['H2S (ug/m3)'] = pd.to_numeric(aire['H2S (ug/m3)'], errors='coerce')
-    aire['SO2 (ug/m3)'] = pd.to_numeric(aire['SO2 (ug/m3)'], errors='coerce')
-    aire['Fecha'] = aire['Fecha'].dt.floor('D')
-    aire = localizar(aire)
-    fijos = ['Fecha', 'Latitud', 'Longitud', 'Ubicación']
-    aire = aire.groupby(fijos).agg({col: 'mean' for col in aire.columns if col not in fijos}).reset_index()
-    aire.rename(columns={'PM2.5 (ug/m3)': 'PM2,5 (ug/m3)'}, inplace=True)
-    return aire
-
-def agregar_grafico(elementos, dataset):
-    columna1, columna2 = st.columns(2)
+def listar_colormaps():
+    import matplotlib
+    return list(matplotlib.colormaps)
+
+@st.cache_data
+def medir_importaciones():
+    return rendimiento.medir_importaciones()
+
+@st.cache_resource
+def cargar_cache_figuras():
+    return figuras.CacheFiguras()
+
+# Filtro compartido por todas las páginas: no modificar el resultado, puede ser una vista de los datos en cache
+@rendimiento.medido("filtrado", entrada=filas_seleccionadas)
+def filtrar_datos(instantanea, ubicaciones, inicio=None, fin=None):
+    return cargar_indice(instantanea).filtrar(ubicaciones, inicio, fin)
+
+# Matrices de Pearson y Spearman de todas las columnas numéricas, una vez por combinación de filtros:
+# cambiar los ejes del gráfico de dispersión solo consulta la matriz
+@rendimiento.medido("calcular_correlaciones", entrada=filas_seleccionadas)
+@st.cache_data(hash_funcs=POR_VERSION)
+def calcular_correlaciones(instantanea, ubicaciones, inicio, fin, columnas):
+    return estadisticas.correlaciones(filtrar_datos(instantanea, list(ubicaciones), inicio, fin), list(columnas))
+
+# Histograma 2D de la dispersión, por combinación de filtros y ejes
+@rendimiento.medido("calcular_celdas_dispersion", entrada=filas_seleccionadas)
+@st.cache_data(hash_funcs=POR_VERSION, max_entries=32)
+def calcular_celdas_dispersion(instantanea, ubicaciones, inicio, fin, x, y):
+    return muestreo.agrupar_en_celdas(filtrar_datos(instantanea, list(ubicaciones), inicio, fin), x, y, "Ubicación")
+
+# `series` tiene una tabla ya reducida por variable (calcular_series); con una sola variable va a todo el ancho
+def agregar_grafico(elementos, series):
+    columnas = st.columns(2) if len(elementos) > 1 else [st.container()]
     n = 1
     for elemento in elementos:
-        if n % 2 == 0:
-            columna = columna2
-        else:
-            columna = columna1
+        columna = columnas[(n - 1) % len(columnas)]
         with columna:
             st.write("### " + elemento)
             st.write(descripciones[elemento])
-            st.line_chart(dataset, x='Fecha', y=elemento, color="Ubicación", use_container_width=True)
+            with rendimiento.etapa("grafico " + elemento, entrada=len(series[elemento])):
+                st.line_chart(series[elemento], x='Fecha', y=elemento, color="Ubicación", use_container_width=True)
         n+=1
 
 def imprimir_error(mensaje):
@@ -87,6 +276,46 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+# Mapa de Inicio con la superficie interpolada del contaminante elegido debajo de los sensores. El selector
+# y el deslizador de días están dentro del fragmento: recorrer los días solo vuelve a dibujar el mapa.
+@st.fragment
+def mostrar_mapa(instantanea, layers, tooltip, ubicaciones):
+    import pydeck as pdk
+
+    datos_cubo = cargar_cubo(instantanea)
+    disponibles = [variable for variable in CONTAMINANTES_SUPERFICIE if variable in datos_cubo.posicion_variable]
+    st.write("### Ubicación de Sensores")
+    col1, col2 = st.columns(2)
+    with col1:
+        variable = st.selectbox("Superficie interpolada (IDW)", ["Ninguna"] + disponibles, key="mapa_superficie")
+    if variable != "Ninguna" and len(datos_cubo.fechas):
+        primero = pd.Timestamp(datos_cubo.fechas[0]).date()
+        ultimo = pd.Timestamp(datos_cubo.fechas[-1]).date()
+        with col2:
+            dia = st.slider("Día", min_value=primero, max_value=ultimo, value=ultimo, format="YYYY-MM-DD", key="mapa_dia")
+        superficie = calcular_superficie(instantanea, variable, dia, tuple(ubicaciones))
+        if superficie is None:
+            st.info(f"Ninguna de las ubicaciones seleccionadas tiene datos de {variable} el {dia}.")
+        else:
+            imagen, limites = superficie
+            # Entre comillas para que pydeck lo envíe como texto y no como una expresión
+            layers = [pdk.Layer("BitmapLayer", image=f"'{imagen}'", bounds=limites, opacity=0.6)] + layers
+            minimo, maximo = calcular_escala_superficie(instantanea, variable)
+            st.caption(f"{variable} del {dia}: de {minimo:.1f} (violeta) a {maximo:.1f} (amarillo). Las zonas a más de "
+                       f"{interpolacion.RADIO_METROS / 1000:g} km de una estación con datos quedan sin color.")
+
+    view_state = pdk.ViewState(
+        latitude=-12.0850, longitude=-77.05000, controller=True, zoom=12, pitch=30
+    )
+
+    chart = pdk.Deck(
+        map_style="mapbox://styles/mapbox/light-v9",
+        layers=layers,
+        initial_view_state=view_state,
+        tooltip={"html": tooltip},
+    )
+    st.pydeck_chart(chart)
+
 def cargar_inicio():
     st.header("Monitoreo de Calidad de Aire QAIRA de la Municipalidad de Miraflores", divider="blue")
     columna1, columna2 = st.columns(2)
@@ -123,47 +352,17 @@ def cargar_inicio():
 
     with columna1:
         try:
-            aire = cargar_datos()
-            data = aire[['Latitud', 'Longitud', 'Ubicación']].drop_duplicates()
+            todas = cargar_resumen_estaciones(instantanea)['Ubicación'].tolist()
             st.sidebar.header("Filtros", divider="gray")
-            ubicaciones = st.sidebar.multiselect("Ubicaciones", sorted(aire['Ubicación'].unique()), sorted(aire['Ubicación'].unique()))
+            ubicaciones = st.sidebar.multiselect("Ubicaciones", todas, todas)
 
             if not ubicaciones:
                 st.error("Por favor seleccione al menos una localización.")
             else:
-                data = aire.loc[aire['Ubicación'].isin(ubicaciones)]
-                point_layer = pdk.Layer(
-                    "ScatterplotLayer",
-                    data=data,
-                    get_position=["Longitud", "Latitud"],
-                    auto_highlight=True,
-                    get_radius=50,
-                    get_fill_color=[0, 128, 0, 140],
-                    pickable=True,
-                )
-
-                text_layer = pdk.Layer(
-                        "TextLayer",
-                        data=data,
-                        get_position=["Longitud", "Latitud"],
-                        get_text="Ubicación",
-                        get_color=[0, 0, 0, 10],
-                        get_size=15,
-                        get_alignment_baseline="'bottom'",
-                    )
-
-                view_state = pdk.ViewState(
-                    latitude=-12.0850, longitude=-77.05000, controller=True, zoom=12, pitch=30
-                )
-
-                chart = pdk.Deck(
-                    map_style="mapbox://styles/mapbox/light-v9",
-                    layers=[point_layer, text_layer],
-                    initial_view_state=view_state,
-                )
-
-                st.write("### Ubicación de Sensores")
-                st.pydeck_chart(chart)
+                resumen = cargar_resumen_estaciones(instantanea)
+                resumen = resumen.loc[resumen['Ubicación'].isin(ubicaciones)]
+                layers, tooltip = figuras.capas_mapa(resumen, CONTAMINANTES_MAPA, LIMITE_ESTACIONES_MAPA, METROS_CELDA_MAPA)
+                mostrar_mapa(instantanea, layers, tooltip, ubicaciones)
         except Exception as e:
             imprimir_error(traceback.print_exc(e))
 
@@ -171,14 +370,10 @@ def cargar_resumen():
     st.header(f'{list(paginas_a_funciones.keys())[1]}', divider="blue")
 
     try:
-        aire = cargar_datos()
-
-        aire.drop(columns=['Latitud', 'Longitud', 'Ubicación'], inplace=True)
-        fijas = ['Fecha']
-        aire = aire.groupby(fijas).agg({col: 'mean' for col in aire.columns if col not in fijas}).reset_index()
+        datos_cubo = cargar_cubo(instantanea)
         st.sidebar.header("Filtros", divider="gray")
-        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=aire['Fecha'].min()), 'ns')
-        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=aire['Fecha'].max()), 'ns')
+        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=pd.Timestamp(datos_cubo.fechas[0])), 'ns')
+        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=pd.Timestamp(datos_cubo.fechas[-1])), 'ns')
         gases = ['Fecha', 'CO (ug/m3)', 'H2S (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'SO2 (ug/m3)']
         material_particulados = ['Fecha', 'PM10 (ug/m3)', 'PM2,5 (ug/m3)']
         variables_meteorologicas = ['Fecha', 'Humedad (%)', 'UV', 'Presion (Pa)', 'Temperatura (C)']
@@ -187,17 +382,17 @@ def cargar_resumen():
         if not inicio and not fin:
             st.error("Por favor seleccione al menos una fecha de inicio y una fecha de fin.")
         else:
-            data = aire.loc[aire['Fecha'].between(inicio, fin)]
+            data = datos_cubo.promedio_estaciones(inicio, fin, gases[1:] + material_particulados[1:] + variables_meteorologicas[1:] + niveles_presion_sonora[1:])
 
             data_gases = data[gases]
             st.write("### Gases (ug/m3)")
             st.write(descripciones["Gases (ug/m3)"])
-            st.bar_chart(data_gases, x='Fecha', y=gases[1:], use_container_width=True)
+            st.bar_chart(muestreo.reducir(data_gases, 'Fecha', gases[1:]), x='Fecha', y=gases[1:], use_container_width=True)
 
             data_material_particulados = data[material_particulados]
             st.write("### Materiales Particulados (ug/m3)")
             st.write(descripciones["Material Particulado"])
-            st.bar_chart(data_material_particulados, x='Fecha', y=material_particulados[1:], use_container_width=True)
+            st.bar_chart(muestreo.reducir(data_material_particulados, 'Fecha', material_particulados[1:]), x='Fecha', y=material_particulados[1:], use_container_width=True)
 
             data_variables_meteorologicas = data[variables_meteorologicas]
             st.write("### Variables Meteorológicas")
@@ -211,107 +406,146 @@ def cargar_resumen():
                     columna = columna1
                 with columna:
                     st.write("#### " + variable_meteorologica)
-                    st.bar_chart(data_variables_meteorologicas, x='Fecha', y=variable_meteorologica, use_container_width=True)
+                    st.bar_chart(muestreo.reducir(data_variables_meteorologicas, 'Fecha', variable_meteorologica), x='Fecha', y=variable_meteorologica, use_container_width=True)
                 n+=1
 
             data_niveles_presion_sonora = data[niveles_presion_sonora]
             st.write("### Niveles Presión Sonora (Ruido)")
             st.write(descripciones["Niveles de Presión Sonora"])
-            st.bar_chart(data_niveles_presion_sonora, x='Fecha', y=niveles_presion_sonora[1:], use_container_width=True)
+            st.bar_chart(muestreo.reducir(data_niveles_presion_sonora, 'Fecha', niveles_presion_sonora[1:]), x='Fecha', y=niveles_presion_sonora[1:], use_container_width=True)
     except Exception as e:
         imprimir_error(traceback.print_exc(e))
 
 def cargar_gases():
     st.header(f'{list(paginas_a_funciones.keys())[2]}', divider="blue")
     try:
-        aire = cargar_datos()
-        fijas = ['Fecha', 'Ubicación', 'Latitud', 'Longitud']
-        aire = aire.groupby(fijas).agg({col: 'mean' for col in aire.columns if col not in fijas}).reset_index()
+        datos_cubo = cargar_cubo(instantanea)
         st.sidebar.header("Filtros", divider="gray")
-        ubicaciones = st.sidebar.multiselect("Ubicaciones", sorted(aire['Ubicación'].unique()), sorted(aire['Ubicación'].unique()))
-        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=aire['Fecha'].min()), 'ns')
-        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=aire['Fecha'].max()), 'ns')
+        ubicaciones = st.sidebar.multiselect("Ubicaciones", datos_cubo.ubicaciones, datos_cubo.ubicaciones)
+        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=pd.Timestamp(datos_cubo.fechas[0])), 'ns')
+        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=pd.Timestamp(datos_cubo.fechas[-1])), 'ns')
         gases = ['Fecha', 'Ubicación', 'CO (ug/m3)', 'H2S (ug/m3)', 'NO2 (ug/m3)', 'O3 (ug/m3)', 'SO2 (ug/m3)']
 
         if not ubicaciones and not inicio and not fin:
             st.error("Por favor seleccione al menos una localización, una fecha de inicio y una fecha de fin.")
         else:
-            data = aire.loc[aire['Ubicación'].isin(ubicaciones) & aire['Fecha'].between(inicio, fin)]
-
-            data_gases = data[gases]
-            agregar_grafico(gases[2:], data_gases)
+            mostrar_series(instantanea, ubicaciones, inicio, fin, gases[2:])
     except Exception as e:
         imprimir_error(traceback.print_exc(e))
 
 def cargar_material_particulados():
     st.header(f'{list(paginas_a_funciones.keys())[3]}', divider="blue")
     try:
-        aire = cargar_datos()
-        fijas = ['Fecha', 'Ubicación', 'Latitud', 'Longitud']
-        aire = aire.groupby(fijas).agg({col: 'mean' for col in aire.columns if col not in fijas}).reset_index()
+        datos_cubo = cargar_cubo(instantanea)
         st.sidebar.header("Filtros", divider="gray")
-        ubicaciones = st.sidebar.multiselect("Ubicaciones", sorted(aire['Ubicación'].unique()), sorted(aire['Ubicación'].unique()))
-        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=aire['Fecha'].min()), 'ns')
-        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=aire['Fecha'].max()), 'ns')
+        ubicaciones = st.sidebar.multiselect("Ubicaciones", datos_cubo.ubicaciones, datos_cubo.ubicaciones)
+        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=pd.Timestamp(datos_cubo.fechas[0])), 'ns')
+        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=pd.Timestamp(datos_cubo.fechas[-1])), 'ns')
         material_particulados = ['Fecha', 'Ubicación', 'PM10 (ug/m3)', 'PM2,5 (ug/m3)']
 
         if not ubicaciones and not inicio and not fin:
             st.error("Por favor seleccione al menos una localización, una fecha de inicio y una fecha de fin.")
         else:
-            data = aire.loc[aire['Ubicación'].isin(ubicaciones) & aire['Fecha'].between(inicio, fin)]
-            
-            data_material_particulados = data[material_particulados]
-            agregar_grafico(material_particulados[2:], data_material_particulados)
+            mostrar_series(instantanea, ubicaciones, inicio, fin, material_particulados[2:])
     except Exception as e:
         imprimir_error(traceback.print_exc(e))
 
 def cargar_variables_meteorologicas():
     st.header(f'{list(paginas_a_funciones.keys())[4]}', divider="blue")
     try:
-        aire = cargar_datos()
-        fijas = ['Fecha', 'Ubicación', 'Latitud', 'Longitud']
-        aire = aire.groupby(fijas).agg({col: 'mean' for col in aire.columns if col not in fijas}).reset_index()
+        datos_cubo = cargar_cubo(instantanea)
         st.sidebar.header("Filtros", divider="gray")
-        ubicaciones = st.sidebar.multiselect("Ubicaciones", sorted(aire['Ubicación'].unique()), sorted(aire['Ubicación'].unique()))
-        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=aire['Fecha'].min()), 'ns')
-        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=aire['Fecha'].max()), 'ns')
+        ubicaciones = st.sidebar.multiselect("Ubicaciones", datos_cubo.ubicaciones, datos_cubo.ubicaciones)
+        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=pd.Timestamp(datos_cubo.fechas[0])), 'ns')
+        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=pd.Timestamp(datos_cubo.fechas[-1])), 'ns')
         variables_meteorologicas = ['Fecha', 'Ubicación', 'Humedad (%)', 'UV', 'Presion (Pa)', 'Temperatura (C)']
 
         if not ubicaciones and not inicio and not fin:
             st.error("Por favor seleccione al menos una localización, una fecha de inicio y una fecha de fin.")
         else:
-            data = aire.loc[aire['Ubicación'].isin(ubicaciones) & aire['Fecha'].between(inicio, fin)]
-            
-            data_variables_meteorologicas = data[variables_meteorologicas]
-            agregar_grafico(variables_meteorologicas[2:], data_variables_meteorologicas)
+            mostrar_series(instantanea, ubicaciones, inicio, fin, variables_meteorologicas[2:])
     except Exception as e:
         imprimir_error(traceback.print_exc(e))
 
 def cargar_niveles_presion_sonora():
     st.header(f'{list(paginas_a_funciones.keys())[5]}', divider="blue")
     try:
-        aire = cargar_datos()
-        fijas = ['Fecha', 'Ubicación', 'Latitud', 'Longitud']
-        aire = aire.groupby(fijas).agg({col: 'mean' for col in aire.columns if col not in fijas}).reset_index()
+        datos_cubo = cargar_cubo(instantanea)
         st.sidebar.header("Filtros", divider="gray")
-        ubicaciones = st.sidebar.multiselect("Ubicaciones", sorted(aire['Ubicación'].unique()), sorted(aire['Ubicación'].unique()))
-        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=aire['Fecha'].min()), 'ns')
-        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=aire['Fecha'].max()), 'ns')
+        ubicaciones = st.sidebar.multiselect("Ubicaciones", datos_cubo.ubicaciones, datos_cubo.ubicaciones)
+        inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=pd.Timestamp(datos_cubo.fechas[0])), 'ns')
+        fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=pd.Timestamp(datos_cubo.fechas[-1])), 'ns')
         niveles_presion_sonora = ['Fecha', 'Ubicación', 'Ruido (dB)']
 
         if not ubicaciones and not inicio and not fin:
             st.error("Por favor seleccione al menos una localización, una fecha de inicio y una fecha de fin.")
         else:
-            data = aire.loc[aire['Ubicación'].isin(ubicaciones) & aire['Fecha'].between(inicio, fin)]
-            
-            data_variables_meteorologicas = data[niveles_presion_sonora]
-
-            st.write("### " + niveles_presion_sonora[2:][0])
-            st.write(descripciones[niveles_presion_sonora[2:][0]])
-            st.line_chart(data_variables_meteorologicas, x='Fecha', y=niveles_presion_sonora[2:][0], color="Ubicación", use_container_width=True)
+            mostrar_series(instantanea, ubicaciones, inicio, fin, niveles_presion_sonora[2:])
     except Exception as e:
         imprimir_error(traceback.print_exc(e))
 
+# Ejes, gráfico y correlación de la dispersión: cambiar un eje solo vuelve a ejecutar este fragmento
+@st.fragment
+def mostrar_dispersion(instantanea, data_filtrada, columnas_numericas, ubicaciones, inicio, fin, limite_puntos):
+    col1, col2 = st.columns(2)
+    with col1:
+        x_axis = st.selectbox("Seleccione Variable para Eje X:", columnas_numericas, index=columnas_numericas.index('Temperatura (C)') if 'Temperatura (C)' in columnas_numericas else 0 )
+    with col2:
+        # Asegurar que la variable Y no sea la misma que X por defecto si es posible
+        default_y_index = 0
+        if x_axis in columnas_numericas:
+            if 'Humedad (%)' in columnas_numericas and 'Humedad (%)' != x_axis:
+                default_y_index = columnas_numericas.index('Humedad (%)')
+            elif 'PM2,5 (ug/m3)' in columnas_numericas and 'PM2,5 (ug/m3)' != x_axis:
+                 default_y_index = columnas_numericas.index('PM2,5 (ug/m3)')
+            elif len(columnas_numericas) > 1:
+                 default_y_index = 1 if x_axis == columnas_numericas[0] else 0 # Elegir la siguiente o la primera
+
+
+        y_axis = st.selectbox("Seleccione Variable para Eje Y:", columnas_numericas, index=default_y_index)
+
+    # --- Mostrar gráfico de dispersión ---
+    if x_axis and y_axis:
+        if x_axis == y_axis:
+            st.warning("Seleccione variables diferentes para el eje X y el eje Y.")
+        else:
+            st.write(f"### Dispersión: {y_axis} vs {x_axis}")
+            # Añadir tooltips opcionales (requiere ajustar el formato si es necesario)
+            # data_filtrada['tooltip'] = data_filtrada.apply(lambda row: f"Fecha: {row['Fecha'].strftime('%Y-%m-%d')}<br>Ubicación: {row['Ubicación']}<br>{x_axis}: {row[x_axis]:.2f}<br>{y_axis}: {row[y_axis]:.2f}", axis=1)
+
+            if len(data_filtrada) > limite_puntos:
+                # Con muchos puntos se envía un histograma 2D por ubicación en lugar de cada fila
+                st.scatter_chart(
+                    calcular_celdas_dispersion(instantanea, tuple(ubicaciones), inicio, fin, x_axis, y_axis),
+                    x=x_axis,
+                    y=y_axis,
+                    color="Ubicación",
+                    size="Puntos", # El tamaño indica cuántos puntos caen en cada celda
+                    use_container_width=True
+                )
+                st.caption(f"Se agruparon {len(data_filtrada)} puntos en una grilla de {muestreo.CELDAS_DISPERSION}×{muestreo.CELDAS_DISPERSION} celdas.")
+            else:
+                st.scatter_chart(
+                    data_filtrada,
+                    x=x_axis,
+                    y=y_axis,
+                    color="Ubicación", # Colorea los puntos según la ubicación
+                    # size=None, # Podrías añadir tamaño basado en otra variable si quisieras
+                    use_container_width=True
+                    # tooltip='tooltip' # Descomentar si definiste la columna tooltip
+                )
+            # Opcional: Mostrar correlación
+            pearson, spearman = calcular_correlaciones(instantanea, tuple(ubicaciones), inicio, fin, tuple(columnas_numericas))
+            correlation = pearson.loc[x_axis, y_axis]
+            if pd.isna(correlation):
+                st.write("No se pudo calcular la correlación (podría haber valores NaN).")
+            else:
+                st.write(f"Correlación de Pearson entre {x_axis} y {y_axis}: {correlation:.3f}")
+                st.write(f"Correlación de Spearman entre {x_axis} y {y_axis}: {spearman.loc[x_axis, y_axis]:.3f}")
+
+    else:
+        st.info("Seleccione variables para los ejes X e Y para ver el gráfico.")
+
 def cargar_pagina_dispersion():
     st.header("Análisis de Dispersión", divider="blue")
 
@@ -338,7 +572,7 @@ Explora cómo interactúan dos variables del aire que tú elijas. Cada punto en
     st.markdown(descripcion_dispersion_markdown) # Reemplaza la línea anterior
 
     try:
-        aire = cargar_datos()
+        aire = cargar_indice(instantanea).aire
         if aire.empty:
             st.warning("No hay datos disponibles para mostrar.")
             return
@@ -353,6 +587,7 @@ Explora cómo interactúan dos variables del aire que tú elijas. Cada punto en
         fecha_max = aire['Fecha'].max().date()
         inicio = np.datetime64(st.sidebar.date_input("Fecha de Inicio", value=fecha_min, min_value=fecha_min, max_value=fecha_max, key='disp_inicio'), 'ns')
         fin = np.datetime64(st.sidebar.date_input("Fecha de Fin", value=fecha_max, min_value=fecha_min, max_value=fecha_max, key='disp_fin'), 'ns')
+        limite_puntos = st.sidebar.number_input("Máximo de puntos sin agrupar", min_value=100, value=muestreo.LIMITE_DISPERSION, step=500, key='disp_limite')
 
         if not ubicaciones:
             st.error("Por favor seleccione al menos una localización.")
@@ -362,106 +597,153 @@ Explora cómo interactúan dos variables del aire que tú elijas. Cada punto en
              return
 
         # Filtrar datos según selecciones
-        data_filtrada = aire[aire['Ubicación'].isin(ubicaciones) & aire['Fecha'].between(inicio, fin)].copy() # Usar .copy() para evitar SettingWithCopyWarning
+        data_filtrada = filtrar_datos(instantanea, ubicaciones, inicio, fin)
 
         if data_filtrada.empty:
             st.warning("No hay datos para las selecciones realizadas.")
             return
 
         # --- Selección de variables para los ejes ---
-        columnas_numericas = sorted([col for col in data_filtrada.columns if data_filtrada[col].dtype in ['int64', 'float64'] and col not in ['Latitud', 'Longitud']])
+        columnas_numericas = datos.columnas_numericas(data_filtrada)
         if not columnas_numericas:
              st.warning("No se encontraron columnas numéricas adecuadas para el gráfico de dispersión.")
              return
 
-        col1, col2 = st.columns(2)
-        with col1:
-            x_axis = st.selectbox("Seleccione Variable para Eje X:", columnas_numericas, index=columnas_numericas.index('Temperatura (C)') if 'Temperatura (C)' in columnas_numericas else 0 )
-        with col2:
-            # Asegurar que la variable Y no sea la misma que X por defecto si es posible
-            default_y_index = 0
-            if x_axis in columnas_numericas:
-                if 'Humedad (%)' in columnas_numericas and 'Humedad (%)' != x_axis:
-                    default_y_index = columnas_numericas.index('Humedad (%)')
-                elif 'PM2,5 (ug/m3)' in columnas_numericas and 'PM2,5 (ug/m3)' != x_axis:
-                     default_y_index = columnas_numericas.index('PM2,5 (ug/m3)')
-                elif len(columnas_numericas) > 1:
-                     default_y_index = 1 if x_axis == columnas_numericas[0] else 0 # Elegir la siguiente o la primera
-
-
-            y_axis = st.selectbox("Seleccione Variable para Eje Y:", columnas_numericas, index=default_y_index)
-
-        # --- Mostrar gráfico de dispersión ---
-        if x_axis and y_axis:
-            if x_axis == y_axis:
-                st.warning("Seleccione variables diferentes para el eje X y el eje Y.")
-            else:
-                st.write(f"### Dispersión: {y_axis} vs {x_axis}")
-                # Añadir tooltips opcionales (requiere ajustar el formato si es necesario)
-                # data_filtrada['tooltip'] = data_filtrada.apply(lambda row: f"Fecha: {row['Fecha'].strftime('%Y-%m-%d')}<br>Ubicación: {row['Ubicación']}<br>{x_axis}: {row[x_axis]:.2f}<br>{y_axis}: {row[y_axis]:.2f}", axis=1)
-
-                st.scatter_chart(
-                    data_filtrada,
-                    x=x_axis,
-                    y=y_axis,
-                    color="Ubicación", # Colorea los puntos según la ubicación
-                    # size=None, # Podrías añadir tamaño basado en otra variable si quisieras
-                    use_container_width=True
-                    # tooltip='tooltip' # Descomentar si definiste la columna tooltip
-                )
-                # Opcional: Mostrar correlación
-                try:
-                    correlation = data_filtrada[x_axis].corr(data_filtrada[y_axis])
-                    st.write(f"Correlación de Pearson entre {x_axis} y {y_axis}: {correlation:.3f}")
-                except Exception:
-                    st.write("No se pudo calcular la correlación (podría haber valores NaN).")
-
-        else:
-            st.info("Seleccione variables para los ejes X e Y para ver el gráfico.")
+        mostrar_dispersion(instantanea, data_filtrada, columnas_numericas, ubicaciones, inicio, fin, limite_puntos)
 
     except Exception as e:
         imprimir_error("Error al cargar la página de análisis de dispersión", e)
 
+# Selector de variable y boxplot: cambiar la variable solo vuelve a ejecutar este fragmento
+@st.fragment
+def mostrar_comparativa(instantanea, ubicaciones, columnas_numericas):
+    variable = st.selectbox("Variable a Comparar", columnas_numericas, key="comp_variable")
+    cajas = cargar_cajas(instantanea)
+    resumenes = [(ubicacion, cajas.get((ubicacion, variable))) for ubicacion in ubicaciones]
+    resumenes = [(ubicacion, resumen) for ubicacion, resumen in resumenes if resumen is not None]
+
+    if not resumenes:
+        st.warning("No hay datos para la variable y ubicaciones seleccionadas.")
+        return
+
+    # Boxplot armado con los estadísticos ya calculados: no se envían todas las observaciones al navegador
+    st.write(f"### Distribución de **{variable}** por Ubicación")
+    fig = figuras.figura_cajas(resumenes, variable)
+    st.plotly_chart(fig, use_container_width=True)
+
+    st.caption("Este gráfico muestra la distribución estadística de la variable seleccionada para cada ubicación. Incluye mediana, cuartiles y posibles valores atípicos.")
+
 def cargar_comparativa_ubicacion():
     st.header("Comparativa por Ubicación", divider="blue")
     st.write("Compare la distribución de una variable ambiental entre diferentes ubicaciones.")
 
     try:
-        aire = cargar_datos()
+        aire = cargar_indice(instantanea).aire
         if aire.empty:
             st.warning("No hay datos disponibles.")
             return
 
         # Variables categóricas y numéricas
         ubicaciones_disponibles = sorted(aire['Ubicación'].unique())
-        columnas_numericas = sorted([
-            col for col in aire.columns
-            if aire[col].dtype in ['float64', 'int64'] and col not in ['Latitud', 'Longitud']
-        ])
+        columnas_numericas = datos.columnas_numericas(aire)
 
         st.sidebar.header("Filtros (Comparativa)", divider="gray")
         ubicaciones = st.sidebar.multiselect("Ubicaciones", ubicaciones_disponibles, ubicaciones_disponibles, key="comp_ubicaciones")
-        variable = st.sidebar.selectbox("Variable a Comparar", columnas_numericas)
 
-        if not ubicaciones or not variable:
+        if not ubicaciones:
             st.warning("Seleccione al menos una ubicación y una variable.")
             return
 
-        data = aire[aire['Ubicación'].isin(ubicaciones)][['Ubicación', variable]].dropna()
+        mostrar_comparativa(instantanea, ubicaciones, columnas_numericas)
 
-        if data.empty:
-            st.warning("No hay datos para la variable y ubicaciones seleccionadas.")
-            return
+    except Exception as e:
+        imprimir_error("Error al cargar la página Comparativa por Ubicación", e)
 
-        # Boxplot
-        st.write(f"### Distribución de **{variable}** por Ubicación")
-        fig = px.box(data, x='Ubicación', y=variable, color='Ubicación', points="all")
-        st.plotly_chart(fig, use_container_width=True)
+# Filtra, agrega y renderiza el mapa de calor; devuelve la imagen PNG y los datos del encabezado
+def generar_heatmap(instantanea, variable_seleccionada, metodo_agregacion, colormap, ubicaciones, inicio, fin):
+    # Daily statistics for the selected locations (cached per filter state)
+    estadisticas_diarias = calcular_estadisticas_diarias(instantanea, tuple(sorted(ubicaciones)), inicio, fin)
 
-        st.caption("Este gráfico muestra la distribución estadística de la variable seleccionada para cada ubicación. Incluye mediana, cuartiles y posibles valores atípicos.")
+    if estadisticas_diarias.empty:
+        st.warning("No hay datos disponibles para las ubicaciones y fechas seleccionadas.")
+        return None
 
-    except Exception as e:
-        imprimir_error("Error al cargar la página Comparativa por Ubicación", e)
+    if (variable_seleccionada, metodo_agregacion) not in estadisticas_diarias.columns:
+         st.error(f"Error interno: La columna '{variable_seleccionada}' no se encontró después de filtrar.")
+         return None
+
+    # Days without valid values for the variable are already NaN here
+    datos_calor = estadisticas_diarias[(variable_seleccionada, metodo_agregacion)].dropna()
+
+    if datos_calor.empty:
+        st.warning(f"No quedaron datos para graficar para '{variable_seleccionada}' con el método '{metodo_agregacion}' después de la agregación diaria.")
+        return None
+
+    try:
+        # Calplot creates a matplotlib figure; it is rasterized once (and closed) so the PNG can be cached
+        imagen = figuras.heatmap_calendario(datos_calor, colormap)
+
+    except Exception as plot_err:
+         st.error(f"Error al generar el gráfico de mapa de calor: {plot_err}")
+         # Optionally print traceback for debugging
+         # st.error("Traceback:")
+         # st.code(traceback.format_exc())
+         return None
+
+    return {
+        'imagen': imagen,
+        'desde': datos_calor.index.min().strftime('%Y-%m-%d'),
+        'hasta': datos_calor.index.max().strftime('%Y-%m-%d'),
+        'dias': len(datos_calor),
+    }
+
+# Controles del mapa de calor (variable, método, colormap) y la imagen: cambiar uno de ellos solo vuelve
+# a ejecutar este fragmento, que toma la figura del cache o la rasteriza una vez
+@st.fragment
+def mostrar_heatmap(instantanea, columnas_numericas_heatmap, ubicaciones, inicio, fin):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        variable_seleccionada = st.selectbox(
+            "Seleccione Variable para Mapa de Calor:",
+            columnas_numericas_heatmap,
+            index=columnas_numericas_heatmap.index('H2S (ug/m3)') if 'H2S (ug/m3)' in columnas_numericas_heatmap else 0,
+            key="heatmap_variable"
+        )
+    with col2:
+        metodo_agregacion = st.selectbox(
+            "Método de Agregación Diario:",
+            ['mean', 'median', 'max', 'min', 'sum'],
+            index=0, # Default to 'mean'
+            key="heatmap_agg"
+        )
+    with col3:
+        mapas_color_disponibles = listar_colormaps() # Get available matplotlib colormaps
+        colormap = st.selectbox(
+            "Colormap:",
+            mapas_color_disponibles,
+            index=mapas_color_disponibles.index('viridis') if 'viridis' in mapas_color_disponibles else 0,
+            key="heatmap_cmap"
+        )
+
+    # La figura ya renderizada se reutiliza mientras no cambie ninguno de estos parámetros
+    cache_figuras = cargar_cache_figuras()
+    clave = (instantanea.version, instantanea.excluye_marcadas, variable_seleccionada, metodo_agregacion, colormap, tuple(sorted(ubicaciones)), str(inicio), str(fin))
+    figura = cache_figuras.obtener(clave)
+
+    if figura is None:
+        with rendimiento.etapa("heatmap", entrada=filas_seleccionadas(instantanea, ubicaciones)):
+            figura = generar_heatmap(instantanea, variable_seleccionada, metodo_agregacion, colormap, ubicaciones, inicio, fin)
+        if figura is None:
+            return
+        figura = cache_figuras.guardar(clave, **figura)
+
+    # --- Generate and Display Heatmap ---
+    st.write(f"### Mapa de Calor: {variable_seleccionada} ({metodo_agregacion.capitalize()})")
+    st.write(f"Datos desde {figura['desde']} hasta {figura['hasta']}")
+    st.write(f"Número de días con datos para graficar: {figura['dias']}")
+    st.image(figura['imagen'], use_container_width=True)
+    estado_cache = cache_figuras.estadisticas()
+    st.caption(f"Cache de figuras: {estado_cache['aciertos']} aciertos, {estado_cache['fallos']} fallos, {estado_cache['entradas']} figuras ({estado_cache['bytes'] / 1024:.0f} KB)")
 
 def cargar_pagina_heatmap():
     st.header("Mapa de Calor Diario por Variable", divider="blue")
@@ -477,45 +759,11 @@ def cargar_pagina_heatmap():
     """)
 
     try:
-        aire = cargar_datos()
+        aire = cargar_indice(instantanea).aire
         if aire.empty:
             st.warning("No hay datos base disponibles para cargar.")
             return
 
-        # --- Configuration Widgets for Heatmap (in main area) ---
-        columnas_numericas_heatmap = sorted([
-            col for col in aire.columns
-            if aire[col].dtype in ['float64', 'int64']
-            and col not in ['Latitud', 'Longitud'] # Exclude non-sensical heatmap variables
-        ])
-        if not columnas_numericas_heatmap:
-            st.error("No se encontraron columnas numéricas adecuadas en los datos cargados.")
-            return
-
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            variable_seleccionada = st.selectbox(
-                "Seleccione Variable para Mapa de Calor:",
-                columnas_numericas_heatmap,
-                index=columnas_numericas_heatmap.index('H2S (ug/m3)') if 'H2S (ug/m3)' in columnas_numericas_heatmap else 0,
-                key="heatmap_variable"
-            )
-        with col2:
-            metodo_agregacion = st.selectbox(
-                "Método de Agregación Diario:",
-                ['mean', 'median', 'max', 'min', 'sum'],
-                index=0, # Default to 'mean'
-                key="heatmap_agg"
-            )
-        with col3:
-            mapas_color_disponibles = plt.colormaps() # Get available matplotlib colormaps
-            colormap = st.selectbox(
-                "Colormap:",
-                mapas_color_disponibles,
-                index=mapas_color_disponibles.index('viridis') if 'viridis' in mapas_color_disponibles else 0,
-                key="heatmap_cmap"
-            )
-
         # --- Apply Sidebar Filters (Location and Date) ---
         # Get filters from the sidebar (ensure these widgets exist in your main app structure)
         # Using placeholder logic if sidebar widgets aren't defined exactly like this yet
@@ -569,78 +817,68 @@ def cargar_pagina_heatmap():
              st.error("La fecha de inicio no puede ser posterior a la fecha de fin (barra lateral).")
              return
 
-        # Filter data based on sidebar selections
-        data_filtrada = aire[
-            aire['Ubicación'].isin(ubicaciones) &
-            aire['Fecha'].between(inicio, fin)
-        ].copy() # Use copy to avoid warnings
-
-        if data_filtrada.empty:
-            st.warning("No hay datos disponibles para las ubicaciones y fechas seleccionadas.")
+        columnas_numericas_heatmap = datos.columnas_numericas(aire)
+        if not columnas_numericas_heatmap:
+            st.error("No se encontraron columnas numéricas adecuadas en los datos cargados.")
             return
 
-        # --- Prepare Data Specifically for Calplot ---
-        # Ensure the selected column is numeric, coercing errors
-        if variable_seleccionada not in data_filtrada.columns:
-             st.error(f"Error interno: La columna '{variable_seleccionada}' no se encontró después de filtrar.")
-             return
-
-        # Important: Convert to numeric *before* aggregation
-        data_filtrada[variable_seleccionada] = pd.to_numeric(data_filtrada[variable_seleccionada], errors='coerce')
+        mostrar_heatmap(instantanea, columnas_numericas_heatmap, ubicaciones, inicio, fin)
 
-        # Drop rows where the specific variable is NaN *before* grouping
-        data_filtrada.dropna(subset=[variable_seleccionada], inplace=True)
+    except FileNotFoundError:
+         imprimir_error("No se encontró el archivo 'data/aire.csv'. Asegúrate de que esté en la ubicación correcta.")
+    except KeyError as ke:
+         imprimir_error(f"Error: No se encontró una columna esperada en los datos: {ke}. Verifica el archivo CSV.")
+    except Exception as e:
+        # Use your existing error printing function
+        st.error(f"Ocurrió un error inesperado al cargar la página del mapa de calor:")
+        st.exception(e) # st.exception shows the traceback nicely
 
-        if data_filtrada.empty:
-             st.warning(f"No quedaron datos para '{variable_seleccionada}' después de eliminar valores no numéricos/vacíos en el rango seleccionado.")
-             return
+# Serie diaria de una estación y contaminante: cambiar cualquiera de los dos solo vuelve a ejecutar este fragmento
+@st.fragment
+def mostrar_serie_normativa(cumplimiento, ubicaciones, anio):
+    st.write("### Serie diaria frente al límite")
+    columna1, columna2 = st.columns(2)
+    ubicacion = columna1.selectbox("Ubicación", ubicaciones, key="norma_ubicacion")
+    variable = columna2.selectbox("Contaminante", cumplimiento.variables, key="norma_variable")
+    serie = cumplimiento.serie(ubicacion, variable)
+    serie = serie[serie['Fecha'].dt.year == anio]
+    st.line_chart(serie, x='Fecha', y=list(serie.columns[1:]), use_container_width=True)
+    st.caption(normativa.LIMITES[variable]['norma'])
 
-        # Aggregate daily values across selected locations
-        # Group by date ONLY, select the variable, and aggregate
-        datos_calor = data_filtrada.groupby('Fecha')[variable_seleccionada].agg(metodo_agregacion)
+def cargar_pagina_normativa():
+    st.header("Cumplimiento Normativo", divider="blue")
+    st.write("Días por encima de los límites diarios de calidad del aire por ubicación y año calendario, a partir de las mediciones horarias.")
 
-        # Drop potential NaNs resulting from aggregation (e.g., if a day had no valid data left)
-        datos_calor.dropna(inplace=True)
+    try:
+        cumplimiento = cargar_cumplimiento(instantanea)
+        if not cumplimiento.variables or len(cumplimiento.dias) == 0:
+            st.warning("No hay datos horarios de contaminantes con límites normativos.")
+            return
 
-        if datos_calor.empty:
-            st.warning(f"No quedaron datos para graficar para '{variable_seleccionada}' con el método '{metodo_agregacion}' después de la agregación diaria.")
+        st.sidebar.header("Filtros (Normativa)", divider="gray")
+        anios = cumplimiento.anios()
+        anio = st.sidebar.selectbox("Año", anios, index=len(anios) - 1, key="norma_anio")
+        ubicaciones = st.sidebar.multiselect("Ubicaciones", cumplimiento.ubicaciones, cumplimiento.ubicaciones, key="norma_ubicaciones")
+        if not ubicaciones:
+            st.warning("Seleccione al menos una ubicación.")
             return
 
-        # --- Generate and Display Heatmap ---
-        st.write(f"### Mapa de Calor: {variable_seleccionada} ({metodo_agregacion.capitalize()})")
-        st.write(f"Datos desde {datos_calor.index.min().strftime('%Y-%m-%d')} hasta {datos_calor.index.max().strftime('%Y-%m-%d')}")
-        st.write(f"Número de días con datos para graficar: {len(datos_calor)}")
+        st.write(f"### Días con excedencia en {anio}")
+        excedencias = cumplimiento.excedencias(anio, ubicaciones)
+        st.dataframe(excedencias, hide_index=True, use_container_width=True)
+        st.caption(
+            f"La media diaria solo cuenta si al menos el {normativa.COBERTURA_MINIMA:.0%} de sus horas tiene datos; "
+            "lo mismo vale para cada ventana de la media móvil de 8 h del ozono."
+        )
 
-        try:
-            # Calplot creates a matplotlib figure and axes
-            fig, ax = calplot.calplot(
-                data=datos_calor,        # Pass the aggregated Series
-                how=None,                # Aggregation was already done manually
-                cmap=colormap,           # Use selected colormap
-                figsize=(15, 4),         # Adjust figure size as needed
-                suptitle=None            # Title is handled by st.write above
-                # yearlabel_kws={'fontsize': 12}, # Example customization
-                # daylabels=['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom'] # Spanish day labels
-            )
-
-            # Display the matplotlib figure in Streamlit
-            st.pyplot(fig)
-
-        except Exception as plot_err:
-             st.error(f"Error al generar el gráfico de mapa de calor: {plot_err}")
-             # Optionally print traceback for debugging
-             # st.error("Traceback:")
-             # st.code(traceback.format_exc())
+        st.write(f"### Categoría diaria del índice de calidad del aire en {anio}")
+        st.bar_chart(cumplimiento.resumen_aqi(anio, ubicaciones), use_container_width=True)
+        st.caption("Peor categoría del día entre PM2,5, PM10 (media diaria) y O3 (máximo de la media de 8 h), con los puntos de corte del AQI de la EPA.")
 
+        mostrar_serie_normativa(cumplimiento, ubicaciones, anio)
 
-    except FileNotFoundError:
-         imprimir_error("No se encontró el archivo 'data/aire.csv'. Asegúrate de que esté en la ubicación correcta.")
-    except KeyError as ke:
-         imprimir_error(f"Error: No se encontró una columna esperada en los datos: {ke}. Verifica el archivo CSV.")
     except Exception as e:
-        # Use your existing error printing function
-        st.error(f"Ocurrió un error inesperado al cargar la página del mapa de calor:")
-        st.exception(e) # st.exception shows the traceback nicely
+        imprimir_error(f"Error al cargar la página Cumplimiento Normativo: {e}")
 
 paginas_a_funciones = {
     "Inicio": cargar_inicio,
@@ -652,12 +890,50 @@ paginas_a_funciones = {
     "Comparativa por Ubicación": cargar_comparativa_ubicacion,
     "Análisis de Dispersión": cargar_pagina_dispersion,
     "Mapa de Calor Diario": cargar_pagina_heatmap,
+    "Cumplimiento Normativo": cargar_pagina_normativa,
 }
 
 st.sidebar.header("Calidad de Aire QAIRA", divider="blue")
 st.sidebar.header("Navegación", divider="gray")
 pagina = st.sidebar.selectbox("Elegir Página", paginas_a_funciones.keys())
-paginas_a_funciones[pagina]()
+
+# Todas las páginas de esta ejecución usan la misma instantánea, aunque el vigilante publique otra mientras tanto
+with rendimiento.etapa("cargar_vigilante") as medicion:
+    vigilante = cargar_vigilante()
+    instantanea = vigilante.actual()
+    medicion.entrada = len(instantanea.niveles['hora'])
+    medicion.salida = len(instantanea.aire)
+if st.session_state.get("version_datos") not in (None, instantanea.version):
+    st.toast("Llegaron datos nuevos de los sensores; los gráficos ya los incluyen.")
+st.session_state["version_datos"] = instantanea.version
+st.sidebar.caption(f"Datos: versión {instantanea.version}")
+if vigilante.error:
+    st.sidebar.warning(f"La última ingesta falló, se muestran los datos anteriores: {vigilante.error}")
+# Control de calidad: rachas de ceros, valores atascados, lecturas fuera de rango y picos se marcan al ingerir
+if st.sidebar.toggle("Excluir lecturas marcadas por control de calidad", key="excluir_marcadas"):
+    with st.sidebar.expander("Horas marcadas por variable"):
+        st.dataframe(calcular_resumen_calidad(instantanea))
+    instantanea = cargar_sin_marcadas(instantanea)
+with rendimiento.etapa("pagina " + pagina, entrada=len(instantanea.aire)):
+    paginas_a_funciones[pagina]()
+
+# Tiempos por etapa de esta ejecución (QAIRA_RENDIMIENTO=1, o =memoria para incluir bytes asignados)
+if rendimiento.ACTIVO:
+    with st.sidebar.expander("Rendimiento"):
+        mediciones = pd.DataFrame(rendimiento.mediciones())
+        if len(mediciones):
+            mediciones['etapa'] = ["  " * nivel + etapa for nivel, etapa in zip(mediciones['nivel'], mediciones['etapa'])]
+            mediciones['ms'] = (mediciones['segundos'] * 1000).round(1)
+            st.dataframe(mediciones[['etapa', 'ms', 'filas_entrada', 'filas_salida', 'bytes']], hide_index=True)
+        st.download_button("Métricas (Prometheus)", rendimiento.texto_prometheus(), file_name="qaira.prom", mime="text/plain")
+
+# Modo de medición: QAIRA_MEDIR_IMPORTACIONES=1 muestra cuánto cuesta importar cada librería pesada
+if os.environ.get("QAIRA_MEDIR_IMPORTACIONES"):
+    with st.sidebar.expander("Tiempos de importación"):
+        st.dataframe(
+            pd.DataFrame([{'Módulo': modulo, 'ms': None if segundos is None else round(segundos * 1000, 1)} for modulo, segundos in medir_importaciones().items()]),
+            hide_index=True,
+        )
 
 footer_html = """
 <div style='position:fixed; left:0; bottom:0; width:100%; background-color:#000; color:white; text-align:center;'>
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Puntos máximos que se envían al navegador por gráfico, repartidos entre sus series
+PUNTOS_POR_GRAFICO = 1500
+METODOS = ['lttb', 'envolvente']
+# Cantidad de puntos a partir de la cual el gráfico de dispersión se agrupa en celdas
+LIMITE_DISPERSION = 5000
+CELDAS_DISPERSION = 60
+
+# Largest-Triangle-Three-Buckets: conserva el primer y el último punto y, en cada cubeta intermedia,
+# el punto que forma el triángulo de mayor área con el punto elegido antes y el promedio de la
+# cubeta siguiente. Así los picos (p. ej. excedencias de PM10) sobreviven a la reducción.
+def lttb(x, y, puntos):
+    n = len(x)
+    if puntos >= n or puntos < 3:
+        return np.arange(n)
+    bordes = np.linspace(1, n - 1, puntos - 1).astype('int64')
+    # Promedios de cada cubeta de una sola vez; la última cubeta usa el punto final
+    sumas_x = np.add.reduceat(x[1:n - 1], bordes[:-1] - 1)
+    sumas_y = np.add.reduceat(y[1:n - 1], bordes[:-1] - 1)
+    tamanos = np.diff(bordes)
+    promedios_x = np.append(sumas_x / tamanos, x[-1])
+    promedios_y = np.append(sumas_y / tamanos, y[-1])
+
+    elegidos = np.empty(puntos, dtype='int64')
+    elegidos[0] = 0
+    elegidos[-1] = n - 1
+    anterior = 0
+    for i in range(puntos - 2):
+        a, b = bordes[i], bordes[i + 1]
+        areas = np.abs(
+            (x[anterior] - promedios_x[i + 1]) * (y[a:b] - y[anterior])
+            - (x[anterior] - x[a:b]) * (promedios_y[i + 1] - y[anterior])
+        )
+        anterior = a + int(np.argmax(areas))
+        elegidos[i + 1] = anterior
+    return elegidos
+
+# Envolvente mínimo/máximo: el menor y el mayor valor de cada cubeta, en orden temporal
+def envolvente(x, y, puntos):
+    n = len(x)
+    if puntos >= n or puntos < 2:
+        return np.arange(n)
+    cubeta = np.arange(n) * (puntos // 2) // n
+    orden = np.lexsort((y, cubeta))
+    primeros = np.flatnonzero(np.r_[True, cubeta[orden][1:] != cubeta[orden][:-1]])
+    ultimos = np.r_[primeros[1:] - 1, n - 1]
+    return np.unique(np.concatenate([orden[primeros], orden[ultimos]]))
+
+def indices_serie(x, y, puntos, metodo):
+    validos = np.flatnonzero(~np.isnan(y))
+    funcion = lttb if metodo == 'lttb' else envolvente
+    return validos[funcion(x[validos], y[validos], puntos)]
+
+# Reduce cada serie (una por valor de `color`, o una sola si es None) a su parte del presupuesto.
+# Con varias columnas en `y` se conserva la unión de los puntos elegidos para cada una.
+def reducir(data, x, y, color=None, puntos=PUNTOS_POR_GRAFICO, metodo='lttb'):
+    columnas = [y] if isinstance(y, str) else list(y)
+    if len(data) <= puntos:
+        return data
+    grupos = [data] if color is None else [grupo for _, grupo in data.groupby(color, observed=True, sort=False)]
+    presupuesto = max(puntos // max(len(grupos) * len(columnas), 1), 3)
+
+    partes = []
+    for grupo in grupos:
+        grupo = grupo.sort_values(x)
+        valores_x = grupo[x].to_numpy().astype('int64') if grupo[x].dtype.kind == 'M' else grupo[x].to_numpy(dtype='float64')
+        filas = np.unique(np.concatenate([
+            indices_serie(valores_x, grupo[columna].to_numpy(dtype='float64', na_value=np.nan), presupuesto, metodo)
+            for columna in columnas
+        ]))
+        partes.append(grupo.iloc[filas])
+    return pd.concat(partes) if partes else data.iloc[0:0]
+
+# Histograma 2D sobre una grilla común para todas las series: una fila por celda ocupada y
+# valor de `color`, con el centro de la celda y la cantidad de puntos que contiene.
+def agrupar_en_celdas(data, x, y, color, celdas=CELDAS_DISPERSION):
+    data = data.dropna(subset=[x, y, color])
+    valores_x = data[x].to_numpy(dtype='float64')
+    valores_y = data[y].to_numpy(dtype='float64')
+    if not len(data):
+        return pd.DataFrame(columns=[x, y, color, 'Puntos'])
+    bordes_x = np.linspace(valores_x.min(), valores_x.max(), celdas + 1)
+    bordes_y = np.linspace(valores_y.min(), valores_y.max(), celdas + 1)
+    celda_x = np.clip(np.searchsorted(bordes_x, valores_x, side='right') - 1, 0, celdas - 1)
+    celda_y = np.clip(np.searchsorted(bordes_y, valores_y, side='right') - 1, 0, celdas - 1)
+
+    serie = pd.Categorical(data[color])
+    codigo = (serie.codes.astype('int64') * celdas + celda_x) * celdas + celda_y
+    ocupadas, puntos = np.unique(codigo, return_counts=True)
+    centros_x = (bordes_x[:-1] + bordes_x[1:]) / 2
+    centros_y = (bordes_y[:-1] + bordes_y[1:]) / 2
+    return pd.DataFrame({
+        x: centros_x[ocupadas // celdas % celdas],
+        y: centros_y[ocupadas % celdas],
+        color: pd.Categorical.from_codes(ocupadas // (celdas * celdas), categories=serie.categories),
+        'Puntos': puntos,
+    })
@@ -0,0 +1,235 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from resoluciones import PREFIJO_CONTEO, PREFIJO_SUMA
+
+UNA_HORA = np.timedelta64(1, 'h')
+UN_DIA = np.timedelta64(1, 'D')
+
+# Límites diarios por contaminante. La métrica de cada día es la media del día calendario (ventana de
+# 24 h) o, para el ozono, el máximo diario de la media móvil de 8 h. `permitidos` son los días al año
+# que la norma tolera por encima del límite (los valores guía de 24 h de la OMS 2021 son percentil 99,
+# unos 3 días al año).
+LIMITES = {
+    'PM10 (ug/m3)': {'ventana': 24, 'limite': 50.0, 'permitidos': 35, 'norma': 'UE 2008/50/CE: media diaria'},
+    'PM2,5 (ug/m3)': {'ventana': 24, 'limite': 15.0, 'permitidos': 3, 'norma': 'OMS 2021: media de 24 h'},
+    'O3 (ug/m3)': {'ventana': 8, 'limite': 100.0, 'permitidos': 3, 'norma': 'OMS 2021: máximo diario de la media de 8 h'},
+    'NO2 (ug/m3)': {'ventana': 24, 'limite': 25.0, 'permitidos': 3, 'norma': 'OMS 2021: media de 24 h'},
+    'SO2 (ug/m3)': {'ventana': 24, 'limite': 40.0, 'permitidos': 3, 'norma': 'OMS 2021: media de 24 h'},
+    'CO (ug/m3)': {'ventana': 24, 'limite': 4000.0, 'permitidos': 3, 'norma': 'OMS 2021: media de 24 h'},
+}
+# Una media (diaria o móvil) solo cuenta si al menos el 75 % de sus horas tiene datos
+COBERTURA_MINIMA = 0.75
+# Categorías del índice de calidad del aire con los puntos de corte del AQI de la EPA, en ug/m3
+# (los del ozono, definidos en ppm para 8 h, convertidos a 25 °C)
+CATEGORIAS_AQI = ['Buena', 'Moderada', 'Dañina para grupos sensibles', 'Dañina', 'Muy dañina', 'Peligrosa']
+CORTES_AQI = {
+    'PM2,5 (ug/m3)': [9.0, 35.4, 55.4, 125.4, 225.4],
+    'PM10 (ug/m3)': [54.0, 154.0, 254.0, 354.0, 424.0],
+    'O3 (ug/m3)': [106.0, 137.0, 167.0, 206.0, 393.0],
+}
+# Días que se procesan por tramo en una reconstrucción completa, para acotar la memoria del bloque horario
+DIAS_POR_TRAMO = 31
+
+# Resultados diarios por estación: media del día calendario y máximo diario de la media móvil (de 24 u
+# 8 h según el contaminante). Nunca se modifica; cada actualización del motor arma uno nuevo.
+class Cumplimiento:
+    def __init__(self, ubicaciones, dias, variables, media, maximo_movil):
+        self.ubicaciones = list(ubicaciones)
+        self.dias = dias
+        self.variables = list(variables)
+        self.media = media
+        self.maximo_movil = maximo_movil
+        for arreglo in (self.dias, self.media, self.maximo_movil):
+            arreglo.flags.writeable = False
+
+    # Valor diario que se compara con el límite de cada variable: estación × día × variable
+    def metrica(self):
+        ventanas = np.array([LIMITES[variable]['ventana'] for variable in self.variables])
+        return np.where(ventanas == 24, self.media, self.maximo_movil)
+
+    def anios(self):
+        return sorted(set(self.dias.astype('datetime64[Y]').astype(int) + 1970))
+
+    # Días de un año calendario, opcionalmente solo hasta `hasta` (inclusive)
+    def rango_anio(self, anio, hasta=None):
+        anios = self.dias.astype('datetime64[Y]').astype(int) + 1970
+        dias = anios == anio
+        return dias if hasta is None else dias & (self.dias <= np.datetime64(hasta, 'D'))
+
+    # Días con excedencia por (estación, contaminante) en un año calendario, junto a los días con dato
+    def excedencias(self, anio, ubicaciones=None, hasta=None):
+        dias = self.rango_anio(anio, hasta)
+        metrica = self.metrica()[:, dias]
+        limites = np.array([LIMITES[variable]['limite'] for variable in self.variables])
+        excedidos = (metrica > limites).sum(axis=1)
+        con_dato = (~np.isnan(metrica)).sum(axis=1)
+        filas = []
+        for i, ubicacion in enumerate(self.ubicaciones):
+            if ubicaciones is not None and ubicacion not in ubicaciones:
+                continue
+            for j, variable in enumerate(self.variables):
+                filas.append({
+                    'Ubicación': ubicacion, 'Contaminante': variable, 'Norma': LIMITES[variable]['norma'],
+                    'Límite (ug/m3)': LIMITES[variable]['limite'], 'Días con dato': int(con_dato[i, j]),
+                    'Días excedidos': int(excedidos[i, j]), 'Días permitidos': LIMITES[variable]['permitidos'],
+                    'Cumple': bool(excedidos[i, j] <= LIMITES[variable]['permitidos']),
+                })
+        return pd.DataFrame(filas)
+
+    # Categoría AQI de cada (estación, día): la peor entre los contaminantes con puntos de corte; -1 sin datos
+    def categorias(self):
+        metrica = self.metrica()
+        peor = np.full(metrica.shape[:2], -1)
+        for variable, cortes in CORTES_AQI.items():
+            if variable not in self.variables:
+                continue
+            valores = metrica[:, :, self.variables.index(variable)]
+            categoria = np.searchsorted(np.array(cortes), valores, side='left')
+            peor = np.maximum(peor, np.where(np.isnan(valores), -1, categoria))
+        return peor
+
+    # Días de cada categoría AQI por estación en un año
+    def resumen_aqi(self, anio, ubicaciones=None, hasta=None):
+        categorias = self.categorias()[:, self.rango_anio(anio, hasta)]
+        conteos = np.stack([(categorias == k).sum(axis=1) for k in range(len(CATEGORIAS_AQI))], axis=1)
+        tabla = pd.DataFrame(conteos, index=pd.Index(self.ubicaciones, name='Ubicación'), columns=CATEGORIAS_AQI)
+        return tabla if ubicaciones is None else tabla.loc[[u for u in self.ubicaciones if u in ubicaciones]]
+
+    # Serie diaria de una estación y contaminante: media diaria y máximo de la media móvil
+    def serie(self, ubicacion, variable):
+        i = self.ubicaciones.index(ubicacion)
+        j = self.variables.index(variable)
+        return pd.DataFrame({
+            'Fecha': self.dias.astype('datetime64[ns]'),
+            'Media diaria': self.media[i, :, j],
+            f"Máximo de la media móvil de {LIMITES[variable]['ventana']} h": self.maximo_movil[i, :, j],
+            'Límite': LIMITES[variable]['limite'],
+        })
+
+# Motor incremental sobre la tabla horaria de resoluciones (sumas y conteos por Ubicación y hora).
+# Las medias de cada ventana salen de sumas acumuladas, así que solo se recalcula desde el primer día
+# cuyas horas cambiaron, con las horas del día anterior como contexto. Para encontrarlo se guarda una
+# huella de cada (estación, día): cambia con las horas nuevas, con las lecturas que se suman a una hora
+# ya procesada y con las horas que el control de calidad marca después (sin las marcadas, su suma y su
+# conteo se anulan). Si llegan horas anteriores al primer día, o una estación nueva, se reconstruye todo.
+class MotorNormativa:
+    def __init__(self):
+        self.candado = threading.Lock()
+        self.reiniciar([], [])
+
+    def reiniciar(self, ubicaciones, variables):
+        self.ubicaciones = list(ubicaciones)
+        self.variables = list(variables)
+        self.dia0 = None
+        self.media = np.empty((len(self.ubicaciones), 0, len(self.variables)))
+        self.maximo_movil = self.media.copy()
+        self.huellas = np.empty((len(self.ubicaciones), 0))
+        self.resultado = None
+
+    def actualizar(self, horas):
+        with self.candado:
+            variables = [variable for variable in LIMITES if PREFIJO_SUMA + variable in horas.columns]
+            horas = horas.dropna(subset=['Ubicación'])
+            dias = horas['Fecha'].to_numpy().astype('datetime64[D]')
+            categorias = pd.Categorical(horas['Ubicación'])
+            ubicaciones = sorted(map(str, categorias.categories[np.unique(categorias.codes)]))
+            ultimo_guardado = self.dia0 + (self.media.shape[1] - 1) * UN_DIA if self.dia0 is not None else None
+            if (self.dia0 is None or len(horas) == 0 or variables != self.variables or not set(ubicaciones) <= set(self.ubicaciones)
+                    or dias.min() < self.dia0 or dias.max() < ultimo_guardado):
+                self.reiniciar(ubicaciones, variables)
+                self.dia0 = dias.min() if len(horas) else None
+            if len(horas):
+                # Posición de cada estación en el eje de ubicaciones, vía los códigos de la categoría
+                estacion = pd.Index(self.ubicaciones).get_indexer(categorias.categories.astype(str))[categorias.codes]
+                huellas = self.calcular_huellas(horas, estacion, dias)
+                guardados = self.huellas.shape[1]
+                cambiados = np.flatnonzero((huellas[:, :guardados] != self.huellas).any(axis=0))
+                primer_dia = self.dia0 + (cambiados[0] if len(cambiados) else guardados) * UN_DIA
+                if primer_dia <= dias.max():
+                    contexto = dias >= primer_dia - UN_DIA
+                    self.incorporar_filas(horas.loc[contexto], estacion[contexto], primer_dia)
+                self.huellas = huellas
+            if self.resultado is None:
+                dias = self.dia0 + np.arange(self.media.shape[1]) * UN_DIA if self.dia0 is not None else np.array([], dtype='datetime64[D]')
+                self.resultado = Cumplimiento(self.ubicaciones, dias, self.variables, self.media, self.maximo_movil)
+            return self.resultado
+
+    # Estación × día desde dia0: suma de las sumas y conteos de cada hora con pesos distintos por variable
+    # y por hora del día, para que también cambie si un valor pasa de una hora a otra
+    def calcular_huellas(self, horas, estacion, dias):
+        pesos = np.sqrt(np.arange(2, 2 + 2 * len(self.variables)))
+        huella = np.zeros(len(horas))
+        for j, variable in enumerate(self.variables):
+            huella += np.nan_to_num(horas[PREFIJO_SUMA + variable].to_numpy('float64')) * pesos[2 * j]
+            huella += horas[PREFIJO_CONTEO + variable].to_numpy('float64') * pesos[2 * j + 1]
+        hora_del_dia = (horas['Fecha'].to_numpy().astype('datetime64[h]') - dias).astype('int64')
+        huella *= np.sqrt(hora_del_dia + 29.0)
+        cantidad_dias = int((dias.max() - self.dia0) / UN_DIA) + 1
+        clave = estacion * cantidad_dias + ((dias - self.dia0) / UN_DIA).astype('int64')
+        return np.bincount(clave, weights=huella, minlength=len(self.ubicaciones) * cantidad_dias).reshape(len(self.ubicaciones), cantidad_dias)
+
+    # `horas` trae también las del día anterior a `primer_dia`, que solo sirven de contexto
+    def incorporar_filas(self, horas, estacion, primer_dia):
+        fechas = horas['Fecha'].to_numpy().astype('datetime64[h]')
+        orden = np.argsort(fechas, kind='stable')
+        fechas = fechas[orden]
+        estacion = estacion[orden]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            valores = np.column_stack([
+                (horas[PREFIJO_SUMA + variable] / horas[PREFIJO_CONTEO + variable].where(horas[PREFIJO_CONTEO + variable] > 0)).to_numpy(dtype='float64')
+                for variable in self.variables
+            ])[orden]
+        # En tramos de días para que el bloque denso estación × hora × variable tenga un tamaño acotado;
+        # cada tramo lleva las horas del día anterior
+        dias = fechas.astype('datetime64[D]')
+        for inicio in np.arange(primer_dia, dias[-1] + UN_DIA, DIAS_POR_TRAMO * UN_DIA):
+            fin = min(inicio + (DIAS_POR_TRAMO - 1) * UN_DIA, dias[-1])
+            a, b = np.searchsorted(dias, [inicio - UN_DIA, fin + UN_DIA])
+            self.incorporar(estacion[a:b], fechas[a:b], valores[a:b], inicio, fin)
+        self.resultado = None
+
+    # Recalcula los días de `primer_dia` a `ultimo_dia`; el bloque empieza un día antes para que las
+    # ventanas móviles de las primeras horas tengan sus horas previas
+    def incorporar(self, estacion, fechas, valores, primer_dia, ultimo_dia):
+        cantidad_dias = int((ultimo_dia - primer_dia) / UN_DIA) + 1
+        inicio = (primer_dia - UN_DIA).astype('datetime64[h]')
+        bloque = np.full((len(self.ubicaciones), 24 * (cantidad_dias + 1), len(self.variables)), np.nan)
+        bloque[estacion, ((fechas - inicio) / UNA_HORA).astype('int64')] = valores
+
+        validos = ~np.isnan(bloque)
+        suma = np.concatenate([np.zeros_like(bloque[:, :1]), np.where(validos, bloque, 0.0).cumsum(axis=1)], axis=1)
+        conteo = np.concatenate([np.zeros(validos[:, :1].shape), validos.cumsum(axis=1)], axis=1)
+        fin = np.arange(1, bloque.shape[1] + 1)
+        movil = np.empty_like(bloque)
+        for j, variable in enumerate(self.variables):
+            ventana = LIMITES[variable]['ventana']
+            comienzo = np.maximum(fin - ventana, 0)
+            horas_validas = conteo[:, fin, j] - conteo[:, comienzo, j]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                movil[:, :, j] = np.where(horas_validas >= COBERTURA_MINIMA * ventana, (suma[:, fin, j] - suma[:, comienzo, j]) / horas_validas, np.nan)
+
+        # Del segundo día del bloque en adelante: media del día y máximo de la media móvil
+        por_dia = (len(self.ubicaciones), cantidad_dias, 24, len(self.variables))
+        valores_dia = bloque[:, 24:].reshape(por_dia)
+        horas_dia = (~np.isnan(valores_dia)).sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media = np.where(horas_dia >= COBERTURA_MINIMA * 24, np.nansum(valores_dia, axis=2) / horas_dia, np.nan)
+        maximo_movil = np.fmax.reduce(movil[:, 24:].reshape(por_dia), axis=2)
+        self.escribir_dias(primer_dia, media, maximo_movil)
+
+    def escribir_dias(self, primer_dia, media, maximo_movil):
+        desde = int((primer_dia - self.dia0) / UN_DIA)
+        faltan = desde + media.shape[1] - self.media.shape[1]
+        if faltan > 0:
+            relleno = np.full((len(self.ubicaciones), faltan, len(self.variables)), np.nan)
+            self.media = np.concatenate([self.media, relleno], axis=1)
+            self.maximo_movil = np.concatenate([self.maximo_movil, relleno], axis=1)
+        else:
+            # Los resultados ya publicados no se modifican: se trabaja sobre copias
+            self.media = self.media.copy()
+            self.maximo_movil = self.maximo_movil.copy()
+        self.media[:, desde:desde + media.shape[1]] = media
+        self.maximo_movil[:, desde:desde + media.shape[1]] = maximo_movil
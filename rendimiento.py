@@ -0,0 +1,152 @@
+import functools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+# Módulos que el tablero importa recién en la página que los usa
+MODULOS_PESADOS = ['streamlit', 'pandas', 'pyarrow', 'scipy.spatial', 'pydeck', 'matplotlib.pyplot', 'calplot', 'plotly.express', 'plotly.graph_objects']
+
+# Costo de importar cada módulo en un intérprete nuevo (python -X importtime), en segundos.
+# Se mide en un proceso aparte porque en el proceso del tablero los módulos ya pueden estar cargados.
+def medir_importaciones(modulos=MODULOS_PESADOS):
+    tiempos = {}
+    for modulo in modulos:
+        proceso = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {modulo}"], capture_output=True, text=True)
+        if proceso.returncode != 0:
+            tiempos[modulo] = None
+            continue
+        # Cada línea es "import time: propio | acumulado | módulo"; la del módulo pedido trae el total
+        acumulados = [int(m.group(1)) for m in re.finditer(rf"^import time:\s*\d+ \|\s*(\d+) \|\s*{re.escape(modulo)}\s*$", proceso.stderr, re.MULTILINE)]
+        tiempos[modulo] = acumulados[-1] / 1e6 if acumulados else 0.0
+    return tiempos
+
+# Instrumentación por etapa. QAIRA_RENDIMIENTO=1 mide tiempos y filas; QAIRA_RENDIMIENTO=memoria además
+# mide bytes asignados con tracemalloc, que sí tiene un costo apreciable. Apagada, cada etapa es una
+# comparación y un objeto compartido que no hace nada, así que se puede dejar en producción.
+MODO = os.environ.get("QAIRA_RENDIMIENTO", "")
+ACTIVO = bool(MODO)
+registro = logging.getLogger("qaira.rendimiento")
+
+_local = threading.local()
+_candado = threading.Lock()
+# Totales acumulados desde que arrancó el proceso: etapa -> [llamadas, segundos, bytes]
+_totales = {}
+
+def activar(activo=True, memoria=False):
+    global ACTIVO
+    ACTIVO = activo
+    if activo and memoria and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if activo and not registro.handlers:
+        registro.addHandler(logging.StreamHandler())
+        registro.setLevel(logging.INFO)
+
+def _pila():
+    if not hasattr(_local, 'pila'):
+        _local.pila = []
+        _local.mediciones = []
+    return _local.pila
+
+# Mediciones de la ejecución actual del script (cada sesión de Streamlit corre en su propio hilo)
+def mediciones():
+    _pila()
+    return [medicion for medicion in _local.mediciones if medicion is not None]
+
+def reiniciar():
+    _pila()
+    _local.mediciones = []
+
+def filas(objeto):
+    forma = getattr(objeto, 'shape', None)
+    return int(forma[0]) if forma else None
+
+class Etapa:
+    def __init__(self, nombre, entrada=None):
+        self.nombre = nombre
+        self.entrada = entrada
+        self.salida = None
+
+    def __enter__(self):
+        pila = _pila()
+        self.nivel = len(pila)
+        pila.append(self)
+        # Se reserva el lugar al entrar para que las etapas anidadas queden después de la que las contiene
+        self.posicion = len(_local.mediciones)
+        _local.mediciones.append(None)
+        self.bytes_inicio = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *error):
+        segundos = time.perf_counter() - self.inicio
+        asignados = tracemalloc.get_traced_memory()[0] - self.bytes_inicio if self.bytes_inicio is not None else None
+        _pila().pop()
+        medicion = {
+            'etapa': self.nombre, 'nivel': self.nivel, 'segundos': segundos,
+            'filas_entrada': self.entrada, 'filas_salida': self.salida, 'bytes': asignados,
+        }
+        _local.mediciones[self.posicion] = medicion
+        with _candado:
+            total = _totales.setdefault(self.nombre, [0, 0.0, 0])
+            total[0] += 1
+            total[1] += segundos
+            # Solo lo que la etapa dejó asignado: el total es un contador y no puede bajar
+            total[2] += max(asignados or 0, 0)
+        registro.info(json.dumps(medicion, ensure_ascii=False))
+        return False
+
+class _EtapaNula:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        return False
+
+_NULA = _EtapaNula()
+
+# with rendimiento.etapa("filtrado", entrada=len(data)) as medicion: ...; medicion.salida = len(resultado)
+def etapa(nombre, entrada=None):
+    return Etapa(nombre, entrada) if ACTIVO else _NULA
+
+# Igual que etapa, para funciones enteras. Las filas de entrada las calcula `entrada` con los mismos
+# argumentos que la función; las de salida salen del resultado si es una tabla.
+def medido(nombre, entrada=None):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envuelta(*argumentos, **opciones):
+            if not ACTIVO:
+                return funcion(*argumentos, **opciones)
+            with Etapa(nombre, entrada(*argumentos, **opciones) if entrada is not None else None) as medicion:
+                resultado = funcion(*argumentos, **opciones)
+                medicion.salida = filas(resultado)
+            return resultado
+        return envuelta
+    return decorador
+
+# Totales en el formato de texto de Prometheus
+def texto_prometheus():
+    with _candado:
+        totales = {nombre: list(total) for nombre, total in _totales.items()}
+    lineas = []
+    for metrica, posicion, ayuda in [
+        ('qaira_etapa_llamadas_total', 0, 'Veces que se ejecutó la etapa'),
+        ('qaira_etapa_segundos_total', 1, 'Tiempo acumulado en la etapa'),
+        ('qaira_etapa_bytes_total', 2, 'Bytes que la etapa dejó asignados, sin contar las que liberaron memoria (solo con QAIRA_RENDIMIENTO=memoria)'),
+    ]:
+        lineas += [f"# HELP {metrica} {ayuda}", f"# TYPE {metrica} counter"]
+        for nombre, total in sorted(totales.items()):
+            etiqueta = nombre.replace('\\', '\\\\').replace('"', '\\"')
+            lineas.append(f'{metrica}{{etapa="{etiqueta}"}} {total[posicion]}')
+    return "\n".join(lineas) + "\n"
+
+activar(ACTIVO, memoria=MODO == "memoria")
+
+if __name__ == "__main__":
+    for modulo, segundos in medir_importaciones(sys.argv[1:] or MODULOS_PESADOS).items():
+        print(f"{modulo:25s} {'no disponible' if segundos is None else f'{segundos * 1000:8.1f} ms'}")
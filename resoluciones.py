@@ -0,0 +1,258 @@
+import numpy as np
+import pandas as pd
+
+import calidad
+import filtros
+
+# Niveles de agregación precalculados al ingerir, del más fino al más grueso
+NIVELES = ['hora', 'dia', 'semana', 'mes']
+HORAS_POR_NIVEL = {'hora': 1, 'dia': 24, 'semana': 24 * 7, 'mes': 24 * 30.44}
+# Cantidad aproximada de puntos por serie que se quiere enviar a cada gráfico
+PUNTOS_OBJETIVO = 200
+
+PREFIJO_SUMA = "suma "
+PREFIJO_CONTEO = "conteo "
+PREFIJO_MIN = "min "
+PREFIJO_MAX = "max "
+ESTADISTICOS = {PREFIJO_SUMA: 'sum', PREFIJO_CONTEO: 'sum', PREFIJO_MIN: 'min', PREFIJO_MAX: 'max'}
+# Máscara de control de calidad (bits de calidad.py); solo existe en el nivel horario
+PREFIJO_CALIDAD = "calidad "
+# Horas previas a las nuevas con las que se empieza a recalcular la máscara en una ingesta incremental
+HORAS_CONTEXTO = 2 * max(calidad.HORAS_ATASCADO, calidad.VENTANA_PICO)
+
+def truncar(fechas, nivel):
+    if nivel == 'hora':
+        return fechas.dt.floor('h')
+    dias = fechas.dt.floor('D')
+    if nivel == 'dia':
+        return dias
+    if nivel == 'semana':
+        # Semanas de lunes a domingo, identificadas por su lunes
+        return dias - pd.to_timedelta(dias.dt.dayofweek, unit='D')
+    return dias - pd.to_timedelta(dias.dt.day - 1, unit='D')
+
+# Suma, conteo, mínimo y máximo por (Ubicación, Fecha) de cada nivel. Se combinan entre sí sin
+# volver a las filas originales, así que los niveles gruesos se calculan a partir del horario.
+def acumular(aire, variables):
+    aire = aire.dropna(subset=['Ubicación'])
+    grupos = aire.groupby(['Ubicación', truncar(aire['Fecha'], 'hora')], observed=True)[variables]
+    hora = pd.concat([
+        grupos.sum().add_prefix(PREFIJO_SUMA),
+        grupos.count().add_prefix(PREFIJO_CONTEO),
+        grupos.min().add_prefix(PREFIJO_MIN),
+        grupos.max().add_prefix(PREFIJO_MAX),
+    ], axis=1).reset_index()
+    hora = calificar(hora, variables)
+    return {nivel: hora if nivel == 'hora' else reagrupar(hora, nivel, variables) for nivel in NIVELES}
+
+# Agrega al nivel horario la máscara de calidad de cada variable, sobre toda la serie. Una ingesta
+# incremental solo la recalcula al final de cada estación (recalificar).
+def calificar(hora, variables):
+    codigos = pd.factorize(hora['Ubicación'])[0]
+    orden = np.lexsort((hora['Fecha'].to_numpy(), codigos))
+    estacion = codigos[orden]
+    mascaras = {}
+    for variable in variables:
+        conteo = hora[PREFIJO_CONTEO + variable].to_numpy()[orden]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            valor = np.where(conteo > 0, hora[PREFIJO_SUMA + variable].to_numpy()[orden] / conteo, np.nan)
+        mascara = np.empty(len(hora), dtype=calidad.TIPO_MASCARA)
+        mascara[orden] = calidad.marcar(
+            estacion, valor, hora[PREFIJO_MIN + variable].to_numpy('float64')[orden],
+            hora[PREFIJO_MAX + variable].to_numpy('float64')[orden], variable,
+        )
+        mascaras[PREFIJO_CALIDAD + variable] = mascara
+    return hora.drop(columns=[columna for columna in hora.columns if columna.startswith(PREFIJO_CALIDAD)]).assign(**mascaras)
+
+# Los mismos niveles sin las horas marcadas por el control de calidad: sus sumas y conteos se anulan en
+# el nivel horario y los demás niveles se vuelven a agregar desde ahí
+def excluir_marcadas(niveles, variables):
+    hora = niveles['hora']
+    columnas = {}
+    for variable in variables:
+        marcada = hora[PREFIJO_CALIDAD + variable].to_numpy() > 0
+        for prefijo, vacio in ((PREFIJO_SUMA, 0), (PREFIJO_CONTEO, 0), (PREFIJO_MIN, np.nan), (PREFIJO_MAX, np.nan)):
+            columna = hora[prefijo + variable]
+            columnas[prefijo + variable] = np.where(marcada, vacio, columna.to_numpy()).astype(columna.dtype)
+    hora = hora.assign(**columnas)
+    return {nivel: hora if nivel == 'hora' else reagrupar(hora, nivel, variables) for nivel in NIVELES}
+
+def resumen_calidad(niveles, variables):
+    return calidad.resumen({variable: niveles['hora'][PREFIJO_CALIDAD + variable].to_numpy() for variable in variables})
+
+def reagrupar(tabla, nivel, variables):
+    agregaciones = {prefijo + variable: funcion for prefijo, funcion in ESTADISTICOS.items() for variable in variables}
+    grupos = tabla.groupby(['Ubicación', truncar(tabla['Fecha'], nivel)], observed=True)
+    return grupos.agg(agregaciones).reset_index()
+
+# Agrega a los niveles las filas de una ingesta nueva. Solo se vuelve a agrupar, en cada estación, desde
+# el primer periodo que tocan las filas nuevas, y la máscara de calidad solo se recalcula cerca de ahí;
+# lo anterior se conserva tal cual.
+def combinar(niveles, nuevos, variables):
+    combinados = {nivel: fusionar(niveles[nivel], nuevos[nivel], nivel, variables) for nivel in NIVELES}
+    hora, nuevas = combinados['hora']
+    return {nivel: recalificar(hora, nuevas, variables) if nivel == 'hora' else tabla for nivel, (tabla, _) in combinados.items()}
+
+# `previo` y el resultado van ordenados por (Ubicación, Fecha), como salen de reagrupar. También indica
+# qué filas del resultado se volvieron a agrupar: son las últimas de cada estación.
+def fusionar(previo, agregado, nivel, variables):
+    if len(agregado) == 0:
+        return previo, np.zeros(len(previo), dtype=bool)
+    ubicaciones = pd.concat([previo['Ubicación'], agregado['Ubicación']], ignore_index=True).astype('category')
+    codigos = ubicaciones.cat.codes.to_numpy()
+    codigos_previo = codigos[:len(previo)]
+    # Primer periodo nuevo de cada estación; las que no recibieron filas conservan todo
+    desde = np.full(len(ubicaciones.cat.categories), np.iinfo('int64').max)
+    np.minimum.at(desde, codigos[len(previo):], agregado['Fecha'].to_numpy('datetime64[ns]').view('int64'))
+    en_cola = previo['Fecha'].to_numpy('datetime64[ns]').view('int64') >= desde[codigos_previo]
+    cola = reagrupar(pd.concat([previo[en_cola], agregado], ignore_index=True), nivel, variables)
+    # En cada estación las filas conservadas son anteriores a las de la cola: basta un orden estable por estación
+    codigos_cola = pd.Categorical(cola['Ubicación'], categories=ubicaciones.cat.categories).codes
+    conservadas = np.flatnonzero(~en_cola)
+    fuente = np.r_[conservadas, len(previo) + np.arange(len(cola))]
+    fuente = fuente[np.argsort(np.r_[codigos_previo[conservadas], codigos_cola], kind='stable')]
+    return pd.concat([previo, cola], ignore_index=True).take(fuente).reset_index(drop=True), fuente >= len(previo)
+
+# Máscara de calidad cuando solo cambiaron las últimas horas de algunas estaciones (`nuevas`)
+def recalificar(hora, nuevas, variables):
+    codigos = hora['Ubicación'].astype('category').cat.codes.to_numpy()
+    inicio = np.flatnonzero(np.r_[True, codigos[1:] != codigos[:-1]]) if len(hora) else np.array([], dtype='int64')
+    fin = np.r_[inicio[1:], len(hora)]
+    cuantas = np.add.reduceat(nuevas.astype('int64'), inicio) if len(hora) else inicio
+    tocadas = cuantas > 0
+    mascaras = leer_mascaras(hora, variables)
+    remarcar_ventanas(hora, mascaras, inicio[tocadas], (fin - cuantas)[tocadas], fin[tocadas], variables, False)
+    return hora.assign(**{PREFIJO_CALIDAD + variable: mascara for variable, mascara in mascaras.items()})
+
+def leer_mascaras(hora, variables):
+    return {variable: hora[PREFIJO_CALIDAD + variable].fillna(0).to_numpy().astype(calidad.TIPO_MASCARA) for variable in variables}
+
+# Recalcula `mascaras` en ventanas de la tabla horaria, una por estación, cuyas filas desde `corte` hasta
+# `fin` cambiaron o se calificaron sin las anteriores. Cada ventana va de HORAS_CONTEXTO horas antes del
+# corte hasta `fin` o, si esas filas ya están `calificadas` por su cuenta, a HORAS_CONTEXTO horas
+# después; se duplica (sin pasar de `inicio`, la primera fila de su estación, ni de `fin`) si le falta
+# contexto: una racha más larga, o pocas lecturas.
+def remarcar_ventanas(hora, mascaras, inicio, corte, fin, variables, calificadas):
+    contexto = np.full(len(corte), HORAS_CONTEXTO)
+    while True:
+        desde = np.maximum(corte - contexto, inicio)
+        hasta = np.minimum(corte + contexto, fin) if calificadas else fin
+        largo = hasta - desde
+        filas = np.arange(largo.sum()) + np.repeat(desde - np.r_[0, np.cumsum(largo)[:-1]], largo)
+        ventana = np.repeat(np.arange(len(desde)), largo)
+        previa = filas < corte[ventana]
+        faltan = np.zeros(len(desde), dtype=bool)
+        recalculadas = {}
+        for variable in variables:
+            conteo = hora[PREFIJO_CONTEO + variable].to_numpy()[filas]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                valor = np.where(conteo > 0, hora[PREFIJO_SUMA + variable].to_numpy()[filas] / conteo, np.nan)
+            recalculadas[variable], falta = calidad.remarcar(
+                ventana, valor, hora[PREFIJO_MIN + variable].to_numpy('float64')[filas],
+                hora[PREFIJO_MAX + variable].to_numpy('float64')[filas], variable,
+                mascaras[variable][filas], previa, desde == inicio, hasta == fin,
+            )
+            faltan |= falta
+        if not faltan.any():
+            break
+        contexto = np.where(faltan, contexto * 2, contexto)
+    for variable in variables:
+        mascaras[variable][filas] = recalculadas[variable]
+
+# Combina los niveles de varios archivos. Si en cada estación las horas de los archivos no se solapan
+# (p. ej. un CSV por sensor y por mes), el nivel horario es la concatenación de los de cada archivo, y
+# su máscara, calculada por archivo, solo se corrige cerca de las fronteras entre archivos. Si se
+# solapan, se vuelve a agrupar y calificar todo. Los demás niveles siempre se vuelven a agrupar.
+def unir(lista, variables):
+    lista = [{nivel: completar(tabla, nivel, variables) for nivel, tabla in de_archivo.items()} for de_archivo in lista]
+    niveles = {nivel: reagrupar(pd.concat([de_archivo[nivel] for de_archivo in lista], ignore_index=True), nivel, variables) for nivel in NIVELES[1:]}
+    hora = pd.concat([de_archivo['hora'] for de_archivo in lista], ignore_index=True)
+    codigos = hora['Ubicación'].astype('category').cat.codes.to_numpy()
+    fechas = hora['Fecha'].to_numpy('datetime64[ns]')
+    archivo = np.repeat(np.arange(len(lista)), [len(de_archivo['hora']) for de_archivo in lista])
+    orden = np.lexsort((fechas, codigos))
+    codigos, fechas, archivo = codigos[orden], fechas[orden], archivo[orden]
+    misma_estacion = np.r_[False, codigos[1:] == codigos[:-1]]
+    fronteras = np.flatnonzero(misma_estacion & (archivo != np.r_[-1, archivo[:-1]]))
+    # Sin solapamiento cada (archivo, estación) queda en un solo tramo y ninguna hora se repite
+    tramos = len(np.unique(archivo * (codigos.max() + 1 if len(codigos) else 1) + codigos))
+    inicios = np.flatnonzero(~misma_estacion)
+    if len(fronteras) != tramos - len(inicios) or (misma_estacion & (fechas == np.r_[fechas[:1], fechas[:-1]])).any():
+        niveles['hora'] = calificar(reagrupar(hora, 'hora', variables), variables)
+        return niveles
+
+    hora = hora.take(orden).reset_index(drop=True)
+    mascaras = leer_mascaras(hora, variables)
+    # Las fronteras de cada estación se corrigen en orden: la i-ésima de todas las estaciones a la vez,
+    # con una ventana que llega hasta la frontera siguiente
+    estacion = np.searchsorted(inicios, fronteras, side='right') - 1
+    siguiente = np.r_[estacion[1:] == estacion[:-1], False]
+    fin = np.where(siguiente, np.r_[fronteras[1:], 0], np.r_[inicios[1:], len(hora)][estacion])
+    posicion = np.arange(len(fronteras))
+    rango = posicion - np.maximum.accumulate(np.where(np.r_[True, estacion[1:] != estacion[:-1]], posicion, 0))
+    for i in range(rango.max() + 1 if len(fronteras) else 0):
+        elegidas = rango == i
+        remarcar_ventanas(hora, mascaras, inicios[estacion[elegidas]], fronteras[elegidas], fin[elegidas], variables, True)
+    niveles['hora'] = hora.assign(**{PREFIJO_CALIDAD + variable: mascara for variable, mascara in mascaras.items()})
+    return niveles
+
+# Agrega las columnas de las variables que un archivo no tiene, sin lecturas, en el orden de acumular
+def completar(tabla, nivel, variables):
+    vacias = {PREFIJO_SUMA: 'float64', PREFIJO_CONTEO: 'int64', PREFIJO_MIN: 'float64', PREFIJO_MAX: 'float64'}
+    if nivel == 'hora':
+        vacias[PREFIJO_CALIDAD] = calidad.TIPO_MASCARA
+    columnas = {prefijo + variable: tipo for prefijo, tipo in vacias.items() for variable in variables}
+    faltan = {
+        columna: np.full(len(tabla), np.nan if columna.startswith((PREFIJO_MIN, PREFIJO_MAX)) else 0, dtype=tipo)
+        for columna, tipo in columnas.items() if columna not in tabla.columns
+    }
+    return tabla.assign(**faltan)[['Ubicación', 'Fecha'] + list(columnas)]
+
+# Todos los niveles en una sola tabla larga, para guardarlos juntos en el cache. Las máscaras solo
+# tienen sentido en el nivel horario: en los demás se guardan en 0 y se descartan al leer.
+def apilar(niveles):
+    tabla = pd.concat([tabla.assign(Nivel=nivel) for nivel, tabla in niveles.items()], ignore_index=True)
+    mascaras = [columna for columna in tabla.columns if columna.startswith(PREFIJO_CALIDAD)]
+    return tabla.fillna({columna: 0 for columna in mascaras}).astype({columna: calidad.TIPO_MASCARA for columna in mascaras})
+
+# apilar deja cada nivel en un bloque contiguo: se corta sin copiar (p. ej. sobre un memory map)
+def desapilar(tabla):
+    mascaras = [columna for columna in tabla.columns if columna.startswith(PREFIJO_CALIDAD)]
+    niveles = {}
+    for nivel in NIVELES:
+        filas = np.flatnonzero((tabla['Nivel'] == nivel).to_numpy())
+        contiguas = len(filas) == 0 or filas[-1] - filas[0] + 1 == len(filas)
+        parte = tabla.iloc[filas[0]:filas[-1] + 1] if len(filas) and contiguas else tabla.iloc[filas]
+        niveles[nivel] = parte.drop(columns=['Nivel'] + ([] if nivel == 'hora' else mascaras)).reset_index(drop=True)
+    return niveles
+
+# Tabla para graficar: promedio de cada variable junto a su mínimo, máximo y conteo
+def resumir(tabla, variables):
+    resumen = tabla[['Ubicación', 'Fecha']].copy()
+    for variable in variables:
+        conteo = tabla[PREFIJO_CONTEO + variable]
+        # Para graficar basta con float32; las sumas de 64 bits quedan en la tabla de origen
+        resumen[variable] = (tabla[PREFIJO_SUMA + variable] / conteo.where(conteo > 0)).astype('float32')
+        resumen[PREFIJO_MIN + variable] = tabla[PREFIJO_MIN + variable].astype('float32')
+        resumen[PREFIJO_MAX + variable] = tabla[PREFIJO_MAX + variable].astype('float32')
+        resumen[PREFIJO_CONTEO + variable] = conteo.astype('int32')
+    return resumen
+
+# El nivel cuya cantidad de puntos en el rango está más cerca de `puntos` (en escala logarítmica);
+# ante un empate se prefiere el más grueso
+def elegir_nivel(inicio, fin, puntos=PUNTOS_OBJETIVO):
+    horas = max((np.datetime64(fin, 'h') - np.datetime64(inicio, 'h')).astype('int64') + 24, 1)
+    distancia = {nivel: abs(np.log(horas / HORAS_POR_NIVEL[nivel] / puntos)) for nivel in NIVELES}
+    return min(reversed(NIVELES), key=distancia.get)
+
+class Resoluciones:
+    def __init__(self, niveles, variables):
+        self.variables = list(variables)
+        self.indices = {nivel: filtros.AireIndexado(resumir(tabla, variables)) for nivel, tabla in niveles.items()}
+
+    # `fin` es un día completo: en niveles más finos que el diario se incluyen todas sus horas,
+    # y en semanas o meses se incluye el periodo que contiene a `inicio`
+    def seleccionar(self, nivel, ubicaciones, inicio, fin, variables):
+        inicio = truncar(pd.Series([pd.Timestamp(inicio)]), nivel).iloc[0]
+        fin = pd.Timestamp(fin).floor('D') + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+        return self.indices[nivel].filtrar(ubicaciones, inicio, fin)[['Fecha', 'Ubicación'] + list(variables)]
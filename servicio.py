@@ -0,0 +1,260 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pyarrow as pa
+
+import datos
+import filtros
+import rendimiento
+import resoluciones
+import vigilancia
+
+# Servicio HTTP sin interfaz sobre los mismos datos del tablero: el vigilante ingiere los CSV en segundo
+# plano y cada consulta recorta la instantánea actual con los índices que usan las páginas.
+#
+#   GET /consulta?ubicacion=A,B&inicio=2020-08-01&fin=2020-08-31&variables=NO2 (ug/m3)&resolucion=hora
+#                &formato=arrow|json&marcadas=excluir
+#   GET /metadatos   ubicaciones, variables, rango de fechas y versión de los datos
+#   GET /metrics     tiempos por etapa en formato Prometheus
+#
+# Las respuestas llevan un ETag que depende de la versión de los datos y de los parámetros: un cliente
+# que repite la consulta con If-None-Match recibe 304 sin que se vuelva a calcular nada.
+PUERTO = int(os.environ.get("QAIRA_PUERTO_SERVICIO", 8765))
+# Respuestas ya serializadas que se conservan en memoria
+ENTRADAS_CACHE = int(os.environ.get("QAIRA_CACHE_SERVICIO", 64))
+TIPO_ARROW = "application/vnd.apache.arrow.stream"
+TIPO_JSON = "application/json"
+RESOLUCIONES = ['automatica'] + resoluciones.NIVELES
+registro = logging.getLogger("qaira.servicio")
+
+class ErrorConsulta(Exception):
+    pass
+
+# Índices de una instantánea (con o sin las horas marcadas), armados una sola vez por versión
+class Indices:
+    def __init__(self, instantanea):
+        self.instantanea = instantanea
+        self.diario = filtros.AireIndexado(instantanea.aire)
+        self.resoluciones = resoluciones.Resoluciones(instantanea.niveles, instantanea.variables)
+
+class Consultas:
+    def __init__(self, vigilante, entradas=ENTRADAS_CACHE):
+        self.vigilante = vigilante
+        self.entradas = entradas
+        self.candado = threading.Lock()
+        self.indices = {}
+        self.respuestas = OrderedDict()
+
+    def obtener_indices(self, instantanea, excluir_marcadas):
+        clave = (instantanea.version, excluir_marcadas)
+        with self.candado:
+            indices = self.indices.get(clave)
+        if indices is None:
+            with rendimiento.etapa("servicio indices", entrada=len(instantanea.aire)):
+                indices = Indices(instantanea.sin_marcadas() if excluir_marcadas else instantanea)
+            with self.candado:
+                # Solo se conservan los de la versión actual
+                self.indices = {c: i for c, i in self.indices.items() if c[0] == instantanea.version}
+                indices = self.indices.setdefault(clave, indices)
+        return indices
+
+    # Parámetros normalizados; la etiqueta se calcula antes de tocar los datos
+    def normalizar(self, parametros, instantanea):
+        def lista(nombre):
+            return [valor for valores in parametros.get(nombre, []) for valor in valores.split(",") if valor]
+
+        def fecha(nombre):
+            valor = parametros.get(nombre, [None])[-1]
+            if valor is None:
+                return None
+            try:
+                return str(np.datetime64(valor, 'D'))
+            except ValueError:
+                raise ErrorConsulta(f"Fecha inválida en '{nombre}': {valor}")
+
+        variables = lista('variables') or list(instantanea.variables)
+        desconocidas = [variable for variable in variables if variable not in instantanea.variables]
+        if desconocidas:
+            raise ErrorConsulta(f"Variables desconocidas: {', '.join(desconocidas)}")
+        resolucion = parametros.get('resolucion', ['automatica'])[-1]
+        if resolucion not in RESOLUCIONES:
+            raise ErrorConsulta(f"Resolución inválida: {resolucion} (válidas: {', '.join(RESOLUCIONES)})")
+        marcadas = parametros.get('marcadas', ['incluir'])[-1]
+        if marcadas not in ('incluir', 'excluir'):
+            raise ErrorConsulta("'marcadas' debe ser 'incluir' o 'excluir'")
+        return {
+            'ubicaciones': sorted(set(lista('ubicacion'))), 'inicio': fecha('inicio'), 'fin': fecha('fin'),
+            'variables': variables, 'resolucion': resolucion, 'marcadas': marcadas,
+        }
+
+    def consultar(self, consulta, indices):
+        diario = indices.diario
+        ubicaciones = consulta['ubicaciones'] or diario.ubicaciones
+        inicio = np.datetime64(consulta['inicio'] or diario.fechas.min(), 'D')
+        fin = np.datetime64(consulta['fin'] or diario.fechas.max(), 'D')
+        if inicio > fin:
+            raise ErrorConsulta("La fecha de inicio es posterior a la de fin")
+        nivel = resoluciones.elegir_nivel(inicio, fin) if consulta['resolucion'] == 'automatica' else consulta['resolucion']
+        if nivel == 'dia':
+            data = diario.filtrar(ubicaciones, inicio, np.datetime64(fin, 'ns'))[datos.CLAVES + consulta['variables']]
+        else:
+            data = indices.resoluciones.seleccionar(nivel, ubicaciones, inicio, fin, consulta['variables'])
+        return data.reset_index(drop=True), nivel
+
+    # `instantanea` es la misma con la que se calculó el ETag: si el vigilante publica otra versión en el
+    # medio, el cuerpo no debe salir de los datos nuevos con la etiqueta de los anteriores
+    def responder(self, instantanea, consulta, formato, comprimir):
+        clave = json.dumps([instantanea.version, consulta, formato, comprimir], sort_keys=True)
+        with self.candado:
+            respuesta = self.respuestas.get(clave)
+            if respuesta is not None:
+                self.respuestas.move_to_end(clave)
+                return respuesta
+        indices = self.obtener_indices(instantanea, consulta['marcadas'] == 'excluir')
+        with rendimiento.etapa("servicio consulta") as medicion:
+            data, nivel = self.consultar(consulta, indices)
+            indice = indices.diario if nivel == 'dia' else indices.resoluciones.indices[nivel]
+            medicion.entrada = indice.filas_de(consulta['ubicaciones'] or indices.diario.ubicaciones)
+            medicion.salida = len(data)
+        with rendimiento.etapa("servicio serializacion", entrada=len(data)):
+            cuerpo = serializar(data, formato)
+            if comprimir:
+                cuerpo = gzip.compress(cuerpo, compresslevel=5)
+        respuesta = {'cuerpo': cuerpo, 'nivel': nivel, 'filas': len(data)}
+        with self.candado:
+            self.respuestas[clave] = respuesta
+            while len(self.respuestas) > self.entradas:
+                self.respuestas.popitem(last=False)
+        return respuesta
+
+def serializar(data, formato):
+    if formato == 'arrow':
+        tabla = pa.Table.from_pandas(data, preserve_index=False)
+        sumidero = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sumidero, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+        return sumidero.getvalue().to_pybytes()
+    data = data.assign(Fecha=data['Fecha'].dt.strftime("%Y-%m-%dT%H:%M:%S"), Ubicación=data['Ubicación'].astype(str))
+    return data.to_json(orient='split', index=False, force_ascii=False).encode()
+
+def etiqueta(version, *partes):
+    return '"' + hashlib.sha256(json.dumps([version, *partes], sort_keys=True).encode()).hexdigest()[:20] + '"'
+
+class Manejador(BaseHTTPRequestHandler):
+    consultas = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parametros = parse_qs(url.query)
+        try:
+            if url.path == "/consulta":
+                self.consulta(parametros)
+            elif url.path == "/metadatos":
+                self.metadatos()
+            elif url.path == "/metrics":
+                self.enviar(200, rendimiento.texto_prometheus().encode(), "text/plain; version=0.0.4")
+            else:
+                self.enviar_json(404, {'error': f"Ruta desconocida: {url.path}"})
+        except ErrorConsulta as error:
+            self.enviar_json(400, {'error': str(error)})
+        except Exception as error:
+            registro.exception("Error atendiendo %s", self.path)
+            self.enviar_json(500, {'error': str(error)})
+
+    def consulta(self, parametros):
+        instantanea = self.consultas.vigilante.actual()
+        consulta = self.consultas.normalizar(parametros, instantanea)
+        formato = parametros.get('formato', [None])[-1] or ('arrow' if TIPO_ARROW in self.headers.get('Accept', '') else 'json')
+        if formato not in ('arrow', 'json'):
+            raise ErrorConsulta("'formato' debe ser 'arrow' o 'json'")
+        comprimir = formato == 'json' and 'gzip' in self.headers.get('Accept-Encoding', '')
+        # Misma versión y mismos parámetros: el cliente ya tiene la respuesta
+        marca = etiqueta(instantanea.version, consulta, formato, comprimir)
+        if self.no_modificado(marca):
+            return
+        respuesta = self.consultas.responder(instantanea, consulta, formato, comprimir)
+        self.enviar(200, respuesta['cuerpo'], TIPO_ARROW if formato == 'arrow' else TIPO_JSON + "; charset=utf-8", marca, {
+            'Content-Encoding': 'gzip' if comprimir else None,
+            'X-Qaira-Version': str(instantanea.version), 'X-Qaira-Resolucion': respuesta['nivel'], 'X-Qaira-Filas': str(respuesta['filas']),
+        })
+
+    def metadatos(self):
+        instantanea = self.consultas.vigilante.actual()
+        marca = etiqueta(instantanea.version, "metadatos")
+        if self.no_modificado(marca):
+            return
+        diario = self.consultas.obtener_indices(instantanea, False).diario
+        cuerpo = {
+            'version': instantanea.version, 'ubicaciones': diario.ubicaciones, 'variables': instantanea.variables,
+            'resoluciones': RESOLUCIONES, 'inicio': str(diario.fechas.min())[:10] if len(diario.fechas) else None,
+            'fin': str(diario.fechas.max())[:10] if len(diario.fechas) else None,
+        }
+        self.enviar(200, json.dumps(cuerpo, ensure_ascii=False).encode(), TIPO_JSON + "; charset=utf-8", marca)
+
+    def no_modificado(self, marca):
+        etiquetas = [valor.strip() for valor in self.headers.get('If-None-Match', '').split(",")]
+        if marca in etiquetas or '*' in etiquetas:
+            self.enviar(304, b"", None, marca)
+            return True
+        return False
+
+    def enviar_json(self, estado, cuerpo):
+        self.enviar(estado, json.dumps(cuerpo, ensure_ascii=False).encode(), TIPO_JSON + "; charset=utf-8")
+
+    def enviar(self, estado, cuerpo, tipo, marca=None, cabeceras=None):
+        self.send_response(estado)
+        if tipo:
+            self.send_header("Content-Type", tipo)
+        if marca:
+            self.send_header("ETag", marca)
+            # El cliente (o el proxy) puede guardar la respuesta, pero debe revalidarla con el ETag
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept, Accept-Encoding")
+        for nombre, valor in (cabeceras or {}).items():
+            if valor is not None:
+                self.send_header(nombre, valor)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *argumentos):
+        registro.info("%s - %s", self.address_string(), formato % argumentos)
+
+def crear_servidor(host, puerto, vigilante):
+    manejador = type("ManejadorQaira", (Manejador,), {'consultas': Consultas(vigilante)})
+    servidor = ThreadingHTTPServer((host, puerto), manejador)
+    servidor.daemon_threads = True
+    return servidor
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio HTTP de consultas sobre los datos de calidad de aire (Arrow IPC o JSON)")
+    parser.add_argument("--ruta", default=os.environ.get("QAIRA_DATOS", datos.RUTA_AIRE), help="CSV de mediciones, directorio o patrón glob")
+    parser.add_argument("--host", default="127.0.0.1", help="Interfaz en la que escuchar (0.0.0.0 detrás de un proxy)")
+    parser.add_argument("--puerto", type=int, default=PUERTO)
+    argumentos = parser.parse_args()
+
+    registro.addHandler(logging.StreamHandler())
+    registro.setLevel(logging.INFO)
+    # Siempre se miden las etapas para que /metrics tenga datos
+    rendimiento.activar(True, memoria=rendimiento.MODO == "memoria")
+    servidor = crear_servidor(argumentos.host, argumentos.puerto, vigilancia.Vigilante(argumentos.ruta))
+    registro.info("Escuchando en http://%s:%d", argumentos.host, argumentos.puerto)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+if __name__ == "__main__":
+    main()
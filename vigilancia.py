@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+
+import datos
+import rendimiento
+
+# Cada cuántos segundos se revisa el directorio de datos
+INTERVALO_SEGUNDOS = float(os.environ.get("QAIRA_INTERVALO_VIGILANCIA", 10))
+registro = logging.getLogger("qaira.vigilancia")
+
+# Lo que ven las páginas en un momento dado. Nunca se modifica: cada ingesta arma uno nuevo.
+# `excluye_marcadas` indica que aire y niveles ya no tienen las horas marcadas por el control de calidad.
+class Instantanea:
+    def __init__(self, version, aire, niveles, variables, excluye_marcadas=False):
+        self.version = version
+        self.aire = aire
+        self.niveles = niveles
+        self.variables = variables
+        self.excluye_marcadas = excluye_marcadas
+        self.derivadas = {}
+        self.candado = threading.RLock()
+
+    # Estructuras derivadas (cubo, índice, cumplimiento...) por nombre, armadas una sola vez: la primera
+    # página que las pide o, desde la segunda versión, el vigilante antes de publicarla
+    def derivada(self, nombre, armar):
+        with self.candado:
+            if nombre not in self.derivadas:
+                self.derivadas[nombre] = armar(self)
+            return self.derivadas[nombre]
+
+    def armadas(self):
+        with self.candado:
+            return set(self.derivadas)
+
+    def sin_marcadas(self):
+        def armar(instantanea):
+            aire, niveles = datos.excluir_marcadas(instantanea.niveles, instantanea.variables, instantanea.aire)
+            return Instantanea(instantanea.version, aire, niveles, instantanea.variables, excluye_marcadas=True)
+        return self.derivada("sin_marcadas", armar)
+
+# Hilo que revisa por sondeo (tamaño y fecha de modificación) los CSV que ingiere: `ruta` y el registro
+# de estaciones o, si `ruta` es un directorio o un patrón, todos sus archivos. Cuando algo cambia, ingiere
+# solo lo agregado (el modo incremental de datos.cargar_aire) y publica una nueva instantánea con la
+# versión incrementada. Las páginas leen `actual()` sin esperar a la ingesta.
+# `preparar(instantanea, anterior)` arma en este hilo, antes de publicar una versión nueva, las
+# estructuras derivadas que las páginas ya usaban en la anterior: las sesiones que se vuelven a ejecutar
+# solo cambian de referencia. La primera versión no se prepara, para no demorar la primera página.
+class Vigilante:
+    def __init__(self, ruta=datos.RUTA_AIRE, ruta_estaciones=datos.RUTA_ESTACIONES, intervalo=INTERVALO_SEGUNDOS, preparar=None):
+        self.ruta = ruta
+        self.ruta_estaciones = ruta_estaciones
+        self.intervalo = intervalo
+        self.preparar = preparar
+        self.candado = threading.Lock()
+        self.detener = threading.Event()
+        self.instantanea = None
+        self.firma = None
+        self.firma_fallida = None
+        self.error = None
+        # La primera carga es síncrona: sin datos no hay nada que mostrar
+        self.revisar()
+        self.hilo = threading.Thread(target=self.ciclo, name="qaira-vigilancia", daemon=True)
+        self.hilo.start()
+
+    def firma_actual(self):
+        # Con un solo CSV los demás archivos del directorio no se ingieren: no deben cambiar la versión
+        archivos = datos.expandir(self.ruta, self.ruta_estaciones) if datos.es_multiple(self.ruta) else [self.ruta]
+        archivos = archivos + [self.ruta_estaciones]
+        firma = {}
+        for archivo in archivos:
+            try:
+                estado = os.stat(archivo)
+            except OSError:
+                continue
+            firma[archivo] = (estado.st_size, estado.st_mtime_ns)
+        return firma
+
+    def revisar(self):
+        firma = self.firma_actual()
+        if firma == self.firma or firma == self.firma_fallida:
+            return False
+        try:
+            with rendimiento.etapa("ingesta") as medicion:
+                aire = datos.abrir_compartido(self.ruta, ruta_estaciones=self.ruta_estaciones)
+                niveles, variables = datos.cargar_niveles(self.ruta, ruta_estaciones=self.ruta_estaciones)
+                medicion.entrada = len(niveles['hora'])
+                medicion.salida = len(aire)
+            # Solo este hilo (o la primera carga, antes de lanzarlo) reemplaza la instantánea
+            version = self.instantanea.version + 1 if self.instantanea is not None else 1
+            instantanea = Instantanea(version, aire, niveles, variables)
+            if self.preparar is not None and self.instantanea is not None:
+                self.preparar(instantanea, self.instantanea)
+        except Exception as error:
+            # Un archivo a medio copiar o mal formado no debe tumbar el tablero: se conservan los datos
+            # anteriores y se reintenta cuando los archivos vuelvan a cambiar
+            registro.warning("No se pudo ingerir %s: %s", self.ruta, error)
+            self.error = str(error)
+            self.firma_fallida = firma
+            if self.instantanea is None:
+                raise
+            return False
+        with self.candado:
+            self.instantanea = instantanea
+            self.firma = firma
+            self.error = None
+        registro.info("Datos actualizados a la versión %d", version)
+        return True
+
+    def ciclo(self):
+        while not self.detener.wait(self.intervalo):
+            # Ninguna sesión muestra las mediciones de este hilo; solo cuentan para los totales
+            rendimiento.reiniciar()
+            self.revisar()
+
+    def actual(self):
+        with self.candado:
+            return self.instantanea